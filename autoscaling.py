@@ -0,0 +1,155 @@
+"""
+Works out how many st_worker instances should be running while years are pulled from a work queue.
+
+Rather than fixing the number of instances up front, the user gives a target time for the whole
+run and/or a maximum hourly spend, and an AutoscalingController is asked regularly how many
+instances there should be. It is given the number of years left in the work queue, and measures
+how many years each instance gets through per hour from how quickly the queue empties. Until
+the first year has been finished, runtimes from previous runs (see scheduling) are used instead.
+
+Instances are added as soon as they are needed, so a run starts with as many instances as it
+needs. Instances are only removed once throughput has been measured and not soon after instances
+have been added (so that the fleet does not keep growing and shrinking), and are removed by
+letting their workers finish the year they are on (see fabfile.drain_worker).
+"""
+from __future__ import print_function
+
+import math
+import logging
+from time import time
+
+import scheduling
+
+log = logging.getLogger('st_master.autoscaling')
+
+# How often the fleet size is reconsidered (s).
+CONTROL_INTERVAL = 300
+# Assumed time for one instance to analyse one year if there is no runtime history.
+DEFAULT_YEAR_HOURS = 2.
+# Instances are not removed for this long (s) after instances have been added.
+SCALE_DOWN_DELAY = 1800
+
+
+def mean_year_hours(years, year_runtimes):
+    """
+    Mean predicted runtime (hours) of years, from historical year_runtimes {year: runtime (s)}.
+    Years with no history are assumed to take the median known runtime.
+    """
+    if not year_runtimes or not years:
+        return DEFAULT_YEAR_HOURS
+    default_runtime = scheduling._median(year_runtimes.values())
+    return sum(year_runtimes.get(year, default_runtime) for year in years) / len(years) / 3600.
+
+
+class AutoscalingController(object):
+    """
+    Decides how many instances there should be so that all years are finished within
+    target_hours of the controller being created, while spending at most max_hourly_spend ($) an
+    hour on instances that cost instance_hourly_cost ($) an hour each. Either limit can be left
+    out (None): with no target time, as many instances as the spend allows are used.
+
+    year_hours is the predicted time (hours) for one instance to analyse one year, used until
+    throughput has been measured. The instances the run starts with count as being added at
+    start_time.
+    """
+    def __init__(self, target_hours=None, max_hourly_spend=None, instance_hourly_cost=None,
+                 max_instances=20, year_hours=DEFAULT_YEAR_HOURS, start_time=None,
+                 scale_down_delay=SCALE_DOWN_DELAY):
+        if target_hours is None and max_hourly_spend is None:
+            raise ValueError('target_hours and/or max_hourly_spend must be given')
+        if max_hourly_spend is not None and not instance_hourly_cost:
+            raise ValueError('instance_hourly_cost must be given with max_hourly_spend')
+        self.target_hours = target_hours
+        self.max_hourly_spend = max_hourly_spend
+        self.instance_hourly_cost = instance_hourly_cost
+        self.max_instances = max_instances
+        self.year_hours = year_hours
+        self.start_time = time() if start_time is None else start_time
+        self.scale_down_delay = scale_down_delay
+        self.last_scale_up = self.start_time
+
+        self.initial_remaining = None
+        self.instance_hours = 0.
+        self.last_update = None
+        self.num_running = 0
+        self.completed = 0
+
+    def update(self, remaining, num_running, now=None):
+        """
+        Records that remaining years are left in the queue (including those being worked on) and
+        that num_running instances are running workers.
+        """
+        now = time() if now is None else now
+        if self.initial_remaining is None:
+            self.initial_remaining = remaining
+        if self.last_update is not None:
+            self.instance_hours += self.num_running * (now - self.last_update) / 3600.
+        self.last_update = now
+        self.num_running = num_running
+        self.completed = self.initial_remaining - remaining
+
+    def measured(self):
+        """
+        Whether about one year per running instance has been finished, so that throughput is
+        not judged from the first (possibly quick) years alone.
+        """
+        return self.completed > 0 and self.completed >= self.num_running
+
+    def years_per_instance_hour(self):
+        """
+        Measured throughput of one instance, or predicted throughput if nothing has finished yet.
+        """
+        if self.measured() and self.instance_hours > 0:
+            return self.completed / self.instance_hours
+        return 1. / self.year_hours
+
+    def max_affordable(self):
+        if self.max_hourly_spend is None:
+            return self.max_instances
+        return min(self.max_instances,
+                   int(self.max_hourly_spend / self.instance_hourly_cost + 1e-9))
+
+    def desired_instances(self, remaining, now=None):
+        """
+        Returns how many instances there should be with remaining years left in the queue.
+        """
+        now = time() if now is None else now
+        if remaining <= 0:
+            return 0
+
+        if self.target_hours is None:
+            needed = remaining
+        else:
+            hours_left = self.target_hours - (now - self.start_time) / 3600.
+            if hours_left <= 0:
+                needed = remaining
+            else:
+                needed = int(math.ceil(remaining /
+                                       (self.years_per_instance_hour() * hours_left) - 1e-9))
+        # Any more instances than years would have nothing to do.
+        needed = min(needed, remaining)
+        return max(1, min(needed, self.max_affordable()))
+
+    def plan(self, remaining, num_active, now=None):
+        """
+        Returns the change in the number of instances: positive to add instances, negative to
+        remove them. num_active includes instances that are being launched or set up.
+        """
+        now = time() if now is None else now
+        if remaining <= 0:
+            # Workers stop by themselves once the queue is empty.
+            return 0
+        desired = self.desired_instances(remaining, now)
+        if desired > num_active:
+            change = desired - num_active
+            self.last_scale_up = now
+        elif (desired < num_active and self.measured() and
+              now - self.last_scale_up >= self.scale_down_delay):
+            change = desired - num_active
+        else:
+            change = 0
+        if change:
+            log.info('{0} year(s) left, {1:.2f} years/instance/hour{2}: {3} -> {4} instances'
+                     .format(remaining, self.years_per_instance_hour(),
+                             '' if self.measured() else ' (predicted)', num_active, desired))
+        return change
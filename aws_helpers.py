@@ -4,29 +4,107 @@ Uses `boto` to interact with AWS.
 
 Mainly uses the EC2 compute and S3 storage services.
 Credentials must be placed in file aws_credentials/credentials.csv (rel to .)
+
+Credentials and connections are cached, so repeatedly calling e.g. create_ec2_connection is cheap.
+Each thread gets its own connections, as boto connections must not be shared between threads.
 """
 from __future__ import print_function
 
 import os
 import sys
 import csv
+import json
+import functools
 import logging
 import math
-from time import sleep
+import base64
+import hashlib
+import binascii
+import threading
+from collections import deque
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+from time import sleep, time
 import datetime as dt
 
 import boto
 import boto.ec2
+import boto.s3.multipart
 import boto.sns
+import boto.sqs
+import boto.utils
+import boto.exception
 from filechunkio import FileChunkIO
 
 log = logging.getLogger('st_master.aws')
 
+# Smallest size possible for all but the last part of a multipart upload:
+MIN_PART_SIZE = 5242880
+DEFAULT_PART_SIZE = 4 * MIN_PART_SIZE
+# Objects larger than this are downloaded as several ranged GETs in parallel.
+DEFAULT_RANGE_SIZE = 32 * 2 ** 20
+# Kept in the download directory by sync_bucket.
+MANIFEST_FILENAME = '.s3_manifest.json'
+
+# EC2 errors that are worth retrying after a backoff.
+RETRY_EC2_ERROR_CODES = ('RequestLimitExceeded', 'InvalidInstanceID.NotFound',
+                         'InvalidSpotInstanceRequestID.NotFound')
+# Approximate on-demand prices ($/hour) in eu-central-1, used to estimate years per dollar. Check
+# current prices before relying on them.
+INSTANCE_HOURLY_COSTS = {
+    't2.medium': 0.06,
+    't2.large': 0.12,
+    'm4.large': 0.129,
+    'm4.xlarge': 0.257,
+    'm4.2xlarge': 0.513,
+    'c4.large': 0.134,
+    'c4.xlarge': 0.267,
+    'c4.2xlarge': 0.534,
+    'r3.large': 0.2,
+    'r3.xlarge': 0.4,
+}
+# Spot request states that mean it will never be fulfilled.
+SPOT_REQUEST_FAILED_STATES = ('cancelled', 'failed', 'closed')
+
 
 class AwsInteractionError(Exception):
     pass
 
 
+def _cached(func, context):
+    cache = {}
+    lock = threading.Lock()
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        key = context() + args
+        with lock:
+            if key not in cache:
+                cache[key] = func(*args)
+            return cache[key]
+    return wrapper
+
+
+def _cached_per_process(func):
+    """
+    Decorator that caches func's result for each set of arguments.
+
+    The process ID is part of the cache key, so processes forked with multiprocessing (e.g. by
+    st_master.run_analysis) get their own results instead of e.g. sharing sockets with their
+    parent.
+    """
+    return _cached(func, lambda: (os.getpid(), ))
+
+
+def _cached_per_thread(func):
+    """
+    Like _cached_per_process, but each thread also gets its own result. Used for connections, as
+    boto connections must not be shared between threads.
+    """
+    return _cached(func, lambda: (os.getpid(), threading.current_thread().ident))
+
+
+@_cached_per_process
 def _get_credentials():
     """
     Reads and returns credentials as:
@@ -37,12 +115,18 @@ def _get_credentials():
     return reader.next()
 
 
+@_cached_per_process
+def _get_ec2_region_names():
+    return [r.name for r in boto.ec2.regions()]
+
+
+@_cached_per_thread
 def create_ec2_connection(region):
     """
     Creates EC2 connection to the given region using credentials
     """
     log.debug("Connecting to {0}".format(region))
-    regions = [r.name for r in boto.ec2.regions()]
+    regions = _get_ec2_region_names()
     if region not in regions:
         raise Exception('Unkown region {0}\n{1}'.format(region, '\n'.join(regions)))
 
@@ -70,7 +154,7 @@ def get_ec2_ip_addresses(region, key, value="*"):
     conn = create_ec2_connection(region)
     instances = conn.get_only_instances(filters={key: value})
     for instance in instances:
-        if instance.update() == 'running':
+        if instance.state == 'running':
             log.debug("{0} is running".format(instance.ip_address))
             ip_addresses.append(str(instance.ip_address))
     return ip_addresses
@@ -79,6 +163,8 @@ def get_ec2_ip_addresses(region, key, value="*"):
 def create_instances(conn, args):
     """
     Creates instance(s) using args.
+    If args.spot_price is set, requests spot instances with that maximum price ($/hour) instead of
+    on-demand instances.
     """
     if not args.allow_multiple_instances:
         key = "tag:{0}".format(args.tag)
@@ -98,36 +184,33 @@ def create_instances(conn, args):
     dev_sda1.size = 18  # size in Gigabytes
     bdm['/dev/sda1'] = dev_sda1
 
-    reservations = conn.run_instances(args.image_id,
-                                      min_count=args.num_instances,
-                                      max_count=args.num_instances,
-                                      key_name='st_worker1',
-                                      instance_type=args.instance_type,
-                                      security_groups=['st_worker_security'],
-                                      block_device_map=bdm)
-
-    if len(reservations.instances) != args.num_instances:
-        raise Exception('Not enough instances created ({0}/{1})'.
-                        format(len(reservations.instances), args.args.num_instances))
-
-    for instance in reservations.instances:
-        instance.add_tag(args.tag, args.tag_value)
-
-    all_instances_running = False
-    running_instances = []
-    while not all_instances_running:
-        sleep(5)
-        all_instances_running = True
-        running_count = 0
-        for instance in reservations.instances:
-            if instance.update() != 'running':
-                all_instances_running = False
-                log.debug(instance.state)
-            else:
-                running_count += 1
-                if instance not in running_instances:
-                    running_instances.append(instance)
-        log.info('Instances running: ({0}/{1})'.format(running_count, args.num_instances))
+    if args.spot_price:
+        log.info('Requesting spot instances, max price: ${0}/hour'.format(args.spot_price))
+        requests = conn.request_spot_instances(str(args.spot_price),
+                                               args.image_id,
+                                               count=args.num_instances,
+                                               key_name='st_worker1',
+                                               instance_type=args.instance_type,
+                                               security_groups=['st_worker_security'],
+                                               block_device_map=bdm)
+        instance_ids = wait_for_spot_requests(conn, [request.id for request in requests])
+    else:
+        reservations = conn.run_instances(args.image_id,
+                                          min_count=args.num_instances,
+                                          max_count=args.num_instances,
+                                          key_name='st_worker1',
+                                          instance_type=args.instance_type,
+                                          security_groups=['st_worker_security'],
+                                          block_device_map=bdm)
+
+        if len(reservations.instances) != args.num_instances:
+            raise Exception('Not enough instances created ({0}/{1})'.
+                            format(len(reservations.instances), args.args.num_instances))
+
+        instance_ids = [instance.id for instance in reservations.instances]
+    _retry_ec2_call(conn.create_tags, instance_ids, {args.tag: args.tag_value})
+
+    running_instances = wait_for_instances_state(conn, instance_ids, 'running')
 
     # conn.attach_volume('vol-dd64eb93', instance.id, '/dev/sdf')
 
@@ -145,7 +228,7 @@ def list_instances(conn, args, running=True):
     for i, instance in enumerate(instances):
         log.info('Instance {0}'.format(i))
         log.info('    inst id   : {0}'.format(instance.id))
-        log.info('    state     : {0}'.format(instance.update()))
+        log.info('    state     : {0}'.format(instance.state))
         log.info('    IP address: {0}'.format(instance.ip_address))
         log.info('    conn cmd  : "ssh -i aws_credentials/st_worker1.pem ubuntu@{0}"'.
                  format(instance.ip_address))
@@ -157,9 +240,7 @@ def terminate_instance(conn, args, instance):
     """
     log.info('Terminating instance: {0}'.format(instance.id))
     instance.terminate()
-    while not instance.update() != 'terminated':
-        sleep(1)
-        log.debug(instance.state)
+    wait_for_instances_state(conn, [instance.id], 'terminated')
     log.info('Instance terminated')
 
 
@@ -169,23 +250,15 @@ def terminate_instances(conn, args):
     """
     key = "tag:{0}".format(args.tag)
     instances = get_instances(conn, filters={key: args.tag_value})
-    for instance in instances:
-        log.info('Terminating instance: {0}'.format(instance.id))
-        instance.terminate()
+    if not instances:
+        log.info('No instances to terminate')
+        return
 
-    all_instances_terminated = False
-    while not all_instances_terminated:
-        sleep(1)
-        all_instances_terminated = True
-        terminated_count = 0
-        for instance in instances:
-            if instance.update() != 'terminated':
-                all_instances_terminated = False
-                log.debug(instance.state)
-            else:
-                terminated_count += 1
-
-        log.info('Instances terminated: ({0}/{1})'.format(terminated_count, len(instances)))
+    instance_ids = [instance.id for instance in instances]
+    log.info('Terminating instances: {0}'.format(', '.join(instance_ids)))
+    _retry_ec2_call(conn.terminate_instances, instance_ids)
+
+    wait_for_instances_state(conn, instance_ids, 'terminated')
     log.info('All instances terminated')
 
 
@@ -205,19 +278,91 @@ def get_instances(conn, filters, running=True):
     Get all instances subject to filters and wheter or not they are running.
     """
     ret_instances = []
+    # Instances come back with their current state, no need to update() each one.
     instances = conn.get_only_instances(filters=filters)
     for instance in instances:
         if running:
-            if instance.update() == 'running':
+            if instance.state == 'running':
                 log.debug("Instance running {0}".format(instance.public_dns_name))
                 ret_instances.append(instance)
         else:
-            log.debug("Instance {0} {1}".format(instance.update(), instance.public_dns_name))
+            log.debug("Instance {0} {1}".format(instance.state, instance.public_dns_name))
             ret_instances.append(instance)
 
     return ret_instances
 
 
+def wait_for_instances_state(conn, instance_ids, state, min_poll_time=1, max_poll_time=30):
+    """
+    Waits until all given instances are in state, then returns them.
+
+    Uses a single describe call per poll, however many instances there are. The time between
+    polls doubles (up to max_poll_time) while nothing changes, and drops back to min_poll_time as
+    soon as another instance reaches state.
+    """
+    poll_time = min_poll_time
+    prev_count = 0
+    while True:
+        instances = _retry_ec2_call(conn.get_only_instances, instance_ids=instance_ids)
+        count = len([i for i in instances if i.state == state])
+        log.info('Instances {0}: ({1}/{2})'.format(state, count, len(instance_ids)))
+        if count == len(instance_ids):
+            return instances
+
+        if count > prev_count:
+            poll_time = min_poll_time
+        else:
+            poll_time = min(poll_time * 2, max_poll_time)
+        prev_count = count
+        sleep(poll_time)
+
+
+def wait_for_spot_requests(conn, request_ids, timeout=600, poll_time=10):
+    """
+    Waits until all given spot requests have been fulfilled, then returns the ids of their
+    instances. Cancels the requests if they are not all fulfilled within timeout seconds, or if any
+    of them can never be fulfilled.
+    """
+    start = time()
+    while True:
+        requests = _retry_ec2_call(conn.get_all_spot_instance_requests, request_ids=request_ids)
+        instance_ids = [r.instance_id for r in requests if r.state == 'active' and r.instance_id]
+        log.info('Spot requests fulfilled: ({0}/{1})'.format(len(instance_ids), len(request_ids)))
+        if len(instance_ids) == len(request_ids):
+            return instance_ids
+
+        failed = [r for r in requests if r.state in SPOT_REQUEST_FAILED_STATES]
+        if failed or time() - start > timeout:
+            conn.cancel_spot_instance_requests(request_ids)
+            # Instances may have been launched for some requests.
+            instance_ids = [r.instance_id for r in requests if r.instance_id]
+            if instance_ids:
+                conn.terminate_instances(instance_ids)
+            if failed:
+                status = failed[0].status.code if failed[0].status else failed[0].state
+                raise AwsInteractionError('Spot request {0} not fulfilled: {1}'.format(
+                    failed[0].id, status))
+            raise AwsInteractionError('Spot requests not fulfilled after {0}s'.format(timeout))
+        sleep(poll_time)
+
+
+def _retry_ec2_call(func, *args, **kwargs):
+    """
+    Calls an EC2 API function, backing off and retrying if throttled or if the instances are not
+    visible yet (EC2 is eventually consistent just after launch).
+    """
+    tries = 0
+    while True:
+        tries += 1
+        try:
+            return func(*args, **kwargs)
+        except boto.exception.EC2ResponseError as e:
+            if e.error_code not in RETRY_EC2_ERROR_CODES or tries > 6:
+                raise
+            log.debug('{0}, retrying'.format(e.error_code))
+            sleep(2 ** tries)
+
+
 def create_image(conn, instance_id, image_nametag, args):
     """
     Creates an AMI image from the given instance ID.
@@ -247,6 +392,7 @@ def create_image(conn, instance_id, image_nametag, args):
     return image
 
 
+@_cached_per_thread
 def create_s3_connection():
     username, aws_access_key_id, aws_secret_access_key = _get_credentials()
     conn = boto.connect_s3(aws_access_key_id=aws_access_key_id,
@@ -261,15 +407,84 @@ def list_files(bucket_name='stormtracks_data'):
         print(key.key)
 
 
-def get_all_files(bucket_name='stormtracks_data', 
-                  directory='/home/markmuetz/stormtracks_data/output/prod_release_1'):
+def get_all_files(bucket_name='stormtracks_data',
+                  directory='/home/markmuetz/stormtracks_data/output/prod_release_1',
+                  num_threads=8, range_size=DEFAULT_RANGE_SIZE, retries=3):
+    """
+    Downloads all files in a bucket to directory, skipping files that are already downloaded.
+    """
     conn = create_s3_connection()
     b = conn.get_bucket(bucket_name)
+    keys = []
     for key in b.list():
-        get_file(key, directory)
+        if _is_downloaded(key, directory):
+            log.debug('File {0} exists, skipping'.format(key.key))
+        else:
+            keys.append(key)
+    log.info('Downloading {0} files'.format(len(keys)))
+    download_keys(b, keys, directory, num_threads, range_size, retries)
+
 
+def sync_bucket(bucket_name='stormtracks_data',
+                directory='/home/markmuetz/stormtracks_data/output/prod_release_1',
+                prune=False, num_threads=8):
+    """
+    Brings directory up to date with a bucket, downloading only new or changed objects.
+
+    A manifest of each downloaded object's size, ETag and last modified date is kept in
+    directory/.s3_manifest.json, so changes are found by comparing the bucket listing against the
+    manifest rather than by inspecting files: local files are only looked at for objects that are
+    not in the manifest, or have changed. So a file deleted locally is only downloaded again once
+    it is removed from the manifest. Local files that match an object's size but are not yet in
+    the manifest (e.g. downloaded by get_all_files) are added to it without downloading.
+    If prune is set, files in the manifest whose objects are no longer in the bucket are deleted.
+    """
+    manifest_filename = os.path.join(directory, MANIFEST_FILENAME)
+    if os.path.exists(manifest_filename):
+        with open(manifest_filename, 'r') as f:
+            manifest = json.load(f)
+    else:
+        manifest = {}
 
-def get_file_from_name(filename, 
+    conn = create_s3_connection()
+    b = conn.get_bucket(bucket_name)
+    bucket_entries = {}
+    changed_keys = []
+    for key in b.list():
+        entry = {'size': key.size, 'etag': key.etag, 'last_modified': key.last_modified}
+        bucket_entries[key.key] = entry
+        if manifest.get(key.key) == entry:
+            continue
+        filename = os.path.join(directory, key.key)
+        if (key.key not in manifest and os.path.exists(filename) and
+                os.path.getsize(filename) == key.size):
+            log.debug('Adding existing file {0} to manifest'.format(key.key))
+            manifest[key.key] = entry
+        else:
+            changed_keys.append(key)
+
+    log.info('{0} new or changed files'.format(len(changed_keys)))
+    failed_keys = download_keys(b, changed_keys, directory, num_threads)
+    for key in changed_keys:
+        if key.key not in failed_keys:
+            manifest[key.key] = bucket_entries[key.key]
+
+    if prune:
+        for key_name in sorted(set(manifest) - set(bucket_entries)):
+            filename = os.path.join(directory, key_name)
+            log.info('Pruning: {0}'.format(key_name))
+            if os.path.exists(filename):
+                os.remove(filename)
+            del manifest[key_name]
+
+    # Write then rename so that an interrupted sync never leaves a corrupt manifest.
+    with open(manifest_filename + '.part', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(manifest_filename + '.part', manifest_filename)
+    return failed_keys
+
+
+def get_file_from_name(filename,
                        bucket_name='stormtracks_data',
                        directory='/home/markmuetz/stormtracks_data/output/prod_release_1'):
     conn = create_s3_connection()
@@ -279,70 +494,353 @@ def get_file_from_name(filename,
 
 
 def get_file(key, directory='/home/markmuetz/stormtracks_data/output/prod_release_1'):
-    filename = os.path.join(directory, key.key)
-    if os.path.exists(filename):
-        print('File {0} exists, skipping'.format(key.key))
+    if _is_downloaded(key, directory):
+        log.info('File {0} exists, skipping'.format(key.key))
         return
+    download_keys(key.bucket, [key], directory)
+
+
+def download_keys(bucket, keys, directory, num_threads=8, range_size=DEFAULT_RANGE_SIZE,
+                  retries=3):
+    """
+    Downloads keys from bucket to directory using a bounded pool of threads, each of which has its
+    own S3 connection. Objects larger than range_size are split into ranged GETs that are
+    downloaded in parallel.
+
+    Each file is written to a temporary .part file which is only renamed once all of it has been
+    downloaded, so an interrupted or failed download never leaves a truncated file behind.
+    Returns the names of any keys that could not be downloaded.
+    """
+    # Number of ranges left to download for each key.
+    ranges_left = {}
+
+    def range_tasks():
+        # The pool's task handler thread runs through this straight away, so every .part file is
+        # created (sparse, so taking no space yet) before most ranges have been downloaded.
+        for key in keys:
+            filename = os.path.join(directory, key.key)
+            if not os.path.exists(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            with open(filename + '.part', 'wb') as fp:
+                fp.truncate(key.size)
+
+            byte_ranges = [(start, min(start + range_size, key.size) - 1)
+                           for start in range(0, key.size, range_size)]
+            if not byte_ranges:
+                # Empty file.
+                byte_ranges = [None]
+            ranges_left[key.key] = len(byte_ranges)
+            for byte_range in byte_ranges:
+                yield bucket.name, key.key, filename + '.part', byte_range, retries
+
+    failed_keys = set()
+    pool = ThreadPool(num_threads)
+    try:
+        for key_name, downloaded in pool.imap_unordered(_download_range, range_tasks()):
+            if not downloaded:
+                failed_keys.add(key_name)
+            ranges_left[key_name] -= 1
+            if ranges_left[key_name] == 0:
+                filename = os.path.join(directory, key_name)
+                if key_name in failed_keys:
+                    log.error('Giving up on {0}'.format(key_name))
+                    os.remove(filename + '.part')
+                else:
+                    os.rename(filename + '.part', filename)
+                    log.info('Downloaded: {0}'.format(key_name))
+    except KeyboardInterrupt:
+        log.info('KeyboardInterrupt')
+        sys.exit(1)
+    finally:
+        # Every task has finished unless there was an error, in which case the rest are dropped.
+        pool.terminate()
+        pool.join()
+
+    return sorted(failed_keys)
+
+
+def _download_range(task):
+    """
+    Downloads one byte range (or the whole object if byte_range is None) of a key into the same
+    position of an existing file, retrying with backoff. Run in a thread, each of which has its own
+    S3 connection.
+    Returns the key name and whether the download succeeded.
+    """
+    bucket_name, key_name, filename, byte_range, retries = task
+    if byte_range is None:
+        headers = None
+    else:
+        headers = {'Range': 'bytes={0}-{1}'.format(*byte_range)}
 
-    downloaded = False
     tries = 0
-    while not downloaded:
-        print('Downloading: {0}'.format(key.key))
+    while True:
         tries += 1
         try:
-            key.get_contents_to_filename(filename)
-            downloaded = True
+            key = _thread_bucket(bucket_name).new_key(key_name)
+            with open(filename, 'r+b') as fp:
+                if byte_range is not None:
+                    fp.seek(byte_range[0])
+                key.get_contents_to_file(fp, headers=headers)
+            return key_name, True
         except Exception as e:
-            print('PROBLEM DOWNLOADING FILE:')
-            print(e)
-            if tries <= 3:
-                print('Try again.')
-                continue
-            else:
-                if os.path.exists(filename):
-                    print('DELETING FILE')
-                    os.remove(filename)
-                print('Giving up.')
-                break
-        except KeyboardInterrupt:
-            print('KeyboardInterrupt')
-            if os.path.exists(filename):
-                print('DELETING FILE')
-                os.remove(filename)
-            sys.exit(1)
+            if tries > retries:
+                log.error('Problem downloading {0} {1}: {2}'.format(key_name, byte_range, e))
+                return key_name, False
+            log.warn('Problem downloading {0} {1}, try again: {2}'.format(key_name, byte_range, e))
+            sleep(2 ** tries)
 
 
-def upload_large_file(filename):
+def _thread_bucket(bucket_name):
+    """
+    Returns the bucket using this thread's own S3 connection (see _cached_per_thread).
     """
-    Uploads a large file to AWS S3.
+    return create_s3_connection().get_bucket(bucket_name, validate=False)
+
+
+def _is_downloaded(key, directory):
+    filename = os.path.join(directory, key.key)
+    return os.path.exists(filename) and os.path.getsize(filename) == key.size
+
+
+def upload_large_file(filename, bucket_name='stormtracks_data', part_size=DEFAULT_PART_SIZE,
+                      num_threads=4, retries=3, verify=False):
+    """
+    Uploads a large file to AWS S3 as a multipart upload, sending parts concurrently.
+
+    If an unfinished multipart upload of the same file exists (e.g. from a worker that crashed),
+    it is resumed: parts that have already been uploaded with the right contents are skipped.
+    Each part is retried up to retries times. If verify is set, the ETag of the uploaded object is
+    checked against the MD5s of the local parts.
     """
+    if part_size < MIN_PART_SIZE:
+        raise AwsInteractionError('part_size must be at least {0} bytes'.format(MIN_PART_SIZE))
+
     conn = create_s3_connection()
-    b = conn.get_bucket('stormtracks_data')
+    b = conn.get_bucket(bucket_name)
 
     # Get file info
     source_path = filename
     source_size = os.stat(source_path).st_size
+    key_name = os.path.basename(source_path)
+
+    mp = None
+    for upload in b.get_all_multipart_uploads(prefix=key_name):
+        if upload.key_name == key_name:
+            log.info('Resuming multipart upload {0}'.format(upload.id))
+            mp = upload
+            break
+    if mp is None:
+        mp = b.initiate_multipart_upload(key_name)
+
+    uploaded_parts = dict((part.part_number, (part.size, part.etag.strip('"'))) for part in mp)
 
-    # Create a multipart upload request
-    mp = b.initiate_multipart_upload(os.path.basename(source_path))
+    chunk_count = int(math.ceil(source_size / float(part_size)))
+    part_args = []
+    for i in range(chunk_count):
+        offset = part_size * i
+        bytes = min(part_size, source_size - offset)
+        part_args.append((bucket_name, key_name, mp.id, source_path, i + 1, offset, bytes,
+                          uploaded_parts.get(i + 1), retries))
+
+    pool = ThreadPool(num_threads)
+    try:
+        part_md5s = pool.map(_upload_part, part_args)
+    finally:
+        pool.close()
+        pool.join()
+
+    # Finish the upload with this file's parts only: a resumed upload can also hold parts numbered
+    # above chunk_count (e.g. of an earlier version of the file), which complete_upload would
+    # include.
+    b.complete_multipart_upload(key_name, mp.id, _complete_upload_xml(part_md5s))
+
+    if verify:
+        expected_etag = '{0}-{1}'.format(hashlib.md5(''.join(part_md5s)).hexdigest(),
+                                         len(part_md5s))
+        etag = b.get_key(key_name).etag.strip('"')
+        if etag != expected_etag:
+            raise AwsInteractionError('ETag mismatch for {0}: {1} != {2}'.format(
+                key_name, etag, expected_etag))
+        log.debug('Verified ETag of {0}'.format(key_name))
+
+
+def _complete_upload_xml(part_md5s):
+    """
+    Body of a request to complete a multipart upload of parts 1..len(part_md5s).
+    """
+    xml = '<CompleteMultipartUpload>\n'
+    for part_num, md5 in enumerate(part_md5s, 1):
+        xml += '  <Part>\n'
+        xml += '    <PartNumber>{0}</PartNumber>\n'.format(part_num)
+        xml += '    <ETag>"{0}"</ETag>\n'.format(binascii.hexlify(md5))
+        xml += '  </Part>\n'
+    xml += '</CompleteMultipartUpload>'
+    return xml
 
-    # Use a chunk size of 5 MiB
-    # Smallest size possible:
-    chunk_size = 5242880
-    chunk_count = int(math.ceil(source_size / float(chunk_size)))
+
+def _upload_part(part_args):
+    """
+    Uploads one part of a multipart upload, unless an identical part has already been uploaded.
+    Run in a thread, each of which has its own S3 connection.
+    Returns the part's MD5 digest.
+    """
+    (bucket_name, key_name, upload_id, source_path, part_num, offset, bytes,
+     uploaded_part, retries) = part_args
 
     # Send the file parts, using FileChunkIO to create a file-like object
     # that points to a certain byte range within the original file. We
     # set bytes to never exceed the original file size.
-    for i in range(chunk_count):
-        log.debug('Uploading chunk {0}'.format(i + 1))
-        offset = chunk_size * i
-        bytes = min(chunk_size, source_size - offset)
-        with FileChunkIO(source_path, 'r', offset=offset, bytes=bytes) as fp:
-            mp.upload_part_from_file(fp, part_num=i + 1)
+    with FileChunkIO(source_path, 'r', offset=offset, bytes=bytes) as fp:
+        md5 = boto.utils.compute_md5(fp)
+        fp.seek(0)
+        if uploaded_part == (bytes, md5[0]):
+            log.debug('Chunk {0} already uploaded'.format(part_num))
+            return binascii.unhexlify(md5[0])
+
+        _send_part(bucket_name, key_name, upload_id, part_num, fp, md5, bytes, retries)
+        return binascii.unhexlify(md5[0])
+
+
+def _send_part(bucket_name, key_name, upload_id, part_num, fp, md5, size, retries):
+    """
+    Sends one part of a multipart upload from fp, retrying with backoff.
+    Run in a thread, each of which has its own S3 connection.
+    """
+    mp = boto.s3.multipart.MultiPartUpload(_thread_bucket(bucket_name))
+    mp.key_name = key_name
+    mp.id = upload_id
+
+    tries = 0
+    while True:
+        log.debug('Uploading chunk {0}'.format(part_num))
+        tries += 1
+        try:
+            mp.upload_part_from_file(fp, part_num=part_num, md5=md5[:2], size=size)
+            return
+        except Exception as e:
+            if tries > retries:
+                log.error('Giving up on chunk {0}'.format(part_num))
+                raise
+            log.warn('Problem uploading chunk {0}, try again: {1}'.format(part_num, e))
+            sleep(2 ** tries)
+            fp.seek(0)
+
+
+def publish_artefact(filename, sha1, bucket_name='stormtracks_data', expires_in=24 * 60 * 60):
+    """
+    Uploads filename to S3 under a key made from its SHA-1 (once only: skipped if that key
+    exists), so that many st_workers can fetch it in parallel rather than it being pushed to each
+    of them. Returns a presigned URL that the file can be fetched from for expires_in seconds.
+    """
+    conn = create_s3_connection()
+    b = conn.get_bucket(bucket_name)
+    key_name = 'artefacts/{0}/{1}'.format(sha1, os.path.basename(filename))
+    key = b.get_key(key_name)
+    if key is None:
+        log.info('Publishing {0} to {1}'.format(filename, key_name))
+        key = b.new_key(key_name)
+        key.set_contents_from_filename(filename)
+    else:
+        log.info('{0} already published'.format(filename))
+    return key.generate_url(expires_in)
+
 
-    # Finish the upload
-    mp.complete_upload()
+def get_key_size(key_name, bucket_name='stormtracks_data'):
+    """
+    Returns size of key_name in bucket, or None if it does not exist.
+    """
+    conn = create_s3_connection()
+    b = conn.get_bucket(bucket_name)
+    key = b.get_key(key_name)
+    if key is None:
+        return None
+    return key.size
+
+
+class MultipartUploadWriter(object):
+    """
+    Write-only file-like object that uploads everything written to it as a single S3 object,
+    without needing a copy of it on disk.
+
+    Data is sent as multipart upload parts of about part_size once enough has been written, with
+    at most num_threads parts being sent at once, so memory use is bounded by roughly
+    (num_threads + 1) * part_size. close() must be called to finish the upload, or cancel() to
+    abort it.
+    """
+    def __init__(self, key_name, bucket_name='stormtracks_data', part_size=DEFAULT_PART_SIZE,
+                 num_threads=4, retries=3):
+        if part_size < MIN_PART_SIZE:
+            raise AwsInteractionError('part_size must be at least {0} bytes'.format(MIN_PART_SIZE))
+        self.key_name = key_name
+        self.bucket_name = bucket_name
+        self.part_size = part_size
+        self.num_threads = num_threads
+        self.retries = retries
+
+        conn = create_s3_connection()
+        self.bucket = conn.get_bucket(bucket_name)
+        self.mp = self.bucket.initiate_multipart_upload(key_name)
+
+        self.buffer = []
+        self.buffer_size = 0
+        self.part_md5s = []
+        self.pending_parts = deque()
+        self.pool = ThreadPool(num_threads)
+        self.etag = None
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffer_size += len(data)
+        if self.buffer_size >= self.part_size:
+            self._send_buffer()
+
+    def _send_buffer(self):
+        # Wait for a thread to become free: bounds the number of parts held in memory.
+        while len(self.pending_parts) >= self.num_threads:
+            self.pending_parts.popleft().get()
+
+        data = ''.join(self.buffer)
+        self.buffer = []
+        self.buffer_size = 0
+
+        md5 = hashlib.md5(data)
+        self.part_md5s.append(md5.digest())
+        part_num = len(self.part_md5s)
+        md5_tuple = (md5.hexdigest(), base64.b64encode(md5.digest()))
+        self.pending_parts.append(self.pool.apply_async(
+            _send_part, (self.bucket_name, self.key_name, self.mp.id, part_num,
+                         StringIO(data), md5_tuple, len(data), self.retries)))
+
+    def close(self, verify=False):
+        """
+        Sends any remaining data and completes the upload. If that fails, the upload is cancelled.
+        If verify is set, the ETag of the uploaded object is checked against the sent parts.
+        """
+        try:
+            if self.buffer_size or not self.part_md5s:
+                self._send_buffer()
+            while self.pending_parts:
+                self.pending_parts.popleft().get()
+            self.pool.close()
+            self.pool.join()
+            self.mp.complete_upload()
+        except:
+            self.cancel()
+            raise
+
+        self.etag = '{0}-{1}'.format(hashlib.md5(''.join(self.part_md5s)).hexdigest(),
+                                     len(self.part_md5s))
+        if verify:
+            etag = self.bucket.get_key(self.key_name).etag.strip('"')
+            if etag != self.etag:
+                raise AwsInteractionError('ETag mismatch for {0}: {1} != {2}'.format(
+                    self.key_name, etag, self.etag))
+            log.debug('Verified ETag of {0}'.format(self.key_name))
+
+    def cancel(self):
+        self.pool.terminate()
+        self.pool.join()
+        self.mp.cancel_upload()
 
 
 def publish_message():
@@ -355,6 +853,7 @@ def publish_message():
                  message='sns test1')
 
 
+@_cached_per_thread
 def create_sns_connection(region):
     print("Connecting to {0}".format(region))
     username, aws_access_key_id, aws_secret_access_key = _get_credentials()
@@ -371,3 +870,25 @@ def create_sns_connection(region):
         raise Exception("Connection not created")
 
     return conn
+
+
+@_cached_per_thread
+def create_sqs_connection(region):
+    """
+    Creates SQS connection to the given region using credentials
+    """
+    log.debug("Connecting to {0}".format(region))
+    username, aws_access_key_id, aws_secret_access_key = _get_credentials()
+
+    conn = boto.sqs.connect_to_region(
+        region_name=region,
+        aws_access_key_id=aws_access_key_id,
+        aws_secret_access_key=aws_secret_access_key
+    )
+
+    if conn is not None:
+        log.debug("Connection with AWS established")
+    else:
+        raise Exception("Connection not created")
+
+    return conn
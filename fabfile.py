@@ -16,19 +16,35 @@ from __future__ import print_function
 import os
 import sys
 import csv
+import socket
 from subprocess import call
-from time import sleep
+from time import sleep, time
+from multiprocessing.pool import ThreadPool
 
 from boto.ec2 import connect_to_region
 from fabric.api import env, run, cd, settings, sudo, put, execute, task, prefix, get
-from fabric.api import parallel, hide
+from fabric.api import parallel, hide, runs_once
 from fabric.contrib.files import upload_template
 from fabric.context_managers import quiet
 from termcolor import cprint
+import paramiko
 
 from aws_helpers import get_ec2_ip_addresses
+from st_utils import file_sha1
+import fanout
 
 REGION = 'eu-central-1'
+# Written by cloud-init once an Ubuntu instance has finished booting.
+BOOT_FINISHED_MARKER = '/var/lib/cloud/instance/boot-finished'
+DOTSTORMTRACKS = 'st_worker_files/dotstormtracks.bz2'
+# Records SHA-1 of the dotstormtracks.bz2 that was last extracted on a worker.
+DOTSTORMTRACKS_EXTRACTED_MARKER = '.dotstormtracks.sha1'
+# (local, remote) files sent to each worker by install_supervisor and st_worker_run.
+WORKER_FILES = [('st_worker_files/supervisord.conf', 'supervisord.conf'),
+                ('st_worker_files/supervisor.conf', 'supervisor.conf'),
+                (DOTSTORMTRACKS, 'dotstormtracks.bz2')]
+# Once this exists, a worker stops claiming years from its work queue (see st_worker.py).
+WORKER_DRAIN_MARKER = '/home/ubuntu/stormtracks_data/drain'
 
 env.user = "ubuntu"
 env.key_filename = ["aws_credentials/st_worker1.pem"]
@@ -82,22 +98,127 @@ def log_vital_stats():
     sudo('supervisorctl start log_vital_stats')
 
 @task
-def st_worker_run(years):
+def st_worker_run(years, queue_uri=None, pipeline=False, disk_budget_gb=12, stream_upload=False,
+                  events_uri=None, dotstormtracks_url=None, run_id=None,
+                  spot_interruption_url=None, max_concurrent_years=1):
     """
     Configures worker to run with given years by copying settings then starting worker.
-    Uses settings template to say which years to run analysis on.
+    Uses settings template to say which years to run analysis on, or which work queue to pull
+    years from if queue_uri is given. If pipeline is set, the worker downloads ahead, using at
+    most disk_budget_gb of disk for downloaded data and output (root volume is 18GB). If
+    stream_upload is set, output is compressed straight into S3 without writing an archive to disk.
+    If events_uri is given, the worker pushes its status and heartbeats to that queue (see
+    heartbeat). Stages that the worker finished are not redone if it is restarted with the same
+    run_id (a new run_id is made if not given). If spot_interruption_url is given, the worker
+    watches it for notice that its spot instance is about to be reclaimed (see spot). Up to
+    max_concurrent_years years are run at once if there is enough memory and disk for them (0: one
+    per CPU).
+
+    dotstormtracks.bz2 and stormtracks settings are only sent if they have changed, and the
+    archive is only extracted if it has changed since it was last extracted. If
+    dotstormtracks_url is given, the worker fetches the archive from there (see
+    aws_helpers.publish_artefact) rather than it being sent from here.
     """
     print(years)
     get_system_state()
+    upload_worker_settings(years, queue_uri, pipeline, disk_budget_gb, stream_upload, events_uri,
+                           run_id, spot_interruption_url, max_concurrent_years)
+    prepare_worker(dotstormtracks_url)
+
+    sudo('supervisorctl start st_worker_run')
+
+
+@task
+@parallel
+def st_benchmark(years, num_procs=1):
+    """
+    Runs st_benchmark.py on the worker with years (list, or comma separated string), processing
+    num_procs years at a time, then gets its report. Returns the report's local filename.
+    """
+    if isinstance(years, basestring):
+        years = [int(year) for year in years.split(',')]
+    upload_worker_settings(years, run_id='benchmark')
+    prepare_worker()
+
+    report = 'stormtracks_data/logs/st_benchmark_{0}.json'.format(num_procs)
+    run('Projects/stormtracks_aws/st_worker_files/st_benchmark.py {0} {1} 0 {2}'.format(
+        report, num_procs, ' '.join(str(year) for year in years)))
+
+    local_dir = 'logs/benchmarks/{0}'.format(env.host)
+    if not os.path.exists(local_dir):
+        os.makedirs(local_dir)
+    get(report, local_dir + '/')
+    return os.path.join(local_dir, os.path.basename(report))
+
+
+def upload_worker_settings(years, queue_uri=None, pipeline=False, disk_budget_gb=12,
+                           stream_upload=False, events_uri=None, run_id=None,
+                           spot_interruption_url=None, max_concurrent_years=1):
+    """
+    Renders st_worker_settings.py on the worker (see st_worker_run).
+    """
     upload_template('st_worker_files/st_worker_settings.tpl.py',
                     'Projects/stormtracks_aws/st_worker_files/st_worker_settings.py',
-                    {'years': years})
+                    {'years': years,
+                     'queue_uri': queue_uri,
+                     'pipeline': bool(pipeline),
+                     'disk_budget_gb': float(disk_budget_gb),
+                     'stream_upload': bool(stream_upload),
+                     'events_uri': events_uri,
+                     'host': env.host,
+                     'run_id': run_id or str(int(time())),
+                     'spot_interruption_url': spot_interruption_url,
+                     'max_concurrent_years': int(max_concurrent_years)})
+
+
+def prepare_worker(dotstormtracks_url=None):
+    """
+    Makes sure the worker has the current dotstormtracks.bz2 extracted and stormtracks settings
+    (see st_worker_run).
+    """
+    sha1 = file_sha1(DOTSTORMTRACKS)
+    distribute_file(DOTSTORMTRACKS, 'dotstormtracks.bz2', url=dotstormtracks_url)
+    with quiet():
+        extracted_sha1 = run('cat {0}'.format(DOTSTORMTRACKS_EXTRACTED_MARKER))
+    if extracted_sha1 != sha1:
+        run('tar xf dotstormtracks.bz2')
+        run('echo {0} > {1}'.format(sha1, DOTSTORMTRACKS_EXTRACTED_MARKER))
+    # After extracting, which may have overwritten it.
+    distribute_file('st_worker_files/stormtracks_settings.py',
+                    '.stormtracks/stormtracks_settings.py')
 
-    put('st_worker_files/dotstormtracks.bz2', 'dotstormtracks.bz2')
-    run('tar xvf dotstormtracks.bz2')
-    put('st_worker_files/stormtracks_settings.py', '.stormtracks/stormtracks_settings.py')
 
-    sudo('supervisorctl start st_worker_run')
+def remote_sha1(remote_path):
+    """
+    Returns SHA-1 hex digest of remote_path, or None if it does not exist.
+    """
+    with quiet():
+        result = run('sha1sum {0}'.format(remote_path))
+    if result.failed:
+        return None
+    return result.split()[0]
+
+
+@task
+def distribute_file(local_path, remote_path, url=None):
+    """
+    Makes remote_path a copy of local_path, doing nothing if it already is one.
+    If url is given, the remote host downloads the file from url, falling back to sending it if
+    that fails. Returns True if the remote file was changed.
+    """
+    sha1 = file_sha1(local_path)
+    if remote_sha1(remote_path) == sha1:
+        print('{0} up to date'.format(remote_path))
+        return False
+
+    if url:
+        with quiet():
+            run("wget -q -O {0} '{1}'".format(remote_path, url))
+        if remote_sha1(remote_path) == sha1:
+            return True
+        print('Could not fetch {0} from url, sending it'.format(remote_path))
+    put(local_path, remote_path)
+    return True
 
 
 @task
@@ -110,8 +231,20 @@ def st_worker_status():
     return status
 
 
+@task
+def drain_worker():
+    """
+    Tells the worker to stop once it has finished the year(s) it is working on.
+    """
+    run('touch {0}'.format(WORKER_DRAIN_MARKER))
+
+
 @task
 def retrieve_logs():
+    """
+    Gets system state and all of the worker's logs, including st_worker_status.log,
+    st_worker_stages.jsonl and vital_stats.log/.bin.
+    """
     if not os.path.exists('logs/remote/{0}'.format(env.host)):
         os.makedirs('logs/remote/{0}'.format(env.host))
 
@@ -200,11 +333,11 @@ def install_supervisor(update=False):
     Starts supervisord running.
     """
     # supervisor configuration file.
-    put('st_worker_files/supervisord.conf', 'supervisord.conf')
+    distribute_file('st_worker_files/supervisord.conf', 'supervisord.conf')
     sudo('cp supervisord.conf /etc/supervisord.conf')
 
     # Upstart configuration file (MUST NOT be named supervisord.conf)
-    put('st_worker_files/supervisor.conf', 'supervisor.conf')
+    distribute_file('st_worker_files/supervisor.conf', 'supervisor.conf')
     sudo('cp supervisor.conf /etc/init/supervisor.conf')
 
     if update:
@@ -266,9 +399,23 @@ def monitor_directory_space(path='stormtracks_data/data/', poll_time=10):
 
 
 @task
-@parallel
+@runs_once
 def put_mem_usage():
-    put('st_worker_files/mem_usage.sh', 'mem_usage.sh', mode=0755)
+    fanout.fan_out('st_worker_files/mem_usage.sh', env.hosts, 'mem_usage.sh', mode=0755)
+
+
+@task
+@runs_once
+def fan_out_file(local_path, remote_path, num_threads=16, max_bandwidth_mb=0, relay=False):
+    """
+    Pushes local_path to remote_path on all hosts at once, e.g.
+    `fab set_hosts fan_out_file:st_worker_files/dotstormtracks.bz2,dotstormtracks.bz2,relay=1`
+    """
+    failed = fanout.fan_out(local_path, env.hosts, remote_path, num_threads=int(num_threads),
+                            max_bandwidth=float(max_bandwidth_mb) * 2 ** 20,
+                            relay=bool(relay))
+    for host, error in sorted(failed.items()):
+        cprint('{0}: {1}'.format(host, error), 'red')
 
 
 @task
@@ -277,6 +424,58 @@ def mount_vol():
     sudo('mount /dev/xvdf PERSISTENT_DATA')
 
 
+def iter_ready_hosts(hosts, timeout=600, poll_time=5, marker=BOOT_FINISHED_MARKER):
+    """
+    Probes all hosts at the same time, yielding (host, is_ready) for each host as soon as it
+    accepts SSH logins and marker file exists on it (if marker is given), or once timeout (s) has
+    passed without it becoming ready.
+    """
+    if not hosts:
+        return
+    deadline = time() + timeout
+    pool = ThreadPool(min(len(hosts), 32))
+    try:
+        for result in pool.imap_unordered(
+                lambda host: _wait_for_host(host, deadline, poll_time, marker), hosts):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _wait_for_host(host, deadline, poll_time, marker):
+    while not _is_host_ready(host, marker):
+        if time() > deadline:
+            return host, False
+        sleep(poll_time)
+    return host, True
+
+
+def _is_host_ready(host, marker):
+    # Check port first: much cheaper than trying to log in.
+    try:
+        sock = socket.create_connection((host, 22), timeout=5)
+        sock.close()
+    except socket.error:
+        return False
+
+    if marker is None:
+        return True
+
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    try:
+        client.connect(host, username=env.user, key_filename=env.key_filename, timeout=10)
+        stdin, stdout, stderr = client.exec_command('test -e {0}'.format(marker))
+        return stdout.channel.recv_exit_status() == 0
+    except Exception:
+        # Anything can go wrong while the instance is booting (e.g. EOFError while sshd is
+        # starting): the host is just not ready yet.
+        return False
+    finally:
+        client.close()
+
+
 def beep():
     call(['paplay', '/usr/share/sounds/LinuxMint/stereo/dialog-information.ogg'])
 
@@ -0,0 +1,210 @@
+"""
+Pushes one local file to many hosts at once.
+
+Fabric's put sends a file to one host at a time (or to all hosts at once with no limit). Here, the
+file is sent over SFTP by a bounded number of threads, each with its own SSH connection, and the
+total rate at which the master sends is capped. Hosts that already have an identical copy (same
+SHA-1) are skipped, and failed transfers are retried.
+
+With relay set, hosts that have received the file forward it to hosts that have not, using scp and
+the st_worker key that install_stormtracks copies to each worker, so the master's upstream
+bandwidth is only needed for the first few hosts.
+"""
+from __future__ import print_function
+
+import os
+import Queue
+import logging
+import threading
+from collections import deque
+from time import time, sleep
+
+import paramiko
+from fabric.api import env
+
+from st_utils import file_sha1
+
+log = logging.getLogger('st_master.fanout')
+
+# Where install_stormtracks puts the key on each worker, used for relaying.
+WORKER_KEY_FILENAME = 'Projects/stormtracks_aws/aws_credentials/st_worker1.pem'
+
+
+class FanOutError(Exception):
+    pass
+
+
+class TokenBucket(object):
+    """
+    Limits the total rate (bytes/s) of all threads that consume from it.
+    clock and sleep can be replaced, e.g. for testing.
+    """
+    def __init__(self, rate, capacity=None, clock=time, sleep=sleep):
+        self.rate = float(rate)
+        self.capacity = capacity or self.rate
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.last_time = clock()
+        self.lock = threading.Lock()
+
+    def consume(self, num_tokens):
+        """
+        Blocks until num_tokens are available, then takes them.
+        """
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * self.rate)
+                self.last_time = now
+                # Allow requests bigger than capacity, by letting tokens go negative.
+                if self.tokens >= min(num_tokens, self.capacity):
+                    self.tokens -= num_tokens
+                    return
+                wait = (min(num_tokens, self.capacity) - self.tokens) / self.rate
+            self.sleep(wait)
+
+
+class ThrottledFile(object):
+    """
+    Read-only file wrapper that takes tokens from bucket for every byte read.
+    """
+    def __init__(self, f, bucket):
+        self.f = f
+        self.bucket = bucket
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        if data:
+            self.bucket.consume(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+
+def fan_out(local_path, hosts, remote_path, mode=None, num_threads=16, max_bandwidth=None,
+            retries=3, relay=False, relay_fanout=2):
+    """
+    Pushes local_path to remote_path on all hosts, sending to at most num_threads hosts at once
+    from here, at a total of at most max_bandwidth bytes/s (unlimited if not given).
+
+    Each host is tried up to retries + 1 times. If relay is set, each host that has received the
+    file forwards it to up to relay_fanout other hosts at once.
+
+    Returns a dict of host: error for hosts that could not be sent the file.
+    """
+    sha1 = file_sha1(local_path)
+    bucket = TokenBucket(max_bandwidth) if max_bandwidth else None
+
+    results = Queue.Queue()
+    # A slot is a source that is free to send the file: None for here, or a host.
+    slots = deque([None] * num_threads)
+    pending = deque(hosts)
+    attempts = dict((host, 0) for host in hosts)
+    failed = {}
+    in_flight = 0
+
+    while pending or in_flight:
+        while pending and slots:
+            source = slots.popleft()
+            host = pending.popleft()
+            thread = threading.Thread(target=_transfer,
+                                      args=(results, source, host, local_path, remote_path,
+                                            sha1, mode, bucket))
+            thread.daemon = True
+            thread.start()
+            in_flight += 1
+
+        source, host, error = results.get()
+        in_flight -= 1
+        if error is None:
+            log.debug('Sent {0} to {1} from {2}'.format(remote_path, host, source or 'master'))
+            slots.append(source)
+            if relay:
+                # Prefer relays, to save bandwidth here.
+                slots.extendleft([host] * relay_fanout)
+            continue
+
+        log.warn('Could not send {0} to {1} from {2}: {3}'.format(
+            remote_path, host, source or 'master', error))
+        if source is None:
+            slots.append(source)
+        # else: don't relay from a host that could not send the file.
+        attempts[host] += 1
+        if attempts[host] > retries:
+            failed[host] = error
+        else:
+            pending.append(host)
+
+        if pending and not slots and not in_flight:
+            # Every relay has failed, fall back to sending from here.
+            slots.append(None)
+
+    if failed:
+        log.error('Could not send {0} to: {1}'.format(remote_path, ', '.join(sorted(failed))))
+    return failed
+
+
+def _connect(host):
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect(host, username=env.user, key_filename=env.key_filename, timeout=30)
+    return client
+
+
+def _run(client, cmd):
+    stdin, stdout, stderr = client.exec_command(cmd)
+    output = stdout.read()
+    if stdout.channel.recv_exit_status() != 0:
+        raise FanOutError('{0} failed: {1}'.format(cmd, stderr.read().strip()))
+    return output
+
+
+def _remote_sha1(client, remote_path):
+    try:
+        return _run(client, 'sha1sum {0}'.format(remote_path)).split()[0]
+    except FanOutError:
+        return None
+
+
+def _transfer(results, source, host, local_path, remote_path, sha1, mode, bucket):
+    # Runs in its own thread, puts (source, host, error) on results when done.
+    try:
+        client = _connect(host)
+        try:
+            if _remote_sha1(client, remote_path) != sha1:
+                if source is None:
+                    _send(client, local_path, remote_path, bucket)
+                else:
+                    _relay(source, host, remote_path)
+                if _remote_sha1(client, remote_path) != sha1:
+                    raise FanOutError('SHA-1 of {0} does not match'.format(remote_path))
+            if mode is not None:
+                client.open_sftp().chmod(remote_path, mode)
+        finally:
+            client.close()
+        results.put((source, host, None))
+    except Exception as e:
+        # Anything else (e.g. EOFError from paramiko) must be reported too, or fan_out would wait
+        # for this transfer forever.
+        results.put((source, host, str(e) or repr(e)))
+
+
+def _send(client, local_path, remote_path, bucket):
+    sftp = client.open_sftp()
+    try:
+        with open(local_path, 'rb') as f:
+            fp = ThrottledFile(f, bucket) if bucket else f
+            sftp.putfo(fp, remote_path, file_size=os.path.getsize(local_path))
+    finally:
+        sftp.close()
+
+
+def _relay(source, host, remote_path):
+    client = _connect(source)
+    try:
+        _run(client, 'scp -q -i {0} -o StrictHostKeyChecking=no -o BatchMode=yes '
+                     '{1} {2}@{3}:{1}'.format(WORKER_KEY_FILENAME, remote_path, env.user, host))
+    finally:
+        client.close()
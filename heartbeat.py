@@ -0,0 +1,226 @@
+"""
+Push-based monitoring of st_workers.
+
+Rather than the master polling each worker over SSH, each st_worker pushes events to an events
+queue (any work_queue URI, e.g. an SQS queue, or an SQLite queue when running locally). The
+master is usually a laptop that workers cannot connect to, so a queue that both sides connect to
+is used instead of e.g. HTTP. Events are dicts:
+
+* ``{'host': ..., 'time': ..., 'event': 'status', 'message': ...}`` - one per st_worker_status
+  log line, sent in batches every FLUSH_INTERVAL seconds, so e.g. 'finished year 2005' and
+  'analysed years 2005' are seen within seconds.
+  A 'claimed year' line also has ``'claim': {'unit': ..., 'handle': ...}``, so that the master can
+  release the claim if the worker dies (see work_queue).
+* ``{'host': ..., 'time': ..., 'event': 'heartbeat'}`` - sent every HEARTBEAT_INTERVAL seconds
+  while st_worker.py is running, so that a dead worker can be spotted.
+
+The master aggregates these using a HeartbeatCollector.
+"""
+from __future__ import print_function
+
+import os
+import logging
+import threading
+import multiprocessing.util
+from time import time
+
+from work_queue import open_queue
+
+log = logging.getLogger('st_master.heartbeat')
+
+HEARTBEAT_INTERVAL = 60
+# Logged status lines are sent in batches this often (s).
+FLUSH_INTERVAL = 2
+# Short, so that events are redelivered soon if the master dies while handling them.
+EVENTS_VISIBILITY_TIMEOUT = 60
+FINISHED_MESSAGE = 'analysed years'
+# Logged instead of FINISHED_MESSAGE by a worker whose spot instance is being reclaimed (see spot).
+INTERRUPTED_MESSAGE = 'interrupted'
+
+
+def make_event(host, event, **fields):
+    fields.update({'host': host, 'event': event, 'time': time()})
+    return fields
+
+
+class HeartbeatHandler(logging.Handler):
+    """
+    Logging handler that pushes each log message to the events queue as a status event.
+
+    Logging never waits for the queue: events are buffered and sent in batches every
+    flush_interval seconds by a sending thread. Safe to use from child processes: each process
+    starts its own sending thread, which sends what is left when the process exits.
+    """
+    def __init__(self, events_uri, host, flush_interval=FLUSH_INTERVAL):
+        logging.Handler.__init__(self)
+        self.events_uri = events_uri
+        self.host = host
+        self.flush_interval = flush_interval
+        self.pid = None
+
+    def emit(self, record):
+        try:
+            if self.pid != os.getpid():
+                self._start()
+            event = make_event(self.host, 'status', message=record.getMessage())
+            if hasattr(record, 'claim'):
+                event['claim'] = record.claim
+            with self.buffer_lock:
+                self.buffer.append(event)
+        except Exception:
+            self.handleError(record)
+
+    def _start(self):
+        # Nothing is kept from a parent process: its buffer lock could be held by its sending
+        # thread, which does not exist in this process.
+        self.pid = os.getpid()
+        self.buffer = []
+        self.buffer_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(name='heartbeat_handler', target=self._send_buffered)
+        self.thread.daemon = True
+        self.thread.start()
+        # Child processes exit without calling logging.shutdown, but do run these.
+        multiprocessing.util.Finalize(self, self.close, exitpriority=0)
+
+    def _send_buffered(self):
+        # Opened in this thread, as SQLite connections cannot be shared between threads.
+        queue = None
+        while True:
+            stopping = self.stopped.wait(self.flush_interval)
+            with self.buffer_lock:
+                events, self.buffer = self.buffer, []
+            if events:
+                try:
+                    if queue is None:
+                        queue = open_queue(self.events_uri, EVENTS_VISIBILITY_TIMEOUT)
+                    queue.put_units(events)
+                except Exception as e:
+                    print('Could not send {0} event(s): {1}'.format(len(events), e))
+            if stopping:
+                return
+
+    def close(self):
+        """
+        Sends any buffered events, then stops the sending thread.
+        """
+        if self.pid == os.getpid():
+            self.stopped.set()
+            self.thread.join()
+        logging.Handler.close(self)
+
+
+def start_heartbeat(events_uri, host, interval=HEARTBEAT_INTERVAL):
+    """
+    Starts a daemon thread that pushes a heartbeat event every interval seconds.
+    Returns the thread, which stops once its stopped attribute (a threading.Event) is set.
+    """
+    stopped = threading.Event()
+
+    def beat():
+        # Opened in this thread, and not shared with logging, so that a child process forked
+        # while a heartbeat is being sent cannot inherit a held lock.
+        queue = open_queue(events_uri, EVENTS_VISIBILITY_TIMEOUT)
+        while not stopped.is_set():
+            try:
+                queue.put_units([make_event(host, 'heartbeat')])
+            except Exception as e:
+                print('Could not send heartbeat: {0}'.format(e))
+            stopped.wait(interval)
+
+    thread = threading.Thread(name='heartbeat', target=beat)
+    thread.daemon = True
+    thread.stopped = stopped
+    thread.start()
+    return thread
+
+
+def receive_events(queue, wait_time=20):
+    """
+    Waits up to wait_time (s) for events on queue, removing them from it.
+    Returns the events in time order.
+    """
+    claims = queue.claim_batch(10, wait_time=wait_time)
+    if claims:
+        queue.complete_batch(claims)
+    return sorted((claim.unit for claim in claims), key=lambda e: e['time'])
+
+
+class HeartbeatCollector(object):
+    """
+    Aggregates the events pushed by st_workers into the latest state of each host.
+
+    Hosts are last seen when their events are applied, by the master's clock, so that a worker
+    whose clock is wrong is not taken to be stale.
+    """
+    def __init__(self, events_uri):
+        self.queue = open_queue(events_uri, EVENTS_VISIBILITY_TIMEOUT)
+        # host: {'last_seen': time, 'status': last status message, 'finished': bool,
+        #        'interrupted': bool, 'claims': {unit: claim handle}}
+        self.hosts = {}
+
+    def watch(self, hosts):
+        """
+        Starts watching hosts, so that they count as stale if they never send an event.
+        """
+        now = time()
+        for host in hosts:
+            self.hosts.setdefault(host, {'last_seen': now, 'status': None, 'finished': False,
+                                         'interrupted': False, 'claims': {}})
+
+    def poll(self, wait_time=20):
+        """
+        Waits up to wait_time (s) for events and applies them. Returns the events in time order.
+        """
+        return self.apply(receive_events(self.queue, wait_time))
+
+    def apply(self, events):
+        """
+        Updates the state of each host from events (e.g. received by another thread).
+        """
+        now = time()
+        for event in events:
+            state = self.hosts.setdefault(event['host'], {'last_seen': now,
+                                                          'status': None,
+                                                          'finished': False,
+                                                          'interrupted': False,
+                                                          'claims': {}})
+            state['last_seen'] = now
+            if event['event'] == 'status':
+                state['status'] = event['message']
+                if 'claim' in event:
+                    state['claims'][str(event['claim']['unit'])] = event['claim']['handle']
+                elif event['message'].startswith(('finished year ', 'released year ')):
+                    state['claims'].pop(event['message'].split()[-1], None)
+                if event['message'].startswith(FINISHED_MESSAGE):
+                    state['finished'] = True
+                elif event['message'].startswith(INTERRUPTED_MESSAGE):
+                    state['finished'] = True
+                    state['interrupted'] = True
+        return events
+
+    def finished_hosts(self):
+        return set(host for host, state in self.hosts.items() if state['finished'])
+
+    def interrupted_hosts(self):
+        """
+        Hosts that stopped early because their spot instance is being reclaimed.
+        """
+        return set(host for host, state in self.hosts.items() if state['interrupted'])
+
+    def claims(self, host):
+        """
+        Handles of the claims host has made and not yet finished or released.
+        """
+        return list(self.hosts.get(host, {}).get('claims', {}).values())
+
+    def stale_hosts(self, timeout=5 * HEARTBEAT_INTERVAL):
+        """
+        Hosts that have not finished and have not been heard from for timeout seconds.
+        """
+        now = time()
+        return set(host for host, state in self.hosts.items()
+                   if not state['finished'] and now - state['last_seen'] > timeout)
+
+    def delete(self):
+        self.queue.delete()
@@ -0,0 +1,416 @@
+"""
+Drives a whole fleet of st_workers from one process.
+
+Fabric is not thread-safe (it uses the global env and a global connection cache), so remote
+commands are run as tasks in a bounded pool of processes, and each task disconnects when it is
+done. Everything else - waiting for hosts to get ready, setting them up, monitoring them,
+retrieving their logs and terminating them - is driven by the main loop of FleetOrchestrator,
+which reacts to task results and st_worker events (see heartbeat) as soon as they arrive.
+"""
+from __future__ import print_function
+
+import Queue
+import logging
+import threading
+import multiprocessing as mp
+from time import time, sleep
+
+from fabric.api import execute
+from fabric.network import disconnect_all
+
+import fabfile
+import heartbeat
+import autoscaling
+from work_queue import open_queue
+from st_utils import setup_logging, parse_status_line
+
+log = logging.getLogger('st_master.orchestrator')
+
+# How often each host is checked over SSH when workers are not pushing events.
+STATUS_POLL_INTERVAL = 60
+
+# Supervisor states of an st_worker that has stopped for good: it is not restarted (see
+# supervisord.conf), e.g. after it logs the years that failed and exits.
+STOPPED_SUPERVISOR_STATES = ('EXITED', 'FATAL', 'STOPPED')
+
+# Host states.
+WAITING = 'waiting'
+SETTING_UP = 'setting up'
+RUNNING = 'running'
+RETRIEVING_LOGS = 'retrieving logs'
+DONE = 'done'
+
+
+def host_log(host):
+    """
+    Logger that writes to logs/st_master_<host>.log as well as to the st_master log.
+    """
+    name = 'st_master.{0}'.format(host)
+    logger = logging.getLogger(name)
+    if not logger.handlers:
+        setup_logging(name=name, filename='logs/st_master_{0}.log'.format(host),
+                      use_console=False)
+    return logger
+
+
+def setup_worker(host, args, years, worker_settings=None):
+    """
+    Updates code on host, then starts the st_worker and vital stats logging.
+    """
+    process_log = host_log(host)
+
+    process_log.info('Updating stormtracks')
+    execute(fabfile.update_stormtracks, host=host)
+    execute(fabfile.update_stormtracks_aws, host=host)
+
+    process_log.info('Updating supervisor')
+    execute(fabfile.install_supervisor, update=True, host=host)
+
+    process_log.info('Starting anaysis')
+    execute(fabfile.st_worker_run, years=years, host=host, **(worker_settings or {}))
+
+    while not execute(fabfile.log_exists, host=host)[host]:
+        process_log.info('Sleeping for 10s to allow creation of logfile')
+        sleep(10)
+    process_log.info('Logfile created')
+
+    # Must be done after st_worker has started running.
+    process_log.info('Logging mem usage')
+    execute(fabfile.log_vital_stats, host=host)
+
+
+def check_worker(host):
+    """
+    Returns the last line of the st_worker's status log and its supervisor status.
+    """
+    status = execute(fabfile.st_worker_status, host=host)[host]
+    supervisor_status_str = execute(fabfile.supervisorctl,
+                                    cmd='status', program='st_worker_run', host=host)[host]
+    return status, supervisor_status_str.split()[1]
+
+
+def retrieve_logs(host):
+    execute(fabfile.retrieve_logs, host=host)
+
+
+def drain_worker(host):
+    execute(fabfile.drain_worker, host=host)
+
+
+def _run_task(task, host, kwargs):
+    # Runs in a pool process. Errors are returned rather than raised: Fabric's abort raises
+    # SystemExit, which would otherwise kill the pool process and lose the result.
+    try:
+        return task.__name__, host, None, task(host=host, **kwargs)
+    except (Exception, SystemExit) as e:
+        host_log(host).error('{0} failed: {1!r}'.format(task.__name__, e))
+        return task.__name__, host, repr(e), None
+    finally:
+        disconnect_all()
+
+
+class FleetOrchestrator(object):
+    """
+    Sets up, monitors, retrieves logs from and terminates st_worker instances.
+
+    host_instances maps each host to its instance, and host_years maps each host to the years it
+    should analyse. At most max_concurrency remote commands run at once. If events_uri is given,
+    workers are monitored using the events they push rather than by polling them over SSH.
+
+    If launch_instances is given, it is called with a number of instances to launch and should
+    return the new instances; it is used to replace workers whose spot instances are reclaimed
+    (see spot). New instances are given no years, so they only take years from the work queue.
+
+    A monitored host that sends no events for stale_timeout seconds is reported, and one that sends
+    none for dead_timeout seconds is given up on: its logs are retrieved, it is terminated and the
+    years it claimed are released back to the work queue.
+
+    If controller (an autoscaling.AutoscalingController) is given, the number of years left in the
+    work queue at queue_uri is checked every autoscaling.CONTROL_INTERVAL seconds, and instances
+    are launched or drained as the controller decides.
+    """
+    def __init__(self, args, host_instances, host_years, worker_settings, events_uri=None,
+                 monitor=True, terminate=True, terminate_unready=True, ready_timeout=600,
+                 max_concurrency=8, stale_timeout=5 * heartbeat.HEARTBEAT_INTERVAL,
+                 dead_timeout=15 * heartbeat.HEARTBEAT_INTERVAL,
+                 launch_instances=None, controller=None, queue_uri=None):
+        self.args = args
+        self.host_instances = host_instances
+        self.host_years = host_years
+        self.worker_settings = worker_settings
+        self.events_uri = events_uri
+        self.monitor = monitor
+        self.terminate = terminate
+        self.terminate_unready = terminate_unready
+        self.ready_timeout = ready_timeout
+        self.max_concurrency = max_concurrency
+        self.stale_timeout = stale_timeout
+        self.dead_timeout = dead_timeout
+        self.launch_instances = launch_instances
+        self.controller = controller
+        self.queue_uri = queue_uri
+
+        self.states = dict((host, WAITING) for host in host_instances)
+        # Results from pool tasks and background threads all arrive on this queue.
+        self.results = Queue.Queue()
+        self.last_checked = {}
+        self.checking = set()
+        self.reported_stale = set()
+        self.collector = None
+        # Number of instances being launched.
+        self.launching = 0
+        self.running_since = {}
+        # Hosts that have been told to stop after their current year.
+        self.draining = set()
+
+    def run(self):
+        """
+        Blocks until every host is done.
+        """
+        # Create pool before starting any threads, its processes are forked. Sized for
+        # max_concurrency rather than the starting hosts, as hosts can be launched later.
+        self.pool = mp.Pool(self.max_concurrency)
+        try:
+            self._start_thread(self._wait_for_hosts, sorted(self.states))
+            if self.events_uri and self.monitor:
+                self.collector = heartbeat.HeartbeatCollector(self.events_uri)
+                self._start_thread(self._receive_events)
+            if self.controller is not None:
+                self._start_thread(self._watch_queue)
+
+            while self.launching or any(state != DONE for state in self.states.values()):
+                try:
+                    # Only times out so that periodic checks are made.
+                    self._handle(self.results.get(timeout=1))
+                except Queue.Empty:
+                    pass
+                self._check_hosts()
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+        if self.collector is not None:
+            self.collector.delete()
+
+    def _start_thread(self, target, *args):
+        thread = threading.Thread(name=target.__name__, target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def _wait_for_hosts(self, hosts):
+        log.info('Waiting for instance(s) to get ready')
+        for host, ready in fabfile.iter_ready_hosts(hosts, timeout=self.ready_timeout):
+            self.results.put(('ready', host, ready))
+
+    def _watch_queue(self):
+        queue = open_queue(self.queue_uri)
+        while True:
+            try:
+                self.results.put(('remaining', queue.remaining()))
+            except Exception as e:
+                log.error('Could not check work queue: {0}'.format(e))
+            sleep(autoscaling.CONTROL_INTERVAL)
+
+    def _release_claims(self, host, handles):
+        queue = open_queue(self.queue_uri)
+        for handle in handles:
+            try:
+                queue.release_handle(handle)
+            except Exception as e:
+                log.error('Could not release claim from {0}: {1!r}'.format(host, e))
+        log.info('Released {0} claim(s) from {1}'.format(len(handles), host))
+
+    def _launch(self, num_instances):
+        try:
+            instances = self.launch_instances(num_instances)
+        except Exception as e:
+            log.error('Could not launch instance(s): {0!r}'.format(e))
+            instances = []
+        self.results.put(('launched', num_instances, instances))
+
+    def _receive_events(self):
+        queue = open_queue(self.events_uri, heartbeat.EVENTS_VISIBILITY_TIMEOUT)
+        while True:
+            try:
+                events = heartbeat.receive_events(queue)
+            except Exception as e:
+                log.error('Could not receive events: {0}'.format(e))
+                sleep(10)
+                continue
+            if events:
+                self.results.put(('events', events))
+
+    def _submit(self, task, host, **kwargs):
+        self.pool.apply_async(_run_task, (task, host, kwargs), callback=self.results.put)
+
+    def _handle(self, result):
+        if result[0] == 'ready':
+            self._host_ready(*result[1:])
+        elif result[0] == 'launched':
+            self._instances_launched(*result[1:])
+        elif result[0] == 'remaining':
+            self._autoscale(result[1])
+        elif result[0] == 'events':
+            for event in self.collector.apply(result[1]):
+                if event['event'] == 'status':
+                    host_log(event['host']).info(event['message'])
+        else:
+            task_name, host, error, value = result
+            getattr(self, '_{0}_done'.format(task_name))(host, error, value)
+
+    def _host_ready(self, host, ready):
+        instance = self.host_instances[host]
+        if not ready:
+            log.error('Instance {0} ({1}) not ready after {2}s'.format(
+                instance.id, host, self.ready_timeout))
+            if self.host_years[host]:
+                log.error('Years not analysed: {0}'.format(self.host_years[host]))
+            if self.terminate_unready:
+                self._terminate(host)
+            self.states[host] = DONE
+            return
+
+        log.info('Running on host:{0}, instance_id: {1}'.format(host, instance.id))
+        self.states[host] = SETTING_UP
+        self._submit(setup_worker, host, args=self.args, years=self.host_years[host],
+                     worker_settings=self.worker_settings)
+
+    def _instances_launched(self, num_instances, instances):
+        self.launching -= num_instances
+        hosts = []
+        for instance in instances:
+            log.info('Launched instance {0} ({1})'.format(
+                instance.id, instance.ip_address))
+            self.host_instances[instance.ip_address] = instance
+            self.host_years[instance.ip_address] = []
+            self.states[instance.ip_address] = WAITING
+            hosts.append(instance.ip_address)
+        if hosts:
+            self._start_thread(self._wait_for_hosts, hosts)
+
+    def _setup_worker_done(self, host, error, value):
+        if error is not None:
+            log.error('Could not set up {0}: {1}'.format(host, error))
+            fabfile.beep()
+        if not self.monitor:
+            self.states[host] = DONE
+        elif error is not None:
+            self._finish(host)
+        else:
+            log.info('{0} running'.format(host))
+            self.states[host] = RUNNING
+            self.running_since[host] = time()
+            self.last_checked[host] = time()
+            if self.collector is not None:
+                self.collector.watch([host])
+
+    def _check_worker_done(self, host, error, value):
+        self.checking.discard(host)
+        self.last_checked[host] = time()
+        if self.states[host] != RUNNING:
+            return
+        if error is not None:
+            log.error('Problem checking {0}: {1}'.format(host, error))
+            fabfile.beep()
+            return
+
+        status, supervisor_status = value
+        host_log(host).info('{0}: {1}'.format(host, status))
+        message = parse_status_line(status)[1]
+        if message.startswith(heartbeat.FINISHED_MESSAGE):
+            self._finish(host)
+        elif message.startswith(heartbeat.INTERRUPTED_MESSAGE):
+            self._replace(host)
+            self._finish(host)
+        elif supervisor_status != 'RUNNING':
+            log.error('{0}: st_worker_run no longer running: {1}'.format(host, supervisor_status))
+            fabfile.beep()
+            if supervisor_status in STOPPED_SUPERVISOR_STATES:
+                self._finish(host)
+
+    def _drain_worker_done(self, host, error, value):
+        if error is not None:
+            log.error('Could not drain {0}: {1}'.format(host, error))
+            self.draining.discard(host)
+
+    def _retrieve_logs_done(self, host, error, value):
+        if error is not None:
+            log.error('Could not retrieve logs from {0}: {1}'.format(host, error))
+        if self.terminate:
+            self._terminate(host)
+            fabfile.beep()
+        self.states[host] = DONE
+
+    def _check_hosts(self):
+        running = set(host for host, state in self.states.items() if state == RUNNING)
+        if self.collector is not None:
+            interrupted_hosts = self.collector.interrupted_hosts()
+            for host in self.collector.finished_hosts() & running:
+                if host in interrupted_hosts:
+                    self._replace(host)
+                self._finish(host)
+
+            stale_hosts = self.collector.stale_hosts(self.stale_timeout) & running
+            for host in stale_hosts - self.reported_stale:
+                log.error('No events from {0} for over {1}s'.format(host, self.stale_timeout))
+                fabfile.beep()
+            self.reported_stale = stale_hosts
+
+            for host in self.collector.stale_hosts(self.dead_timeout) & running:
+                log.error('No events from {0} for over {1}s, giving up on it'.format(
+                    host, self.dead_timeout))
+                self._time_out(host)
+        else:
+            now = time()
+            for host in running - self.checking:
+                if now - self.last_checked[host] >= STATUS_POLL_INTERVAL:
+                    self.checking.add(host)
+                    self._submit(check_worker, host)
+
+    def _autoscale(self, remaining):
+        running = [host for host, state in self.states.items() if state == RUNNING]
+        active = [host for host, state in self.states.items()
+                  if state in (WAITING, SETTING_UP, RUNNING) and host not in self.draining]
+        self.controller.update(remaining, len(running))
+        change = self.controller.plan(remaining, len(active) + self.launching)
+        if change > 0 and self.launch_instances is not None:
+            self.launching += change
+            self._start_thread(self._launch, change)
+        elif change < 0:
+            # Most recently started first: they are the least likely to be near the end of a year.
+            running = sorted(set(running) - self.draining, key=lambda h: -self.running_since[h])
+            for host in running[:-change]:
+                log.info('Draining {0}'.format(host))
+                self.draining.add(host)
+                self._submit(drain_worker, host)
+
+    def _replace(self, host):
+        log.warn('{0} interrupted, its years have been put back on the work queue'.format(host))
+        self._launch_replacement(host)
+
+    def _time_out(self, host):
+        handles = self.collector.claims(host)
+        if self.queue_uri and handles:
+            # Otherwise its years would only be handed out again once the claims time out.
+            self._start_thread(self._release_claims, host, handles)
+            self._launch_replacement(host)
+        elif self.host_years[host]:
+            log.error('Years not analysed: {0}'.format(self.host_years[host]))
+        self._finish(host)
+
+    def _launch_replacement(self, host):
+        if self.launch_instances is not None:
+            log.info('Launching replacement for {0}'.format(host))
+            self.launching += 1
+            # Can take minutes, so done in the background.
+            self._start_thread(self._launch, 1)
+
+    def _finish(self, host):
+        log.info('{0} finished, retrieving logs'.format(host))
+        self.states[host] = RETRIEVING_LOGS
+        self._submit(retrieve_logs, host)
+
+    def _terminate(self, host):
+        instance = self.host_instances[host]
+        log.info('Terminating instance {0}'.format(instance.id))
+        instance.terminate()
@@ -1,24 +1,54 @@
 #!/usr/bin/env python
 # PYTHON_ARGCOMPLETE_OK
+"""
+Parses and plots logs retrieved from st_workers (see fabfile.retrieve_logs).
+
+Log files are parsed into numpy columns, which are cached in CACHE_DIR as .npz files so that
+each log is only parsed again once it has changed (size or mtime differs).
+"""
 import os
-from glob import glob
-import datetime as dt
+import json
+import struct
+import multiprocessing as mp
 
 import numpy as np
 import pylab as plt
 
 from commandify import commandify, command, main_command
 
+from scheduling import parse_status_log_runtimes
+
+REMOTE_LOGS_DIR = 'logs/remote'
+CACHE_DIR = 'logs/cache'
+FLEET_REPORT_DIR = 'logs/fleet_report'
+
+# Columns of vital_stats.log after date. Old logs only have the first four, missing columns are
+# NaN.
+VITAL_STATS_COLUMNS = ['mem_usage', 'used', 'free', 'df', 'rss', 'cpu', 'read', 'write',
+                       'num_procs']
+
+# Numeric fields of each line of st_worker_stages.jsonl (see st_worker.stage).
+STAGE_COLUMNS = ['year', 'start', 'end', 'duration', 'cpu', 'rchar', 'wchar', 'read_bytes',
+                 'write_bytes', 'peak_rss_mb']
+
+# Must match st_worker_files/log_vital_stats.py.
+RING_MAGIC = 'VSTATRB1'
+RING_HEADER_FMT = '<8sIdII'
+RING_FIELD_FMT = '16s'
+RING_TIER_FMT = '<IIQQ'
+
+
 @main_command
 def main():
     pass
 
-def get_hosts():
-    os.chdir('logs/remote')
 
-    hosts = sorted(glob('*'))
-    os.chdir('../../')
-    return hosts
+def get_hosts(remote_logs_dir=REMOTE_LOGS_DIR):
+    return sorted(os.listdir(remote_logs_dir))
+
+
+def host_log_filename(host, name, remote_logs_dir=REMOTE_LOGS_DIR):
+    return os.path.join(remote_logs_dir, host, 'logs', name)
 
 
 @command
@@ -27,32 +57,106 @@ def list_hosts():
         print(host)
 
 
-def check_vital_stat_line(line):
-    parts = line.strip().split(',')
-    if parts[0] == 'date':
-        return False
-    return True
-
-def read_vital_stat_line(line, parse_df=False):
-    parts = line.strip().split(',')
-    date = dt.datetime.strptime(parts[0], '%Y-%m-%d %H:%M:%S.%f')
-    percentage_mem = float(parts[1])
-    used_ram = int(parts[2])
-    free_ram = int(parts[3])
-    if parse_df:
-        df = float(parts[4])
-        return date, percentage_mem, used_ram, free_ram, df
-    else:
-        return date, percentage_mem, used_ram, free_ram
+def cached_parse(filename, parser, cache_dir=CACHE_DIR):
+    """
+    Returns parser(filename), a dict of numpy arrays, from the cache if filename has not changed
+    since it was cached.
+    """
+    stat = os.stat(filename)
+    cache_filename = os.path.join(cache_dir,
+                                  os.path.relpath(filename).replace(os.sep, '_') + '.npz')
+    if os.path.exists(cache_filename):
+        cached = np.load(cache_filename)
+        if (cached['_size'] == stat.st_size and cached['_mtime'] == stat.st_mtime):
+            return dict((k, cached[k]) for k in cached.files if not k.startswith('_'))
+
+    columns = parser(filename)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    np.savez(cache_filename, _size=stat.st_size, _mtime=stat.st_mtime, **columns)
+    return columns
+
+
+def read_vital_stats_log(filename):
+    """
+    Parses a vital_stats.log file into a dict of columns: 'date' (datetime64) and each of
+    VITAL_STATS_COLUMNS (float).
+    """
+    with open(filename, 'r') as f:
+        # Header is written each time log_vital_stats starts. The last line is skipped if it has not
+        # been written in full, as the log is often copied while it is still being appended to.
+        rows = [line.rstrip().split(',') for line in f
+                if line[:4].isdigit() and line.endswith('\n')]
+
+    columns = {'date': np.array([row[0] for row in rows], dtype='datetime64[us]')}
+    values = np.empty((len(rows), len(VITAL_STATS_COLUMNS)))
+    values.fill(np.nan)
+    # Group rows by number of columns, so that each group can be converted in one go.
+    widths = np.array([len(row) for row in rows])
+    for width in np.unique(widths):
+        indices = np.nonzero(widths == width)[0]
+        values[indices, :width - 1] = np.array([rows[i][1:] for i in indices], dtype=float)
+
+    for i, name in enumerate(VITAL_STATS_COLUMNS):
+        columns[name] = values[:, i]
+    return columns
+
+
+def read_analysis_log(filename):
+    """
+    Parses the timestamps of an analysis.log file into a dict of columns: 'date' (datetime64) and
+    'delta' (s between each line and the next).
+    """
+    with open(filename, 'r') as f:
+        # e.g. 2015-06-01 12:00:00,123 - skips continuation lines (e.g. tracebacks).
+        stamps = [line[:10] + 'T' + line[11:19] + '.' + line[20:23] for line in f
+                  if line[:4].isdigit() and line[19:20] == ',']
+    dates = np.array(stamps, dtype='datetime64[ms]')
+    return {'date': dates, 'delta': np.diff(dates) / np.timedelta64(1, 's')}
+
+
+def read_stages_log(filename):
+    """
+    Parses an st_worker_stages.jsonl file into a dict of columns, one row per stage of each year.
+    """
+    with open(filename, 'r') as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    columns = {'stage': np.array([e['stage'] for e in events], dtype=str),
+               'ok': np.array([e['status'] == 'ok' for e in events], dtype=bool)}
+    for name in STAGE_COLUMNS:
+        columns[name] = np.array([e[name] for e in events], dtype=float)
+    return columns
+
+
+def load_vital_stats(host):
+    return cached_parse(host_log_filename(host, 'vital_stats.log'), read_vital_stats_log)
+
+
+def load_analysis(host):
+    return cached_parse(host_log_filename(host, 'analysis.log'), read_analysis_log)
+
+
+def load_stages(host):
+    return cached_parse(host_log_filename(host, 'st_worker_stages.jsonl'), read_stages_log)
+
+
+def _column(col):
+    # col can be a column name or (for compatibility with older usage) an index, 1 being the
+    # first column after date.
+    if str(col).isdigit():
+        return VITAL_STATS_COLUMNS[int(col) - 1]
+    return col
 
 
 @command
-def parse_all_vital_stats(col=1, parse_df=False):
+def parse_all_vital_stats(col='mem_usage'):
     run_times = []
     for host in get_hosts():
-        vals = parse_vital_stats(host, col, parse_df, plot=False)
-        plt.plot(vals[:, 0], vals[:, col])
-        run_times.append((vals[-1, 0] - vals[0, 0]).total_seconds() / 3600.)
+        stats = load_vital_stats(host)
+        if not len(stats['date']):
+            continue
+        plt.plot(stats['date'].astype(object), stats[_column(col)])
+        run_times.append((stats['date'][-1] - stats['date'][0]) / np.timedelta64(1, 'h'))
 
     plt.figure()
     plt.plot(range(len(run_times)), sorted(run_times))
@@ -60,33 +164,80 @@ def parse_all_vital_stats(col=1, parse_df=False):
 
 
 @command
-def parse_vital_stats(host, col=1, parse_df=False, plot=True):
-    os.chdir('logs/remote/{0}/logs'.format(host))
-    lines = open('vital_stats.log', 'r').readlines()
+def parse_vital_stats(host, col='mem_usage', plot=True):
+    stats = load_vital_stats(host)
+    if plot:
+        plt.plot(stats['date'].astype(object), stats[_column(col)])
+        plt.show()
+    else:
+        return stats
+
+
+def read_vital_stats_ring(filename, tier=0):
+    """
+    Reads one tier of a vital_stats.bin file written by log_vital_stats.RingLog, without parsing
+    it: the tier's records are memory mapped.
+
+    Returns a numpy record array in time order, with a 'time' (s since epoch) column then either
+    a column for each field (tier 0) or <field>_min, <field>_mean and <field>_max columns for each
+    field (downsampled tiers).
+    """
+    with open(filename, 'rb') as f:
+        header = f.read(struct.calcsize(RING_HEADER_FMT))
+        magic, num_fields, interval, num_tiers, header_size = struct.unpack(RING_HEADER_FMT,
+                                                                            header)
+        if magic != RING_MAGIC:
+            raise ValueError('{0} is not a vital stats ring file'.format(filename))
+        field_size = struct.calcsize(RING_FIELD_FMT)
+        fields = [struct.unpack(RING_FIELD_FMT, f.read(field_size))[0].rstrip('\0')
+                  for i in range(num_fields)]
+        tier_size = struct.calcsize(RING_TIER_FMT)
+        tiers = [struct.unpack(RING_TIER_FMT, f.read(tier_size)) for i in range(num_tiers)]
 
-    if parse_df:
-        def read_line(line):
-            return read_vital_stat_line(line, True)
+    factor, capacity, count, offset = tiers[tier]
+    if tier == 0:
+        names = fields
     else:
-        read_line = read_vital_stat_line
+        names = ['{0}_{1}'.format(field, stat) for field in fields
+                 for stat in ('min', 'mean', 'max')]
+    dtype = np.dtype([('time', '<f8')] + [(name, '<f8') for name in names])
 
-    vals = np.array(map(read_line, filter(check_vital_stat_line, lines)))
-    os.chdir('../../../../')
-    if plot:
-        plt.plot(vals[:, 0], vals[:, col])
-        plt.show()
+    if count == 0:
+        return np.zeros(0, dtype=dtype).view(np.recarray)
+    records = np.memmap(filename, dtype=dtype, mode='r', offset=offset,
+                        shape=(min(count, capacity), ))
+    if count > capacity:
+        # Ring has wrapped: oldest record is the one that will be overwritten next.
+        start = count % capacity
+        records = np.concatenate((records[start:], records[:start]))
+    return records.view(np.recarray)
+
+
+@command
+def plot_vital_stats(host, field='rss', tier=0):
+    """
+    Plots field from host's vital_stats.bin (with min/max range for downsampled tiers).
+    """
+    stats = read_vital_stats_ring(host_log_filename(host, 'vital_stats.bin'), tier)
+    hours = (stats.time - stats.time[0]) / 3600.
+    if tier == 0:
+        plt.plot(hours, stats[field])
     else:
-        return vals
+        plt.plot(hours, stats[field + '_mean'])
+        plt.fill_between(hours, stats[field + '_min'], stats[field + '_max'], alpha=0.3)
+    plt.xlabel('time (h)')
+    plt.ylabel(field)
+    plt.show()
 
 
 @command
 def parse_all_analysis(plot='deltas'):
     for host in get_hosts():
-        dates, deltas = parse_analysis(host, plot=False)
+        analysis = load_analysis(host)
         if plot == 'deltas':
-            plt.plot([d.total_seconds() for d in deltas])
+            plt.plot(analysis['delta'])
         elif plot == 'dates':
-            plt.plot(dates)
+            plt.plot(analysis['date'].astype(object))
 
     if plot == 'deltas':
         plt.ylim(0, 20)
@@ -95,21 +246,199 @@ def parse_all_analysis(plot='deltas'):
 
 @command
 def parse_analysis(host, plot='deltas'):
-    os.chdir('logs/remote/{0}/logs'.format(host))
-    lines = open('analysis.log', 'r').readlines()
-    dates = [dt.datetime.strptime(line[:23] + '00', '%Y-%m-%d %H:%M:%S,%f') for line in lines]
-    deltas = []
-    for i in range(len(dates) - 1):
-        deltas.append(dates[i + 1] - dates[i])
-    os.chdir('../../../../')
+    analysis = load_analysis(host)
     if plot == 'deltas':
-        plt.plot([d.total_seconds() for d in deltas])
+        plt.plot(analysis['delta'])
         plt.ylim(0, 20)
         plt.show()
     elif plot == 'dates':
-        plt.plot(dates)
+        plt.plot(analysis['date'].astype(object))
         plt.show()
-    return dates, deltas
+    return analysis['date'], analysis['delta']
+
+
+def summarise_host(host):
+    """
+    Returns a dict of statistics for one host, from whichever of its logs exist.
+    Run in a process pool by fleet_report.
+    """
+    summary = {'host': host}
+
+    filename = host_log_filename(host, 'st_worker_status.log')
+    if os.path.exists(filename):
+        summary['year_runtimes'] = parse_status_log_runtimes(filename)
+
+    filename = host_log_filename(host, 'vital_stats.log')
+    if os.path.exists(filename):
+        stats = load_vital_stats(host)
+        if len(stats['date']):
+            summary['runtime_h'] = (stats['date'][-1] - stats['date'][0]) / np.timedelta64(1, 'h')
+            for name in ['mem_usage', 'rss', 'used']:
+                values = stats[name][~np.isnan(stats[name])]
+                if len(values):
+                    summary[name + '_peak'] = values.max()
+                    summary[name + '_p95'] = np.percentile(values, 95)
+            summary['df_peak'] = np.nanmax(stats['df'])
+
+    filename = host_log_filename(host, 'vital_stats.bin')
+    if os.path.exists(filename):
+        # Maxima over every sample, vital_stats.log only has every CSV_EVERY'th sample.
+        for tier in range(2):
+            stats = read_vital_stats_ring(filename, tier)
+            if not len(stats):
+                continue
+            for name in ['mem_usage', 'rss', 'used', 'df']:
+                column = name if tier == 0 else name + '_max'
+                summary[name + '_peak'] = max(summary.get(name + '_peak', 0),
+                                              stats[column].max())
+
+    filename = host_log_filename(host, 'analysis.log')
+    if os.path.exists(filename):
+        summary['step_durations'] = load_analysis(host)['delta'].astype(np.float32)
+
+    filename = host_log_filename(host, 'st_worker_stages.jsonl')
+    if os.path.exists(filename):
+        summary['stages'] = load_stages(host)
+
+    return summary
+
+
+def _percentiles(values, percentiles=(5, 50, 95, 99, 100)):
+    if not len(values):
+        return {}
+    return dict(('p{0}'.format(p), float(v))
+                for p, v in zip(percentiles, np.percentile(values, percentiles)))
+
+
+@command
+def fleet_report(output_dir=FLEET_REPORT_DIR, num_procs=4):
+    """
+    Summarises the logs of all hosts (parsed in parallel) into output_dir/summary.json, and
+    saves figures of runtimes, memory, disk usage and step durations. Needs no display.
+    """
+    plt.switch_backend('Agg')
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    pool = mp.Pool(num_procs)
+    try:
+        summaries = pool.map(summarise_host, get_hosts())
+    finally:
+        pool.close()
+        pool.join()
+
+    year_runtimes = {}
+    for summary in summaries:
+        for year, runtime in summary.get('year_runtimes', {}).items():
+            year_runtimes.setdefault(year, []).append(runtime / 3600.)
+    step_durations = np.concatenate([s['step_durations'] for s in summaries
+                                     if 'step_durations' in s] or [np.zeros(0)])
+    stages = [s['stages'] for s in summaries if 'stages' in s]
+
+    def column(key):
+        return np.array([s[key] for s in summaries if key in s])
+
+    report = {
+        'num_hosts': len(summaries),
+        'host_runtime_h': _percentiles(column('runtime_h')),
+        'year_runtime_h': dict((year, _percentiles(runtimes))
+                               for year, runtimes in sorted(year_runtimes.items())),
+        'mem_usage_peak_pc': _percentiles(column('mem_usage_peak')),
+        'mem_usage_p95_pc': _percentiles(column('mem_usage_p95')),
+        'rss_peak_mb': _percentiles(column('rss_peak')),
+        'rss_p95_mb': _percentiles(column('rss_p95')),
+        'used_peak_mb': _percentiles(column('used_peak')),
+        'df_peak_pc': _percentiles(column('df_peak')),
+        'step_duration_s': _percentiles(step_durations),
+        'stages': _summarise_stages(stages),
+        'hosts': [dict((k, float(v)) for k, v in s.items()
+                       if k not in ('host', 'year_runtimes', 'step_durations', 'stages'))
+                  for s in summaries],
+    }
+    for host_report, summary in zip(report['hosts'], summaries):
+        host_report['host'] = summary['host']
+        host_report['year_runtime_h'] = dict((year, runtime / 3600.) for year, runtime in
+                                             summary.get('year_runtimes', {}).items())
+
+    with open(os.path.join(output_dir, 'summary.json'), 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    _save_fleet_figures(output_dir, summaries, year_runtimes, step_durations)
+    print('Fleet report written to {0}'.format(output_dir))
+    return report
+
+
+def _summarise_stages(host_stages):
+    """
+    Per stage percentiles of duration, and of CPU use and data rates during the stage, which show
+    whether it is CPU, network or disk bound.
+    """
+    if not host_stages:
+        return {}
+    columns = dict((name, np.concatenate([stages[name] for stages in host_stages]))
+                   for name in host_stages[0])
+    summary = {}
+    for stage in np.unique(columns['stage']):
+        ok = (columns['stage'] == stage) & columns['ok']
+        duration = np.maximum(columns['duration'][ok], 1e-6)
+        summary[stage] = {
+            'count': int(ok.sum()),
+            'failed': int(((columns['stage'] == stage) & ~columns['ok']).sum()),
+            'duration_s': _percentiles(duration),
+            'cpu_fraction': _percentiles(columns['cpu'][ok] / duration),
+            'read_mb_per_s': _percentiles(columns['rchar'][ok] / duration / 2 ** 20),
+            'write_mb_per_s': _percentiles(columns['wchar'][ok] / duration / 2 ** 20),
+            'disk_read_mb_per_s': _percentiles(columns['read_bytes'][ok] / duration / 2 ** 20),
+            'disk_write_mb_per_s': _percentiles(columns['write_bytes'][ok] / duration / 2 ** 20),
+            'peak_rss_mb': _percentiles(columns['peak_rss_mb'][ok]),
+        }
+    return summary
+
+
+def _save_fleet_figures(output_dir, summaries, year_runtimes, step_durations):
+    hosts = [s for s in summaries if 'runtime_h' in s]
+    if hosts:
+        plt.figure()
+        plt.bar(range(len(hosts)), sorted(s['runtime_h'] for s in hosts))
+        plt.xlabel('host (sorted)')
+        plt.ylabel('runtime (h)')
+        plt.savefig(os.path.join(output_dir, 'host_runtimes.png'))
+        plt.close()
+
+    if year_runtimes:
+        years = sorted(year_runtimes)
+        plt.figure(figsize=(max(6, len(years) / 4.), 4))
+        plt.boxplot([year_runtimes[year] for year in years], labels=years)
+        plt.xticks(rotation=90)
+        plt.ylabel('runtime (h)')
+        plt.tight_layout()
+        plt.savefig(os.path.join(output_dir, 'year_runtimes.png'))
+        plt.close()
+
+    for key, ylabel, filename in [('rss', 'st_worker RSS (Mb)', 'memory.png'),
+                                  ('df', 'disk used (%)', 'disk.png')]:
+        hosts = [s for s in summaries if key + '_peak' in s]
+        if not hosts:
+            continue
+        plt.figure()
+        plt.plot(sorted(s[key + '_peak'] for s in hosts), label='peak')
+        if key + '_p95' in hosts[0]:
+            plt.plot(sorted(s.get(key + '_p95', np.nan) for s in hosts), label='p95')
+            plt.legend(loc='best')
+        plt.xlabel('host (sorted)')
+        plt.ylabel(ylabel)
+        plt.savefig(os.path.join(output_dir, filename))
+        plt.close()
+
+    if len(step_durations):
+        plt.figure()
+        plt.hist(step_durations[step_durations > 0],
+                 bins=np.logspace(-3, np.log10(max(step_durations.max(), 1)), 50))
+        plt.xscale('log')
+        plt.yscale('log')
+        plt.xlabel('analysis step duration (s)')
+        plt.savefig(os.path.join(output_dir, 'step_durations.png'))
+        plt.close()
 
 
 if __name__ == '__main__':
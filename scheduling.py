@@ -0,0 +1,116 @@
+"""
+Works out which years each st_worker instance should analyse.
+
+Per-year runtimes vary a lot (e.g. with storm activity and data volume), so years are not treated
+as equal work. Instead the runtime of each year is read from the st_worker_status.log files that
+have been retrieved from previous runs (see fabfile.retrieve_logs), and is stored in a small
+runtime history file. Years are then assigned to instances using longest-processing-time-first
+(LPT) bin packing.
+"""
+from __future__ import print_function
+
+import os
+import json
+import heapq
+import logging
+from glob import glob
+
+from st_utils import parse_status_line
+
+log = logging.getLogger('st_master.scheduling')
+
+REMOTE_LOGS_DIR = 'logs/remote'
+RUNTIME_HISTORY_FILE = 'logs/year_runtimes.json'
+
+
+def parse_status_log_runtimes(filename):
+    """
+    Returns a dict of year: runtime (s) for every year that was fully analysed in filename.
+    """
+    start_dates = {}
+    runtimes = {}
+    with open(filename, 'r') as f:
+        for line in f:
+            date, message = parse_status_line(line)
+            if date is None:
+                continue
+            if message.startswith('downloading year data '):
+                start_dates[int(message.split()[-1])] = date
+            elif message.startswith('finished year '):
+                year = int(message.split()[-1])
+                if year in start_dates:
+                    runtimes[year] = (date - start_dates.pop(year)).total_seconds()
+    return runtimes
+
+
+def load_runtime_history(history_file=RUNTIME_HISTORY_FILE):
+    """
+    Returns the raw history: {year: {host: runtime (s)}}.
+    """
+    if not os.path.exists(history_file):
+        return {}
+    with open(history_file, 'r') as f:
+        history = json.load(f)
+    # JSON keys are always strings.
+    return dict((int(year), host_runtimes) for year, host_runtimes in history.items())
+
+
+def update_runtime_history(remote_logs_dir=REMOTE_LOGS_DIR, history_file=RUNTIME_HISTORY_FILE):
+    """
+    Adds runtimes from all retrieved st_worker_status.log files to the history file.
+    Returns {year: runtime (s)}, using the median runtime where a year has been run more than once.
+    """
+    history = load_runtime_history(history_file)
+
+    pattern = os.path.join(remote_logs_dir, '*', 'logs', 'st_worker_status.log')
+    for filename in glob(pattern):
+        host = filename.split(os.sep)[-3]
+        for year, runtime in parse_status_log_runtimes(filename).items():
+            history.setdefault(year, {})[host] = runtime
+
+    if history:
+        if not os.path.exists(os.path.dirname(history_file)):
+            os.makedirs(os.path.dirname(history_file))
+        with open(history_file, 'w') as f:
+            json.dump(history, f, indent=2, sort_keys=True)
+
+    return dict((year, _median(host_runtimes.values()))
+                for year, host_runtimes in history.items())
+
+
+def lpt_partition(num_bins, years, year_runtimes):
+    """
+    Partitions years into num_bins using longest-processing-time-first bin packing.
+
+    Years missing from year_runtimes are assumed to take the median known runtime (or all take
+    equal time if there is no history at all).
+
+    Returns a list of years for each bin and a list of each bin's predicted runtime (s).
+    """
+    if year_runtimes:
+        default_runtime = _median(year_runtimes.values())
+    else:
+        default_runtime = 1.
+    runtimes = dict((year, year_runtimes.get(year, default_runtime)) for year in years)
+
+    bins = [[] for i in range(num_bins)]
+    # Heap of (load, bin index): always add next longest year to least loaded bin.
+    loads = [(0., i) for i in range(num_bins)]
+    for year in sorted(years, key=lambda y: (-runtimes[y], y)):
+        load, i = heapq.heappop(loads)
+        bins[i].append(year)
+        heapq.heappush(loads, (load + runtimes[year], i))
+
+    bin_runtimes = [0.] * num_bins
+    for load, i in loads:
+        bin_runtimes[i] = load
+
+    return [sorted(b) for b in bins], bin_runtimes
+
+
+def _median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.
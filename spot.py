@@ -0,0 +1,66 @@
+"""
+Handling of spot instance interruptions on st_workers.
+
+EC2 gives two minutes notice before it reclaims a spot instance, by making INSTANCE_ACTION_URL in
+the instance metadata return the action (rather than 404). An st_worker on a spot instance watches
+for this; on notice it abandons the years it is working on, releasing them back to the work queue
+so that other instances can claim them straight away, and logs heartbeat.INTERRUPTED_MESSAGE so
+that the master launches a replacement instance. Any local progress is lost with the instance.
+"""
+from __future__ import print_function
+
+import json
+import socket
+import urllib2
+import threading
+from time import sleep
+
+INSTANCE_ACTION_URL = 'http://169.254.169.254/latest/meta-data/spot/instance-action'
+# AWS recommends checking every 5s.
+INTERRUPTION_POLL_INTERVAL = 5
+
+
+def interruption_notice(url=INSTANCE_ACTION_URL, timeout=2):
+    """
+    Returns the instance action (e.g. {'action': 'terminate', 'time': '...'}) if notice of
+    interruption has been given, otherwise None.
+    """
+    try:
+        response = urllib2.urlopen(url, timeout=timeout)
+        body = response.read()
+    except urllib2.HTTPError:
+        # 404 until notice is given.
+        return None
+    except (urllib2.URLError, socket.error) as e:
+        print('Could not check for interruption notice: {0}'.format(e))
+        return None
+    try:
+        return json.loads(body)
+    except ValueError:
+        return {'action': body}
+
+
+def start_interruption_watcher(url=INSTANCE_ACTION_URL, interval=INTERRUPTION_POLL_INTERVAL):
+    """
+    Starts a daemon thread that checks url for notice of interruption every interval seconds.
+    Returns a threading.Event that is set once notice has been given, with the notice as its notice
+    attribute.
+    """
+    interrupted = threading.Event()
+    interrupted.notice = None
+
+    def watch():
+        # Does not log, so that logging handlers (e.g. HeartbeatHandler) are only used by the
+        # thread that acts on the notice.
+        while True:
+            notice = interruption_notice(url)
+            if notice is not None:
+                interrupted.notice = notice
+                interrupted.set()
+                return
+            sleep(interval)
+
+    thread = threading.Thread(name='interruption_watcher', target=watch)
+    thread.daemon = True
+    thread.start()
+    return interrupted
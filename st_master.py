@@ -8,10 +8,14 @@ Uses functions in fabfile to run remote commands on EC2 instances.
 """
 from __future__ import print_function
 
+import os
+import copy
+import json
 import logging
+import functools
 from time import sleep
+import datetime as dt
 from argparse import ArgumentParser
-import multiprocessing as mp
 
 import argcomplete
 from fabric.api import execute, env
@@ -21,8 +25,14 @@ import commandify as cmdify
 import fabfile
 import aws_helpers
 from aws_helpers import AwsInteractionError
-from st_utils import setup_logging
+from st_utils import setup_logging, parse_status_line
 import amis
+import work_queue
+import scheduling
+import orchestrator
+import fanout
+import spot
+import autoscaling
 
 
 if __name__ == '__main__':
@@ -35,8 +45,16 @@ def main_command(args):
 
 
 @cmdify.command
-def get_all_files(conn, args):
-    aws_helpers.get_all_files()
+def get_all_files(conn, args, num_threads=8):
+    aws_helpers.get_all_files(num_threads=num_threads)
+
+
+@cmdify.command
+def sync_files(conn, args, prune=False, num_threads=8):
+    """
+    Downloads new or changed files from S3, optionally pruning files removed from S3.
+    """
+    aws_helpers.sync_bucket(prune=prune, num_threads=num_threads)
 
 
 @cmdify.command
@@ -72,6 +90,24 @@ def run_fabric_commands(conn, args):
     execute_fabric_commands(args, host)
 
 
+@cmdify.command
+def push_worker_files(conn, args, num_threads=16, max_bandwidth_mb=0., relay=False):
+    """
+    Pushes the files that each worker needs for run_analysis to all running instances at once,
+    so that they do not need to be sent to each instance as it is set up.
+    Total bandwidth used is capped at max_bandwidth_mb MB/s (if given).
+    """
+    key = "tag:{0}".format(args.tag)
+    hosts = [i.ip_address for i in
+             aws_helpers.get_instances(conn, filters={key: args.tag_value}, running=True)]
+    for local_path, remote_path in fabfile.WORKER_FILES:
+        log.info('Pushing {0} to {1} host(s)'.format(local_path, len(hosts)))
+        failed = fanout.fan_out(local_path, hosts, remote_path, num_threads=num_threads,
+                                max_bandwidth=max_bandwidth_mb * 2 ** 20, relay=relay)
+        for host, error in sorted(failed.items()):
+            log.error('Could not push {0} to {1}: {2}'.format(local_path, host, error))
+
+
 @cmdify.command
 def setup_st_worker_image(conn, args):
     """
@@ -99,8 +135,10 @@ def setup_st_worker_image(conn, args):
         instance = instances[0]
         host = instance.ip_address
 
-        log.info('Sleeping for 1m to allow instance to get ready')
-        sleep(60)
+        log.info('Waiting for instance to get ready')
+        for host, ready in fabfile.iter_ready_hosts([host]):
+            if not ready:
+                raise AwsInteractionError('Instance {0} did not become ready'.format(instance.id))
 
         log.info('Perform full setup')
         execute(fabfile.full_setup, host=host)
@@ -115,39 +153,105 @@ def setup_st_worker_image(conn, args):
     log.info("Success! Run 'python aws_interaction.py run_analysis'")
 
 
-@cmdify.command
-def match_instances_to_years(instances, years):
-    min_years_per_instance = len(years) // len(instances)
-    extra_years = len(years) - len(instances) * min_years_per_instance
-    instance_to_years_map = {}
-    year_index = 0
-    for instance in instances:
-        years_per_instance = min_years_per_instance
-        if extra_years:
-            extra_years -= 1
-            years_per_instance += 1
+def plan_years(num_instances, years, year_runtimes=None):
+    """
+    Partitions years between num_instances using LPT bin packing on historical per-year runtimes
+    and logs the predicted runtime of each instance.
+    Returns a list of years for each instance.
+    """
+    if year_runtimes is None:
+        year_runtimes = scheduling.update_runtime_history()
+    year_lists, runtimes = scheduling.lpt_partition(num_instances, years, year_runtimes)
+
+    if not year_runtimes:
+        log.info('No runtime history found, treating all years as equal work')
+        return year_lists
 
-        instance_to_years_map[instance] = []
-        for i in range(year_index, year_index + years_per_instance):
-            instance_to_years_map[instance].append(years[i])
+    for i, (instance_years, runtime) in enumerate(zip(year_lists, runtimes)):
+        log.info('Instance {0}: predicted {1:.1f}h for years {2}'.format(
+            i, runtime / 3600., ', '.join(str(y) for y in instance_years)))
+    log.info('Predicted makespan: {0:.1f}h'.format(max(runtimes) / 3600.))
+    return year_lists
 
-        year_index += years_per_instance
 
-    return instance_to_years_map
+def match_instances_to_years(instances, years, year_runtimes=None):
+    """
+    Assigns years to instances so that they should all finish at around the same time.
+    """
+    year_lists = plan_years(len(instances), years, year_runtimes)
+    return dict(zip(instances, year_lists))
 
 
-@cmdify.command(start_year={'flag': '-s'}, 
+@cmdify.command(start_year={'flag': '-s'},
                 end_year={'flag': '-e'},
-                create_new_instances={'flag': '-d'})
+                create_new_instances={'flag': '-d'},
+                use_queue={'flag': '-q'},
+                pipeline={'flag': '-p'},
+                push_events={'flag': '-b'})
 def run_analysis(conn, args, create_new_instances=True, start_year=2005, end_year=2005,
-                 terminate=True, monitor=True):
+                 terminate=True, monitor=True, use_queue=False, queue_uri='',
+                 pipeline=False, disk_budget_gb=12., stream_upload=False, ready_timeout=600,
+                 push_events=False, events_uri='', max_concurrency=8,
+                 publish_min_instances=4, target_hours=0., max_hourly_spend=0.,
+                 instance_hourly_cost=0.06, max_instances=20, max_concurrent_years=1):
     """
     Runs a full analysis.
-    Creates EC2 instances as necessary, allows them time to start up. Then executes
-    remote commands on them, getting them to download then analyse the given years,
-    monitoring their progress. Once they have finished, terminate all running instances.
+    Creates EC2 instances as necessary, waits for each to accept SSH logins (for at most
+    ready_timeout seconds). As soon as each is ready, executes remote commands on it, getting it
+    to download then analyse the given years, monitoring its progress. As each instance finishes,
+    retrieves its logs and terminates it. All instances are driven from this process, running at
+    most max_concurrency remote commands at once (see orchestrator).
+
+    If use_queue is set, all years are put in an SQS work queue (or the queue given by
+    queue_uri) and each instance pulls years from it when free, rather than being given a fixed
+    set of years up front.
+
+    If pipeline is set, each worker downloads its next year and uploads its previous year while
+    analysing the current one, holding at most disk_budget_gb of downloaded data and output.
+
+    If stream_upload is set, each year's output is compressed straight into S3.
+
+    If max_concurrent_years is more than one (or 0: one per CPU), each worker runs up to that many
+    years at once, starting another only when it has enough free memory and disk for it. Cannot
+    be used with pipeline.
+
+    If there are at least publish_min_instances instances, dotstormtracks.bz2 is published to S3
+    once for workers to fetch, rather than being sent to each of them from here.
+
+    If push_events is set, workers push their status and heartbeats to an SQS events queue (or
+    the queue given by events_uri), and are monitored from these rather than over SSH.
+
+    If --spot-price is given, spot instances are used and years are always put in a work queue:
+    when a spot instance is about to be reclaimed, its worker puts the years it was working on back
+    on the queue, and a replacement instance is launched (see spot).
+
+    If target_hours and/or max_hourly_spend are given, the number of instances is not fixed:
+    instances are added and removed during the run so that all years are finished within
+    target_hours, spending at most max_hourly_spend ($/hour) on instances that cost
+    instance_hourly_cost (or the spot price) each, and running at most max_instances
+    (see autoscaling). Years are always put in a work queue.
     """
     log.info('Running analysis: {0}-{1}'.format(args.start_year, args.end_year))
+    years = range(args.start_year, args.end_year + 1)
+    autoscale = bool(target_hours or max_hourly_spend)
+    use_queue = use_queue or bool(queue_uri) or bool(args.spot_price) or autoscale
+    push_events = push_events or bool(events_uri)
+    if pipeline and max_concurrent_years != 1:
+        raise AwsInteractionError('Cannot use pipeline with max_concurrent_years')
+
+    if autoscale:
+        if not args.allow_multiple_instances:
+            raise AwsInteractionError('Autoscaling needs --allow-multiple-instances')
+        controller = autoscaling.AutoscalingController(
+            target_hours or None, max_hourly_spend or None,
+            args.spot_price or instance_hourly_cost, max_instances,
+            autoscaling.mean_year_hours(years, scheduling.update_runtime_history()))
+        if create_new_instances:
+            args.num_instances = controller.desired_instances(len(years))
+            log.info('Autoscaling: starting with {0} instance(s)'.format(args.num_instances))
+    else:
+        controller = None
+
     if not args.allow_multiple_instances and args.num_instances != 1:
         raise AwsInteractionError('Should only be one instance for run_analysis')
 
@@ -160,57 +264,80 @@ def run_analysis(conn, args, create_new_instances=True, start_year=2005, end_yea
 
         args.image_id = image.id
 
+        if not use_queue:
+            # Plan before launching so that the predicted runtimes can be checked.
+            year_lists = plan_years(args.num_instances, years)
+
         instances = aws_helpers.create_instances(conn, args)
 
         if len(instances) != args.num_instances:
             raise AwsInteractionError('Should have created exactly {0} instance(s) for run_analysis\n'
                                       'Created {1}'.format(args.num_instances, len(instances)))
-        log.info('Sleeping for 60s to allow instance(s) to get ready')
-        sleep(60)
     else:
         log.info('Using existing instances')
         key = "tag:{0}".format(args.tag)
         instances = aws_helpers.get_instances(conn, filters={key: args.tag_value}, running=True)
         log.info('Using instance(s): {0}'.format(', '.join([i.id for i in instances])))
-
-    years = range(args.start_year, args.end_year + 1)
-    instance_to_years_map = match_instances_to_years(instances, years)
-    log.debug(instance_to_years_map)
-
-    instance_procs = []
-    for instance in instances:
-        host = instance.ip_address
-        log.info('Running on host:{0}, instance_id: {1}'.format(host, instance.id))
-
-        proc = mp.Process(name=host, target=execute_fabric_commands,
-                          kwargs={
-                              'args': args,
-                              'host': host,
-                              'years': instance_to_years_map[instance],
-                              'monitor': monitor})
-        instance_procs.append((instance, proc))
-
-        log.info('Executing fabric commands')
-        proc.start()
-
-    while instance_procs:
-        finished_instance_procs = []
-        for instance, proc in instance_procs:
-            proc.join(timeout=0.01)
-            if not proc.is_alive():
-                log.info("proc {0} finished".format(proc))
-                finished_instance_procs.append((instance, proc))
-        for instance_proc in finished_instance_procs:
-            instance_procs.remove(instance_proc)
-            instance, proc = instance_proc
-            if monitor and terminate:
-                # Don't need to monitor to make sure it's finished.
-                log.info('Terminating instance {0}'.format(instance.id))
-                instance.terminate()
-                fabfile.beep()
-
-        if instance_procs:
-            sleep(10)
+        if not use_queue:
+            year_lists = plan_years(len(instances), years)
+
+    if use_queue:
+        if not queue_uri:
+            queue_name = dt.datetime.strftime(dt.datetime.now(), 'st_years_%Y-%m-%d-%H-%M-%S')
+            queue_uri = 'sqs://{0}/{1}'.format(args.region, queue_name)
+        log.info('Putting years in work queue {0}'.format(queue_uri))
+        queue = work_queue.open_queue(queue_uri)
+        queue.put_units(years)
+        instance_to_years_map = dict((instance, []) for instance in instances)
+    else:
+        queue = None
+        instance_to_years_map = dict(zip(instances, year_lists))
+        log.debug(instance_to_years_map)
+
+    if push_events and not events_uri:
+        queue_name = dt.datetime.strftime(dt.datetime.now(), 'st_events_%Y-%m-%d-%H-%M-%S')
+        events_uri = 'sqs://{0}/{1}'.format(args.region, queue_name)
+    if events_uri:
+        log.info('Workers will push events to {0}'.format(events_uri))
+
+    worker_settings = {'queue_uri': queue_uri or None,
+                       'pipeline': pipeline,
+                       'disk_budget_gb': disk_budget_gb,
+                       'stream_upload': stream_upload,
+                       'events_uri': events_uri or None,
+                       'run_id': dt.datetime.strftime(dt.datetime.now(), '%Y-%m-%d-%H-%M-%S'),
+                       'max_concurrent_years': max_concurrent_years}
+    if args.spot_price:
+        worker_settings['spot_interruption_url'] = spot.INSTANCE_ACTION_URL
+    if args.spot_price or autoscale:
+        launch_instances = functools.partial(launch_more_instances, conn, args)
+    else:
+        launch_instances = None
+    if len(instances) >= publish_min_instances:
+        worker_settings['dotstormtracks_url'] = aws_helpers.publish_artefact(
+            fabfile.DOTSTORMTRACKS, fabfile.file_sha1(fabfile.DOTSTORMTRACKS))
+
+    host_instances = dict((instance.ip_address, instance) for instance in instances)
+    host_years = dict((instance.ip_address, instance_to_years_map[instance])
+                      for instance in instances)
+    fleet = orchestrator.FleetOrchestrator(args, host_instances, host_years, worker_settings,
+                                           events_uri=events_uri or None,
+                                           monitor=monitor,
+                                           terminate=monitor and terminate,
+                                           terminate_unready=create_new_instances and terminate,
+                                           ready_timeout=ready_timeout,
+                                           max_concurrency=max_concurrency,
+                                           launch_instances=launch_instances,
+                                           controller=controller,
+                                           queue_uri=queue_uri)
+    fleet.run()
+
+    if queue is not None and monitor:
+        remaining = queue.remaining()
+        if remaining:
+            log.error('{0} year(s) left in work queue {1}'.format(remaining, queue_uri))
+        else:
+            queue.delete()
 
     log.info('Done')
 
@@ -218,33 +345,96 @@ def run_analysis(conn, args, create_new_instances=True, start_year=2005, end_yea
         fabfile.notify()
 
 
-def execute_fabric_commands(args, host, years, monitor):
+def launch_more_instances(conn, args, num_instances):
     """
-    Executes remote functions to run analysis on a given year for a given host.
-    Monitors their output to see when they are finished (blocking).
+    Launches num_instances more instances in the same way as run_analysis.
     """
-    process_log = setup_logging(name='st_master'.format(host),
-                                filename='logs/st_master_{0}.log'.format(host),
-                                use_console=False)
+    replacement_args = copy.copy(args)
+    replacement_args.num_instances = num_instances
+    # Other instances (e.g. ones being replaced) are running.
+    replacement_args.allow_multiple_instances = True
+    return aws_helpers.create_instances(conn, replacement_args)
+
 
-    process_log.info('Updating stormtracks')
-    execute(fabfile.update_stormtracks, host=host)
-    execute(fabfile.update_stormtracks_aws, host=host)
+@cmdify.command
+def benchmark(conn, args, instance_types='t2.medium', num_procs='1', years='2005',
+              terminate=True):
+    """
+    Compares instance types (comma separated) for running the analysis.
+    Launches one instance of each type from the image and runs st_benchmark.py on each with
+    the given years (comma separated), once for each number of years processed at once in
+    num_procs (comma separated). Downloads and uploads are replaced by local stand-ins, so the
+    results depend only on the instance type.
+
+    Writes the reports to logs/benchmarks/summary.json, best years per dollar first, using the
+    spot price if given or otherwise the approximate on-demand price of each type.
+    """
+    images = conn.get_all_images(filters={'tag:name': args.image_nametag})
+    if len(images) != 1:
+        raise AwsInteractionError('Should be exactly one image')
+    args.image_id = images[0].id
 
-    process_log.info('Updating supervisor')
-    execute(fabfile.install_supervisor, update=True, host=host)
+    host_types = {}
+    instances = []
+    try:
+        for instance_type in instance_types.split(','):
+            type_args = copy.copy(args)
+            type_args.instance_type = instance_type
+            type_args.num_instances = 1
+            type_args.allow_multiple_instances = True
+            for instance in aws_helpers.create_instances(conn, type_args):
+                instances.append(instance)
+                host_types[instance.ip_address] = instance_type
+
+        hosts = []
+        for host, ready in fabfile.iter_ready_hosts(host_types.keys()):
+            if ready:
+                hosts.append(host)
+            else:
+                log.error('{0} ({1}) did not become ready'.format(host, host_types[host]))
+        if not hosts:
+            raise AwsInteractionError('No instances became ready')
+
+        execute(fabfile.update_stormtracks, hosts=hosts)
+        execute(fabfile.update_stormtracks_aws, hosts=hosts)
+        results = []
+        for procs in num_procs.split(','):
+            log.info('Benchmarking {0} year(s) at a time'.format(procs))
+            report_filenames = execute(fabfile.st_benchmark, years=years, num_procs=int(procs),
+                                       hosts=hosts)
+            for host, report_filename in report_filenames.items():
+                with open(report_filename, 'r') as f:
+                    report = json.load(f)
+                report['instance_type'] = host_types[host]
+                report['hourly_cost'] = (args.spot_price or
+                                         aws_helpers.INSTANCE_HOURLY_COSTS.get(host_types[host]))
+                if report['hourly_cost']:
+                    report['years_per_dollar'] = report['years_per_hour'] / report['hourly_cost']
+                results.append(report)
+    finally:
+        if terminate:
+            for instance in instances:
+                instance.terminate()
 
-    process_log.info('Starting anaysis')
-    execute(fabfile.st_worker_run, years=years, host=host)
+    results.sort(key=lambda report: -(report['years_per_dollar'] or 0))
+    if not os.path.exists('logs/benchmarks'):
+        os.makedirs('logs/benchmarks')
+    with open('logs/benchmarks/summary.json', 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    for report in results:
+        log.info('{0:<12} {1} proc(s): {2:.2f} years/hour, {3} years/$, peak RSS {4:.0f}Mb'.format(
+            report['instance_type'], report['num_procs'], report['years_per_hour'],
+            '{0:.2f}'.format(report['years_per_dollar']) if report['years_per_dollar'] else '?',
+            max(stage['peak_rss_mb'] for stage in report['stages'].values())))
 
-    while not execute(fabfile.log_exists, host=host)[host]:
-        process_log.info('Sleeping for 10s to allow creation of logfile')
-        sleep(10)
-    process_log.info('Logfile created')
 
-    # Must be done after st_worker has started running.
-    process_log.info('Logging mem usage')
-    execute(fabfile.log_vital_stats, host=host)
+def execute_fabric_commands(args, host, years, monitor, worker_settings=None):
+    """
+    Executes remote functions to run analysis on a given year for a given host.
+    Monitors their output to see when they are finished (blocking).
+    """
+    orchestrator.setup_worker(host, args, years, worker_settings)
+    process_log = orchestrator.host_log(host)
 
     if monitor:
         # Blocks until finished.
@@ -278,7 +468,7 @@ def st_worker_status_monitor(process_log, args, host):
     status = execute(fabfile.st_worker_status, host=host)[host]
     process_log.info(status)
     minutes = 0
-    while status[:14] != 'analysed years':
+    while not parse_status_line(status)[1].startswith('analysed years'):
         try:
             supervisor_status_str = execute(fabfile.supervisorctl, 
                                             cmd='status', program='st_worker_run', host=host)[host]
@@ -343,6 +533,7 @@ def main():
     parser.add_argument('-a', '--allow-multiple-instances', default=False, action='store_true')
     parser.add_argument('-d', '--dry-run', default=False, action='store_true')
     parser.add_argument('--instance-type', default='t2.medium')
+    parser.add_argument('--spot-price', type=float, default=0.)
 
     parser.setup_arguments()
     argcomplete.autocomplete(parser)
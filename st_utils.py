@@ -1,14 +1,22 @@
 """
 Utilities for all stormtracks_aws files.
 """
+import os
+import hashlib
 import logging
+import datetime as dt
+
+STATUS_DATE_FMT = '%Y-%m-%d %H:%M:%S'
+
+_sha1s = {}
 
 
 def setup_logging(name, filename, mode='a', use_console=True):
     log = logging.getLogger(name)
 
     if name == 'st_worker_status':
-        formatter = logging.Formatter('%(message)s')
+        # Timestamps allow per-year runtimes to be worked out from retrieved logs.
+        formatter = logging.Formatter('%(asctime)s %(message)s', STATUS_DATE_FMT)
     else:
         formatter = logging.Formatter('%(asctime)s.%(msecs)06d %(name)-16s %(levelname)-8s %(message)s',
                                       "%Y-%m-%d %H:%M:%S")
@@ -26,3 +34,30 @@ def setup_logging(name, filename, mode='a', use_console=True):
         log.addHandler(streamHandler)
 
     return log
+
+
+def parse_status_line(line):
+    """
+    Splits a line from st_worker_status.log into its date and message.
+    Date is None for lines written before status lines were timestamped.
+    """
+    try:
+        date = dt.datetime.strptime(line[:19], STATUS_DATE_FMT)
+        return date, line[20:].strip()
+    except ValueError:
+        return None, line.strip()
+
+
+def file_sha1(filename):
+    """
+    Returns SHA-1 hex digest of filename, cached until it is modified.
+    """
+    stat = os.stat(filename)
+    cache_key = (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+    if cache_key not in _sha1s:
+        sha1 = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(2 ** 20), ''):
+                sha1.update(chunk)
+        _sha1s[cache_key] = sha1.hexdigest()
+    return _sha1s[cache_key]
@@ -1,62 +1,296 @@
 #!/usr/bin/env python
-from subprocess import call, check_output
-from time import sleep
+"""
+Samples the memory, CPU, I/O and disk usage of the st_worker (including all of its child
+processes) and of the whole system, appending one line per sample to vital_stats.log.
+
+Everything is read straight from /proc and statvfs rather than by running other programs, so
+sampling once a second costs very little. Run by supervisor with the system python, so must only
+use the standard library.
+
+The first five columns are the same as they always have been, new columns are added at the end:
+
+* st_worker_mem_usage(%) - RSS of st_worker process tree as % of total memory.
+* used(Mb), free(Mb) - system memory used/free, not counting buffers and cache (as in free -m).
+* df(%) - disk usage of root filesystem.
+* rss(Mb) - RSS of st_worker process tree.
+* cpu(s) - CPU time used by the st_worker process tree so far (including finished children).
+* read(Mb), write(Mb) - bytes read from/written to disk by live processes in the tree.
+* num_procs - number of processes in the tree.
+
+Every sample is also written to vital_stats.bin, a fixed size binary file (see RingLog) holding
+the most recent samples at full resolution plus min/mean/max of longer periods, so that long runs
+sampled every second stay small and can be loaded quickly (see parse_logs.read_vital_stats_ring).
+vital_stats.log is only written to every CSV_EVERY samples.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import struct
 import datetime as dt
+from time import time, sleep
+
+PROG = 'st_worker.py'
+LOG_FILENAME = '/home/ubuntu/stormtracks_data/logs/vital_stats.log'
+RING_FILENAME = '/home/ubuntu/stormtracks_data/logs/vital_stats.bin'
+CSV_EVERY = 10
+HEADER = ('date,st_worker_mem_usage(%),used(Mb),free(Mb),df(%),'
+          'rss(Mb),cpu(s),read(Mb),write(Mb),num_procs\n')
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+CLOCK_TICKS = float(os.sysconf('SC_CLK_TCK'))
+MB = 2 ** 20
+
+FIELDS = ['mem_usage', 'used', 'free', 'df', 'rss', 'cpu', 'read', 'write', 'num_procs']
+# (samples per record, max records kept): 6 hours of samples, a week of minutes, a year of hours
+# (at one sample per second).
+TIERS = [(1, 6 * 60 * 60), (60, 7 * 24 * 60), (60 * 60, 365 * 24)]
+
+RING_MAGIC = b'VSTATRB1'
+# magic, number of fields, sample interval (s), number of tiers, total header size
+RING_HEADER_FMT = '<8sIdII'
+RING_FIELD_FMT = '16s'
+# samples per record, capacity (records), records written, offset of records in file
+RING_TIER_FMT = '<IIQQ'
+
+
+class RingLog(object):
+    """
+    Fixed size binary log of samples, laid out so that each tier can be read as a numpy array.
+
+    The file starts with a header (RING_HEADER_FMT), followed by the name of each field and a
+    descriptor of each tier (RING_TIER_FMT). Each tier is a ring buffer of records of doubles:
+    tier 0 records are (time, field values...), other tiers' records are
+    (time of first sample, min, mean, max of each field in turn...) over samples-per-record
+    samples. Records are written before the count in their tier's descriptor is updated.
+    """
+    def __init__(self, filename, fields=FIELDS, interval=1., tiers=TIERS):
+        self.num_fields = len(fields)
+        header_size = (struct.calcsize(RING_HEADER_FMT) +
+                       struct.calcsize(RING_FIELD_FMT) * len(fields) +
+                       struct.calcsize(RING_TIER_FMT) * len(tiers))
+        header_size += -header_size % 8
+
+        self.tiers = []
+        offset = header_size
+        descriptor_offset = (struct.calcsize(RING_HEADER_FMT) +
+                             struct.calcsize(RING_FIELD_FMT) * len(fields))
+        for i, (factor, capacity) in enumerate(tiers):
+            if i == 0:
+                record_fmt = '<{0}d'.format(1 + len(fields))
+            else:
+                record_fmt = '<{0}d'.format(1 + 3 * len(fields))
+            tier = {'factor': factor, 'capacity': capacity, 'count': 0, 'offset': offset,
+                    'record_fmt': record_fmt,
+                    'record_size': struct.calcsize(record_fmt),
+                    # Count is after factor and capacity.
+                    'count_offset': descriptor_offset + struct.calcsize(RING_TIER_FMT) * i + 8,
+                    'window': [], 'window_start': None}
+            self.tiers.append(tier)
+            offset += tier['record_size'] * capacity
+
+        self.f = open(filename, 'w+b')
+        self.f.write(struct.pack(RING_HEADER_FMT, RING_MAGIC, len(fields), interval, len(tiers),
+                                 header_size))
+        for field in fields:
+            self.f.write(struct.pack(RING_FIELD_FMT, field.encode('ascii')))
+        for tier in self.tiers:
+            self.f.write(struct.pack(RING_TIER_FMT, tier['factor'], tier['capacity'], 0,
+                                     tier['offset']))
+        # Sparse until written to.
+        self.f.truncate(offset)
+        self.f.flush()
+
+    def append(self, sample_time, values):
+        self._write(self.tiers[0], (sample_time, ) + tuple(values))
+        for tier in self.tiers[1:]:
+            if not tier['window']:
+                tier['window_start'] = sample_time
+            tier['window'].append(values)
+            if len(tier['window']) == tier['factor']:
+                record = [tier['window_start']]
+                for field_values in zip(*tier['window']):
+                    record.extend([min(field_values),
+                                   sum(field_values) / float(len(field_values)),
+                                   max(field_values)])
+                self._write(tier, record)
+                tier['window'] = []
+        self.f.flush()
+
+    def _write(self, tier, record):
+        self.f.seek(tier['offset'] + (tier['count'] % tier['capacity']) * tier['record_size'])
+        self.f.write(struct.pack(tier['record_fmt'], *record))
+        tier['count'] += 1
+        self.f.seek(tier['count_offset'])
+        self.f.write(struct.pack('<Q', tier['count']))
+
+
+def read_file(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def read_stat(pid):
+    """
+    Returns (ppid, utime + stime, cutime + cstime) of pid, times in s.
+    """
+    stat = read_file('/proc/{0}/stat'.format(pid))
+    # Process name is in brackets and can contain spaces.
+    fields = stat[stat.rindex(')') + 2:].split()
+    ppid = int(fields[1])
+    cpu = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    children_cpu = (int(fields[13]) + int(fields[14])) / CLOCK_TICKS
+    return ppid, cpu, children_cpu
+
+
+def read_rss(pid):
+    return int(read_file('/proc/{0}/statm'.format(pid)).split()[1]) * PAGE_SIZE
 
 
-def get_df():
-    cmd = "df -h"
-    df_out = check_output(cmd, shell=True)
-    df_lines = df_out.split('\n')
-    df_percent = float(df_lines[1].split()[4][:-1])
-    return df_percent
+def read_io(pid):
+    """
+    Returns (read_bytes, write_bytes) of pid.
+    """
+    io = {}
+    for line in read_file('/proc/{0}/io'.format(pid)).splitlines():
+        key, value = line.split(':')
+        io[key] = int(value)
+    return io['read_bytes'], io['write_bytes']
 
 
-def get_percent_mem_used(prog='st_worker'):
-    cmd1 = 'pgrep {0}'.format(prog)
-    pidnos = check_output(cmd1, shell=True).split()
-    if len(pidnos) == 0:
-        raise Exception('no pidno for {0} found'.format(prog))
-    elif len(pidnos) == 1:
-        pidno = pidnos
+def read_meminfo():
+    """
+    Returns dict of /proc/meminfo values, in bytes.
+    """
+    meminfo = {}
+    for line in read_file('/proc/meminfo').splitlines():
+        parts = line.split()
+        meminfo[parts[0].rstrip(':')] = int(parts[1]) * 1024
+    return meminfo
+
+
+def get_df(path='/'):
+    """
+    Returns % of disk used, calculated the same way as df.
+    """
+    st = os.statvfs(path)
+    used = st.f_blocks - st.f_bfree
+    return 100. * used / (used + st.f_bavail)
+
+
+def all_pids():
+    return [int(name) for name in os.listdir('/proc') if name.isdigit()]
+
+
+def is_prog(pid, prog=PROG):
+    try:
+        return prog in read_file('/proc/{0}/cmdline'.format(pid))
+    except IOError:
+        return False
+
+
+def find_root_pid(prog=PROG):
+    """
+    Returns pid of the process running prog whose parent is not also running prog, or None.
+    """
+    for pid in all_pids():
+        try:
+            if is_prog(pid, prog) and not is_prog(read_stat(pid)[0], prog):
+                return pid
+        except IOError:
+            # Process has exited.
+            pass
+    return None
+
+
+def process_tree(root_pid):
+    """
+    Returns {pid: (ppid, cpu, children_cpu)} for root_pid and all of its descendants.
+    """
+    stats = {}
+    for pid in all_pids():
+        try:
+            stats[pid] = read_stat(pid)
+        except IOError:
+            pass
+
+    tree = {}
+    if root_pid not in stats:
+        return tree
+    tree[root_pid] = stats[root_pid]
+    # Descendants have higher pids unless pids have wrapped, so loop until nothing is added.
+    added = True
+    while added:
+        added = False
+        for pid, stat in stats.items():
+            if pid not in tree and stat[0] in tree:
+                tree[pid] = stat
+                added = True
+    return tree
+
+
+def sample_tree(root_pid):
+    """
+    Returns (rss, cpu, read_bytes, write_bytes, num_procs) summed over root_pid's process tree.
+    """
+    tree = process_tree(root_pid)
+    rss, cpu, read_bytes, write_bytes = 0, 0., 0, 0
+    for pid, (ppid, proc_cpu, children_cpu) in tree.items():
+        # Includes children that have finished (and been waited for), which are no longer in the
+        # tree.
+        cpu += proc_cpu + children_cpu
+        try:
+            rss += read_rss(pid)
+            proc_read_bytes, proc_write_bytes = read_io(pid)
+            read_bytes += proc_read_bytes
+            write_bytes += proc_write_bytes
+        except (IOError, KeyError):
+            pass
+    return rss, cpu, read_bytes, write_bytes, len(tree)
+
+
+def sample(root_pid):
+    meminfo = read_meminfo()
+    free = meminfo['MemFree'] + meminfo.get('Buffers', 0) + meminfo.get('Cached', 0)
+    used = meminfo['MemTotal'] - free
+
+    if root_pid is None:
+        rss, cpu, read_bytes, write_bytes, num_procs = 0, 0., 0, 0, 0
     else:
-        # Find which is child:
-        for pidno in pidnos:
-            cmd1 = 'pgrep {0} -P {1}'.format(prog, pidno)
-            try:
-                pidno = check_output(cmd1, shell=True).split()
-                if pidno.split():
-                    break
-            except:
-                pass
-
-    cmd2 = "top -bn1 -p {0}".format(pidno.strip())
-    top_out = check_output(cmd2, shell=True)
-    top_lines = top_out.split('\n')
-    mem_usage_percent = float(top_lines[7].split()[9])
-    return mem_usage_percent
-
-
-def get_sys_used_free_mem():
-    cmd = "free -m"
-    free_out = check_output(cmd, shell=True)
-    free_lines = free_out.split('\n')
-    used, free = map(int, free_lines[2].split()[2:4])
-    return used, free
-
-
-def main(filename='/home/ubuntu/stormtracks_data/logs/vital_stats.log'):
+        rss, cpu, read_bytes, write_bytes, num_procs = sample_tree(root_pid)
+
+    return (100. * rss / meminfo['MemTotal'], used // MB, free // MB, get_df(),
+            rss / float(MB), cpu, read_bytes / float(MB), write_bytes / float(MB), num_procs)
+
+
+def main(filename=LOG_FILENAME, ring_filename=RING_FILENAME, interval=1., csv_every=CSV_EVERY):
+    root_pid = None
+    ring = RingLog(ring_filename, interval=interval)
     with open(filename, 'a') as f:
-        f.write('date,st_worker_mem_usage(%),used(Mb),free(Mb),df(%)\n')
+        f.write(HEADER)
+        next_time = time()
+        num_samples = 0
         while True:
-            date = dt.datetime.strftime(dt.datetime.now(), "%Y-%m-%d %H:%M:%S.%f")
-            mem_usage_percent = get_percent_mem_used()
-            used, free = get_sys_used_free_mem()
-            df = get_df()
-            f.write('{0},{1},{2},{3},{4}\n'.format(date, mem_usage_percent, used, free, df))
-            f.flush()
-            sleep(10)
+            if root_pid is None or not is_prog(root_pid):
+                root_pid = find_root_pid()
+
+            now = dt.datetime.now()
+            values = sample(root_pid)
+            ring.append(time(), values)
+            if num_samples % csv_every == 0:
+                date = dt.datetime.strftime(now, "%Y-%m-%d %H:%M:%S.%f")
+                f.write('{0},{1:.2f},{2},{3},{4:.1f},{5:.1f},{6:.2f},{7:.1f},{8:.1f},{9}\n'.format(
+                    date, *values))
+                f.flush()
+            num_samples += 1
+
+            # Keep to a fixed schedule, however long sampling takes.
+            next_time += interval
+            sleep(max(0, next_time - time()))
 
 
 if __name__ == '__main__':
-    main()
+    if len(sys.argv) > 1:
+        main(interval=float(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,216 @@
+#!/home/ubuntu/Projects/stormtracks/st_env/bin/python
+"""
+Benchmarks the st_worker stages on this instance, to help choose an instance type and how many
+years to process at once.
+
+Runs the stage functions from st_worker.py on each of the given years, num_procs years at a time,
+each stage in its own process so that its peak RSS can be measured. Network stages are replaced by
+local stand-ins, so that results depend on the instance rather than on the network:
+
+* download - C20 data for each year is downloaded once into CACHE_DIR beforehand (recorded as the
+  download_network stage, but not counted in the totals), then copied from there.
+* upload - the compressed output is read in parts, computing the MD5 of each as
+  aws_helpers.upload_large_file does, and written to UPLOAD_DIR.
+
+Each stage is recorded with st_worker.stage (wall time, CPU time, peak RSS and bytes read and
+written), and a JSON report is written with the mean of each stage, the years per hour for this
+instance and, if its hourly cost is given, years per dollar. Reports from different instances can
+be compared with st_master.py benchmark. Logs to st_worker_status.log, like st_worker.py.
+
+Usage: st_benchmark.py <report filename> <num procs> <hourly cost ($)> <year> [<year> ...]
+"""
+# So I can access modules defined in parent dir.
+import sys
+sys.path.append('/home/ubuntu/Projects/stormtracks_aws')
+import os
+import json
+import shutil
+import hashlib
+import urllib2
+import multiprocessing as mp
+from time import time
+
+import st_worker
+from st_worker import stage, settings
+from aws_helpers import DEFAULT_PART_SIZE
+
+CACHE_DIR = '/home/ubuntu/stormtracks_data/benchmark_cache'
+UPLOAD_DIR = '/home/ubuntu/stormtracks_data/benchmark_upload'
+STAGES_FILENAME = os.path.join(settings.LOGGING_DIR, 'st_benchmark_stages.jsonl')
+INSTANCE_TYPE_URL = 'http://169.254.169.254/latest/meta-data/instance-type'
+# Summed in the report, as well as averaged.
+COUNTERS = ['duration', 'cpu', 'rchar', 'wchar', 'read_bytes', 'write_bytes']
+
+log = st_worker.log
+
+
+def cache_year_data(year):
+    """
+    Downloads year's C20 data into CACHE_DIR/<year>, unless it is already there.
+    """
+    year_cache_dir = os.path.join(CACHE_DIR, str(year))
+    if os.path.exists(year_cache_dir):
+        return
+    log.info('caching year data {0}'.format(year))
+    with stage('download_network', year):
+        st_worker.download_year_data(year)
+
+    # Moved into a temporary dir first, so that an interrupted cache is not used.
+    tmp_dir = year_cache_dir + '.tmp'
+    for filename in st_worker.year_data_files(year):
+        cache_filename = os.path.join(tmp_dir,
+                                      os.path.relpath(filename, settings.C20_FULL_DATA_DIR))
+        if not os.path.exists(os.path.dirname(cache_filename)):
+            os.makedirs(os.path.dirname(cache_filename))
+        shutil.move(filename, cache_filename)
+    os.rename(tmp_dir, year_cache_dir)
+
+
+def local_download(year):
+    """
+    Stands in for st_worker.download_year_data: copies year's data from the cache.
+    """
+    year_cache_dir = os.path.join(CACHE_DIR, str(year))
+    for root, dirs, filenames in os.walk(year_cache_dir):
+        for filename in filenames:
+            cache_filename = os.path.join(root, filename)
+            data_filename = os.path.join(settings.C20_FULL_DATA_DIR,
+                                         os.path.relpath(cache_filename, year_cache_dir))
+            if not os.path.exists(os.path.dirname(data_filename)):
+                os.makedirs(os.path.dirname(data_filename))
+            shutil.copyfile(cache_filename, data_filename)
+
+
+def local_upload(compressed_filename):
+    """
+    Stands in for st_worker.upload_year_s3: does the local work of a multipart upload.
+    """
+    if not os.path.exists(UPLOAD_DIR):
+        os.makedirs(UPLOAD_DIR)
+    upload_filename = os.path.join(UPLOAD_DIR, os.path.basename(compressed_filename))
+    with open(compressed_filename, 'rb') as f, open(upload_filename, 'wb') as out:
+        data = f.read(DEFAULT_PART_SIZE)
+        while data:
+            hashlib.md5(data).hexdigest()
+            out.write(data)
+            data = f.read(DEFAULT_PART_SIZE)
+    os.remove(upload_filename)
+
+
+# (name, function, called with year or, for upload, the compressed filename), in order.
+STAGES = [('download', local_download),
+          ('analyse', st_worker.cross_ensemble_analyse_year),
+          ('compress', st_worker.compress_year_output),
+          ('upload', local_upload),
+          ('delete', st_worker.delete_year_data)]
+
+
+def run_stage(name, func, arg, year, results):
+    # Runs in its own process, so that ru_maxrss is the peak RSS of this stage alone.
+    with stage(name, year):
+        results.put(func(arg))
+
+
+def benchmark_year(year):
+    """
+    Runs each stage for year in its own child process. Exits with 1 if any stage fails.
+    """
+    results = mp.Queue()
+    compressed_filename = None
+    for name, func in STAGES:
+        arg = compressed_filename if name == 'upload' else year
+        proc = mp.Process(name=name, target=run_stage, args=(name, func, arg, year, results))
+        proc.start()
+        proc.join()
+        if proc.exitcode != 0:
+            log.error('{0} failed for year {1}'.format(name, year))
+            sys.exit(1)
+        value = results.get()
+        if name == 'compress':
+            compressed_filename = value
+    os.remove(compressed_filename)
+    log.info('benchmarked year {0}'.format(year))
+
+
+def get_instance_type():
+    try:
+        return urllib2.urlopen(INSTANCE_TYPE_URL, timeout=2).read()
+    except (urllib2.URLError, IOError):
+        return None
+
+
+def get_mem_total_mb():
+    with open('/proc/meminfo', 'r') as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1]) // 1024
+
+
+def summarise(events, years, failed_years, wall_time, num_procs, hourly_cost):
+    stages = {}
+    for event in events:
+        if event['status'] != 'ok' or event['stage'] == 'download_network':
+            continue
+        summary = stages.setdefault(event['stage'], dict([('count', 0), ('peak_rss_mb', 0.)] +
+                                                         [(key, 0) for key in COUNTERS]))
+        summary['count'] += 1
+        summary['peak_rss_mb'] = max(summary['peak_rss_mb'], event['peak_rss_mb'])
+        for key in COUNTERS:
+            summary[key] += event[key]
+    for summary in stages.values():
+        for key in COUNTERS:
+            summary['mean_' + key] = summary[key] / float(summary['count'])
+
+    num_years = len(years) - len(failed_years)
+    years_per_hour = num_years / wall_time * 3600. if wall_time else 0.
+    return {'instance_type': get_instance_type(),
+            'cpu_count': mp.cpu_count(),
+            'mem_total_mb': get_mem_total_mb(),
+            'num_procs': num_procs,
+            'years': years,
+            'failed_years': failed_years,
+            'wall_time': wall_time,
+            'hourly_cost': hourly_cost,
+            'years_per_hour': years_per_hour,
+            'years_per_dollar': years_per_hour / hourly_cost if hourly_cost else None,
+            'network_stand_ins': True,
+            'stages': stages}
+
+
+def main(report_filename, num_procs, hourly_cost, years):
+    st_worker.stages_filename = STAGES_FILENAME
+    if os.path.exists(STAGES_FILENAME):
+        os.remove(STAGES_FILENAME)
+
+    for year in years:
+        cache_year_data(year)
+
+    log.info('benchmarking years {0}, {1} at a time'.format(
+        ', '.join(str(y) for y in years), num_procs))
+    start = time()
+    pending = list(years)
+    running = []
+    failed_years = []
+    while pending or running:
+        while pending and len(running) < num_procs:
+            year = pending.pop(0)
+            proc = mp.Process(name='benchmark_year', target=benchmark_year, args=(year, ))
+            proc.start()
+            running.append((year, proc))
+        year, proc = running.pop(0)
+        proc.join()
+        if proc.exitcode != 0:
+            failed_years.append(year)
+    wall_time = time() - start
+
+    with open(STAGES_FILENAME, 'r') as f:
+        events = [json.loads(line) for line in f]
+    report = summarise(events, years, failed_years, wall_time, num_procs, hourly_cost)
+    with open(report_filename, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    log.info('benchmarked {0} year(s) in {1:.0f}s: {2:.2f} years/hour'.format(
+        len(years) - len(failed_years), wall_time, report['years_per_hour']))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], int(sys.argv[2]), float(sys.argv[3]), [int(y) for y in sys.argv[4:]])
@@ -3,25 +3,56 @@
 Will be run from st_worker ubuntu EC2 instance.
 
 Imports functions from stormtracks and stormtracks_aws and calls those functions to perform analysis
-on years defined by st_worker_settings.YEARS. Will download all NetCDF4 files for given years then
+on years defined by st_worker_settings.YEARS, or on years pulled one at a time from the work queue
+given by st_worker_settings.QUEUE_URI. Will download all NetCDF4 files for given years then
 perform tracking/matching analysis, then collect fields based on tracks.  Finally zips and sends all
 output to S3, then tidies up after itself (deletes NetCDF4 files) before starting on next year. All
-actions are logged to st_worker_status.log, which allows for (very simple) remote monitoring.
+actions are logged to st_worker_status.log, which allows for (very simple) remote monitoring. If
+st_worker_settings.EVENTS_URI is set, log messages and regular heartbeats are also pushed to the
+master (see heartbeat).
+
+If st_worker_settings.PIPELINE is set, the stages for different years are overlapped: the next
+year's data is downloaded and the previous year's output is compressed and uploaded while the
+current year is analysed. How far ahead data is downloaded is limited by
+st_worker_settings.DISK_BUDGET_GB, which covers both the data and the output.
+
+If st_worker_settings.MAX_CONCURRENT_YEARS is more than one, up to that many years are run at once,
+each from start to finish in its own process. Another year is only started when there is enough
+free memory and disk for it, going by the most that a year has needed so far (see
+run_concurrent).
+
+If st_worker_settings.SPOT_INTERRUPTION_URL is set, the worker is on a spot instance: on notice
+that the instance is about to be reclaimed, work in progress is abandoned and its years are
+released back to the work queue (see spot).
 """
 # So I can access modules defined in parent dir.
 import sys
 sys.path.append('/home/ubuntu/Projects/stormtracks_aws')
 import os
+import json
+import tarfile
+import resource
+import threading
 import multiprocessing as mp
+from glob import glob
+from collections import deque
+from contextlib import contextmanager
+from time import sleep, time
 
 from stormtracks.load_settings import settings
 from stormtracks import download, analysis
-from stormtracks.results import StormtracksResultsManager
+from stormtracks.results import StormtracksResultsManager, RESULTS_TPL
 
-from st_worker_settings import YEARS
+from st_worker_settings import (YEARS, QUEUE_URI, PIPELINE, DISK_BUDGET_GB, STREAM_UPLOAD,
+                                EVENTS_URI, HOST, RUN_ID, SPOT_INTERRUPTION_URL,
+                                MAX_CONCURRENT_YEARS)
 
 from st_utils import setup_logging
-from aws_helpers import upload_large_file
+from aws_helpers import upload_large_file, MultipartUploadWriter, get_key_size
+from work_queue import open_queue
+from heartbeat import HeartbeatHandler, start_heartbeat, INTERRUPTED_MESSAGE
+from spot import start_interruption_watcher
+from log_vital_stats import read_meminfo, sample_tree, MB
 
 # So as paths to e.g. aws_credentials in upload_large_file work.
 os.chdir('/home/ubuntu/Projects/stormtracks_aws')
@@ -29,6 +60,158 @@ os.chdir('/home/ubuntu/Projects/stormtracks_aws')
 # N.B. uses absolute path.
 logging_filename = os.path.join(settings.LOGGING_DIR, 'st_worker_status.log')
 log = setup_logging(name='st_worker_status', filename=logging_filename, mode='w')
+# One JSON object per stage of each year, see stage.
+stages_filename = os.path.join(settings.LOGGING_DIR, 'st_worker_stages.jsonl')
+if EVENTS_URI:
+    # Push every status line to the master as well.
+    log.addHandler(HeartbeatHandler(EVENTS_URI, HOST))
+
+# Never prefetch more than this many years, even if within disk budget, so that years pulled from
+# a work queue are not hoarded by one worker.
+MAX_PREFETCH_YEARS = 2
+# Once this exists, no more years are claimed from the work queue (see fabfile.drain_worker).
+DRAIN_FILENAME = '/home/ubuntu/stormtracks_data/drain'
+# A year that fails is tried this many times in all (serial mode), resuming from its checkpoints.
+YEAR_ATTEMPTS = 2
+
+# Completion markers for each stage of each year (see write_checkpoint), kept per run so that a
+# worker restarted during a run resumes where it stopped, but a new run starts afresh.
+CHECKPOINT_DIR = os.path.join('/home/ubuntu/stormtracks_data/checkpoints', RUN_ID or 'default')
+# Stages that produce something the next stage needs, in the order they are run. Streaming
+# uploads go straight from analyse to upload.
+STAGES = ['download', 'analyse', 'compress', 'upload']
+# Always left free when deciding whether another year can be started (see can_start_year).
+MEMORY_HEADROOM_MB = 512
+DISK_HEADROOM_GB = 1.
+
+
+def read_proc_io():
+    """
+    Returns this process's I/O counters: rchar/wchar include network I/O, read_bytes/write_bytes
+    only count I/O that reached disk.
+    """
+    io = {}
+    with open('/proc/self/io', 'r') as f:
+        for line in f:
+            key, value = line.split(':')
+            io[key] = int(value)
+    return io
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kB on Linux.
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024.
+
+
+@contextmanager
+def stage(name, year):
+    """
+    Records the duration, CPU time, I/O and peak RSS of one stage for one year, and whether it
+    succeeded, as a line of stages_filename. Peak RSS is that of the process so far.
+    """
+    event = {'stage': name, 'year': year, 'pid': os.getpid(), 'start': time()}
+    io_start = read_proc_io()
+    times_start = os.times()
+    try:
+        yield
+        event['status'] = 'ok'
+    except BaseException as e:
+        event['status'] = 'error'
+        event['error'] = repr(e)
+        raise
+    finally:
+        io_end = read_proc_io()
+        times_end = os.times()
+        event['end'] = time()
+        event['duration'] = event['end'] - event['start']
+        event['cpu'] = sum(times_end[:4]) - sum(times_start[:4])
+        for key in ['rchar', 'wchar', 'read_bytes', 'write_bytes']:
+            event[key] = io_end[key] - io_start[key]
+        event['peak_rss_mb'] = peak_rss_mb()
+        # Single write of one line, so lines from different processes do not interleave.
+        with open(stages_filename, 'a') as f:
+            f.write(json.dumps(event, sort_keys=True) + '\n')
+
+
+def checkpoint_filename(year, stage_name):
+    return os.path.join(CHECKPOINT_DIR, '{0}_{1}.json'.format(year, stage_name))
+
+
+def write_checkpoint(year, stage_name, files=(), s3_key=None):
+    """
+    Records that stage_name has finished for year, along with what it produced: local files
+    and/or an S3 key, and their sizes, so that it can be checked that they are still there.
+    """
+    checkpoint = {'year': year, 'stage': stage_name, 'time': time(),
+                  'files': dict((filename, os.path.getsize(filename)) for filename in files)}
+    if s3_key is not None:
+        checkpoint['s3_key'] = s3_key
+        checkpoint['s3_size'] = get_key_size(s3_key)
+    if not os.path.exists(CHECKPOINT_DIR):
+        os.makedirs(CHECKPOINT_DIR)
+    filename = checkpoint_filename(year, stage_name)
+    # Renamed into place, so that a marker is never half written.
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    os.rename(filename + '.tmp', filename)
+
+
+def read_checkpoint(year, stage_name):
+    filename = checkpoint_filename(year, stage_name)
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def is_done(year, stage_name):
+    """
+    Whether stage_name has finished for year and what it produced is still there.
+    """
+    checkpoint = read_checkpoint(year, stage_name)
+    if checkpoint is None or not (checkpoint['files'] or 's3_key' in checkpoint):
+        # A stage that produced nothing can't be checked, so is done again.
+        return False
+    for filename, size in checkpoint['files'].items():
+        if not os.path.exists(filename) or os.path.getsize(filename) != size:
+            return False
+    if 's3_key' in checkpoint:
+        return get_key_size(checkpoint['s3_key']) == checkpoint['s3_size']
+    return True
+
+
+def stage_done(year, stage_name):
+    """
+    Whether stage_name, or a stage after it, has finished for year, i.e. whether it can be skipped.
+    """
+    return any(is_done(year, name) for name in STAGES[STAGES.index(stage_name):])
+
+
+def clear_checkpoints(year):
+    """
+    Removes all but the upload marker of a finished year, which is kept so that the year is not
+    redone if it is handed out again in this run.
+    """
+    for stage_name in STAGES[:-1]:
+        filename = checkpoint_filename(year, stage_name)
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+def year_data_files(year):
+    """
+    Returns the C20 data files of year. stormtracks keeps each year's files in a dir named after
+    the year, either straight under C20_FULL_DATA_DIR or under a version dir (e.g. v1/2005), so
+    other years being downloaded or deleted at the same time do not affect this.
+    """
+    year_dirs = (glob(os.path.join(settings.C20_FULL_DATA_DIR, str(year))) +
+                 glob(os.path.join(settings.C20_FULL_DATA_DIR, '*', str(year))))
+    files = []
+    for year_dir in year_dirs:
+        for root, dirs, filenames in os.walk(year_dir):
+            files.extend(os.path.join(root, filename) for filename in filenames)
+    return sorted(files)
 
 
 def download_year_data(year):
@@ -52,6 +235,18 @@ def cross_ensemble_analyse_year(year):
     sa.run_cross_ensemble_analysis()
 
 
+def results_dir():
+    """
+    Dir that the output of each year, and its compressed archive, are written to.
+    """
+    srm = StormtracksResultsManager('aws_tracking_analysis')
+    return os.path.join(srm.output_dir, srm.name)
+
+
+def year_output_filename(year):
+    return os.path.join(results_dir(), RESULTS_TPL.format(year))
+
+
 def compress_year_output(year):
     srm = StormtracksResultsManager('aws_tracking_analysis')
     compressed_filename = srm.compress_year(year, delete=True)
@@ -59,7 +254,28 @@ def compress_year_output(year):
 
 
 def upload_year_s3(compressed_filename):
-    upload_large_file(compressed_filename)
+    upload_large_file(compressed_filename, verify=True)
+
+
+def stream_year_output_s3(year):
+    """
+    Compresses a year's output straight into S3, without writing the archive to disk first.
+    Produces the same object as compress_year_output followed by upload_year_s3.
+    Returns the key of the object.
+    """
+    srm = StormtracksResultsManager('aws_tracking_analysis')
+    year_filename = year_output_filename(year)
+    writer = MultipartUploadWriter(os.path.basename(year_filename) + '.bz2')
+    try:
+        tar = tarfile.open(fileobj=writer, mode='w|bz2')
+        tar.add(year_filename, arcname=os.path.basename(year_filename))
+        tar.close()
+        writer.close(verify=True)
+    except:
+        writer.cancel()
+        raise
+    srm.delete_year(year)
+    return writer.key_name
 
 
 def delete_year_data(year):
@@ -67,33 +283,458 @@ def delete_year_data(year):
 
 
 def run_for_year(year):
+    """
+    Runs all stages for year, skipping any that have already finished (e.g. before the worker was
+    restarted), so that e.g. a failed upload does not mean downloading and analysing again.
+    """
+    download_stage(year)
+    analyse_year_output(year)
+    compress_and_upload_year(year)
+    delete_stage(year)
+    clear_checkpoints(year)
+    log.info('finished year {0}'.format(year))
+
+
+def compress_and_upload_year(year):
+    if is_done(year, 'upload'):
+        log.info('year output already uploaded {0}'.format(year))
+    elif STREAM_UPLOAD:
+        log.info('streaming year output to s3 {0}'.format(year))
+        with stage('stream_upload', year):
+            key_name = stream_year_output_s3(year)
+            write_checkpoint(year, 'upload', s3_key=key_name)
+    else:
+        if is_done(year, 'compress'):
+            log.info('year output already compressed {0}'.format(year))
+            compressed_filename = list(read_checkpoint(year, 'compress')['files'])[0]
+        else:
+            log.info('compressing year output {0}'.format(year))
+            with stage('compress', year):
+                compressed_filename = compress_year_output(year)
+                write_checkpoint(year, 'compress', files=[compressed_filename])
+        log.info('uploading year to s3 {0}'.format(year))
+        with stage('upload', year):
+            upload_year_s3(compressed_filename)
+            write_checkpoint(year, 'upload', s3_key=os.path.basename(compressed_filename))
+
+
+def download_stage(year):
+    if stage_done(year, 'download'):
+        log.info('year data already downloaded {0}'.format(year))
+        return
     log.info('downloading year data {0}'.format(year))
-    download_year_data(year)
+    with stage('download', year):
+        download_year_data(year)
+        files = year_data_files(year)
+        if not files:
+            raise Exception('no data files found for year {0}'.format(year))
+        write_checkpoint(year, 'download', files=files)
+
+
+def analyse_year_output(year):
+    if stage_done(year, 'analyse'):
+        log.info('year already analysed {0}'.format(year))
+        return
     log.info('cross ensemble analysing year {0}'.format(year))
     # analyse_year(year)
-    cross_ensemble_analyse_year(year)
-    log.info('compressing year output {0}'.format(year))
-    compressed_filename = compress_year_output(year)
-    log.info('uploading year to s3 {0}'.format(year))
-    upload_year_s3(compressed_filename)
-    log.info('deleting year data {0}'.format(year))
-    delete_year_data(year)
+    with stage('analyse', year):
+        cross_ensemble_analyse_year(year)
+        write_checkpoint(year, 'analyse', files=[year_output_filename(year)])
 
 
-def main():
-    for year in YEARS:
-        try:
-            proc = mp.Process(name='run_for_year', target=run_for_year,
-                              kwargs={'year': year})
-            log.info('Starting child process')
-            proc.start()
+def delete_stage(year):
+    # Nothing to delete if the data has already been deleted, or the year was finished before a
+    # restart.
+    if is_done(year, 'download'):
+        log.info('deleting year data {0}'.format(year))
+        with stage('delete', year):
+            delete_year_data(year)
+
+
+def analyse_stage(year):
+    analyse_year_output(year)
+    # Output is all that is needed from now on, free up space for next download.
+    delete_stage(year)
+
+
+def upload_stage(year):
+    compress_and_upload_year(year)
+    clear_checkpoints(year)
+    log.info('finished year {0}'.format(year))
+
+
+def start_child_process(target, year):
+    proc = mp.Process(name=target.__name__, target=target, kwargs={'year': year})
+    log.info('Starting child process')
+    proc.start()
+    return proc
+
+
+def join_child_process(proc, interrupted):
+    """
+    Waits for proc to finish. If notice of interruption is given first, kills proc and returns
+    False.
+    """
+    while proc.is_alive():
+        if interrupted.is_set():
+            proc.terminate()
             proc.join()
-        except Exception as e:
-            log.error(e)
-            log.error('Error with year'.format(year))
-            raise e
+            return False
+        proc.join(1)
+    return True
+
+
+def release_years(queue, years_claims):
+    """
+    Hands years that will not be finished back to the work queue, so that other workers can claim
+    them straight away.
+    """
+    for year, claim in years_claims:
+        if queue is not None:
+            queue.release(claim)
+            log.info('released year {0}'.format(year))
+        else:
+            log.info('abandoned year {0}'.format(year))
+
+
+def static_years(years):
+    for year in years:
+        yield year, None
+
+
+def queued_years(queue):
+    while not os.path.exists(DRAIN_FILENAME):
+        claim = queue.claim()
+        if claim is None:
+            return
+        # The handle lets the master release the claim if this worker dies (see heartbeat).
+        log.info('claimed year {0}'.format(claim.unit),
+                 extra={'claim': {'unit': claim.unit, 'handle': queue.handle(claim)}})
+        yield claim.unit, claim
+    log.info('drained, not claiming any more years')
+
+
+def run_serial(years, queue=None, interrupted=None):
+    """
+    Runs each year from start to finish in a child process before starting the next.
+    A year that fails is tried again (up to YEAR_ATTEMPTS times in all), carrying on from the last
+    stage that finished. If it still fails, it is not completed in the queue, so will be handed out
+    again once its claim times out.
+
+    Stops, releasing the current year, once the interrupted event is set.
+
+    Returns (analysed years, failed years).
+    """
+    interrupted = interrupted or threading.Event()
+    analysed_years = []
+    failed_years = []
+    for year, claim in years:
+        for attempt in range(YEAR_ATTEMPTS):
+            proc = start_child_process(run_for_year, year)
+            if not join_child_process(proc, interrupted) or proc.exitcode == 0:
+                break
+            log.error('Error with year {0}, exit code: {1}'.format(year, proc.exitcode))
+
+        if interrupted.is_set():
+            release_years(queue, [(year, claim)])
+            break
+        elif proc.exitcode == 0:
+            if queue is not None:
+                queue.complete(claim)
+            analysed_years.append(year)
+        else:
+            failed_years.append(year)
+    return analysed_years, failed_years
+
+
+def files_size(filenames):
+    size = 0
+    for filename in filenames:
+        try:
+            size += os.path.getsize(filename)
+        except OSError:
+            # Deleted since it was listed.
+            pass
+    return size
+
+
+def dir_size(path):
+    return files_size(os.path.join(root, filename)
+                      for root, dirs, files in os.walk(path) for filename in files)
+
+
+def disk_used():
+    """
+    Disk used by C20 data, output and compressed archives.
+    """
+    return dir_size(settings.C20_FULL_DATA_DIR) + dir_size(results_dir())
+
+
+def year_footprint(filename=None):
+    """
+    Returns (peak RSS (Mb), disk used (bytes)) of the most demanding years recorded in filename
+    (stages_filename by default), or None if no year has been analysed yet. The disk used by a
+    year is what its download, analyse and compress stages wrote.
+    """
+    filename = filename or stages_filename
+    if not os.path.exists(filename):
+        return None
+    analysed = False
+    peak_rss = 0.
+    year_writes = {}
+    with open(filename, 'r') as f:
+        for line in f:
+            event = json.loads(line)
+            if event['status'] != 'ok':
+                continue
+            analysed = analysed or event['stage'] == 'analyse'
+            peak_rss = max(peak_rss, event['peak_rss_mb'])
+            if event['stage'] in STAGES[:-1]:
+                year_writes[event['year']] = (year_writes.get(event['year'], 0) +
+                                              event['write_bytes'])
+    if not analysed:
+        return None
+    return peak_rss, max(year_writes.values())
+
+
+def available_memory_mb():
+    meminfo = read_meminfo()
+    if 'MemAvailable' in meminfo:
+        available = meminfo['MemAvailable']
+    else:
+        # Older kernels.
+        available = meminfo['MemFree'] + meminfo.get('Buffers', 0) + meminfo.get('Cached', 0)
+    return available / float(MB)
+
+
+def free_disk(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def can_start_year(running, footprint):
+    """
+    Whether another year can be started alongside running [(year, proc, claim, attempt)] without
+    running out of memory or disk, given footprint (see year_footprint). Running years are
+    assumed to still need whatever they have not yet used of the footprint. If no footprint has
+    been recorded, years are only started one at a time.
+    """
+    if not running:
+        return True
+    if footprint is None:
+        return False
+    year_rss_mb, year_disk = footprint
+
+    memory_needed = MEMORY_HEADROOM_MB + year_rss_mb
+    disk_needed = DISK_HEADROOM_GB * 2 ** 30 + year_disk
+    for year, proc, claim, attempt in running:
+        # RSS of the whole tree, as analysis may start processes of its own.
+        memory_needed += max(0., year_rss_mb - sample_tree(proc.pid)[0] / float(MB))
+        if not stage_done(year, 'download'):
+            disk_needed += year_disk
+    return (available_memory_mb() >= memory_needed and
+            free_disk(settings.C20_FULL_DATA_DIR) >= disk_needed)
+
+
+def run_concurrent(years, queue=None, max_years=MAX_CONCURRENT_YEARS, interrupted=None):
+    """
+    Runs up to max_years years at once, each from start to finish in its own child process as in
+    run_serial. Another year is only started (e.g. claimed from the queue) once can_start_year
+    says that there is room for it, so until a year has been recorded in stages_filename, years
+    are run one at a time. A year that fails is tried again, as in run_serial.
+
+    Stops, releasing all years in progress, once the interrupted event is set.
+
+    Returns (analysed years, failed years).
+    """
+    interrupted = interrupted or threading.Event()
+    years = iter(years)
+    years_left = True
+    # (year, claim, attempt) of years to try again.
+    retries = deque()
+    # (year, proc, claim, attempt)
+    running = []
+    footprint = year_footprint()
+    waiting = False
+    analysed_years = []
+    failed_years = []
+
+    while years_left or retries or running:
+        for year, proc, claim, attempt in list(running):
+            if proc.is_alive():
+                continue
+            running.remove((year, proc, claim, attempt))
+            if proc.exitcode == 0:
+                if queue is not None:
+                    queue.complete(claim)
+                analysed_years.append(year)
+                footprint = year_footprint()
+            else:
+                log.error('Error with year {0}, exit code: {1}'.format(year, proc.exitcode))
+                if attempt + 1 < YEAR_ATTEMPTS:
+                    retries.append((year, claim, attempt + 1))
+                else:
+                    failed_years.append(year)
+
+        if interrupted.is_set():
+            for year, proc, claim, attempt in running:
+                proc.terminate()
+                proc.join()
+            release_years(queue, [(year, claim) for year, proc, claim, attempt in running] +
+                          [(year, claim) for year, claim, attempt in retries])
+            break
+
+        while len(running) < max_years and (retries or years_left):
+            if not can_start_year(running, footprint):
+                if not waiting:
+                    log.info('waiting to start another year: {0}'.format(
+                        'no year recorded yet' if footprint is None
+                        else 'not enough free memory or disk'))
+                    waiting = True
+                break
+            waiting = False
+            if retries:
+                year, claim, attempt = retries.popleft()
+            else:
+                # Only take the next year (e.g. claim it from the queue) when it can be started.
+                next_year = next(years, None)
+                if next_year is None:
+                    years_left = False
+                    break
+                year, claim = next_year
+                attempt = 0
+            running.append((year, start_child_process(run_for_year, year), claim, attempt))
+
+        sleep(1)
+
+    return analysed_years, failed_years
+
+
+def run_pipelined(years, queue=None, disk_budget_gb=DISK_BUDGET_GB, interrupted=None):
+    """
+    Runs the download, analyse and upload stages of different years at the same time, each in its
+    own child process. Stages are connected by bounded queues: the next year is only downloaded if
+    the C20 data, output and archives on disk plus the most that a year has needed so far (its data
+    and its output) fit in disk_budget_gb, and a year is only analysed once the previous year's
+    output has started uploading.
+
+    Stops, releasing all years in progress, once the interrupted event is set.
+
+    Returns (analysed years, failed years).
+    """
+    interrupted = interrupted or threading.Event()
+    disk_budget = disk_budget_gb * 2 ** 30
+    years = iter(years)
+    years_left = True
+    downloaded = deque()
+    analysed = deque()
+    # stage name: (proc, year, claim)
+    running = {}
+    # Largest data and output of a year so far, measured from each year's own files, as other
+    # years' files come and go at the same time.
+    data_size = 0
+    output_size = 0
+    analysed_years = []
+    failed_years = []
+
+    while years_left or downloaded or analysed or running:
+        for name, (proc, year, claim) in list(running.items()):
+            if proc.is_alive():
+                continue
+            del running[name]
+            if proc.exitcode != 0:
+                log.error('Error with year {0} in {1}, exit code: {2}'.format(year, name,
+                                                                              proc.exitcode))
+                failed_years.append(year)
+                if name != 'upload':
+                    try:
+                        delete_year_data(year)
+                    except Exception as e:
+                        log.error(e)
+            elif name == 'download':
+                data_size = max(data_size, files_size(year_data_files(year)))
+                downloaded.append((year, claim))
+            elif name == 'analyse':
+                output_size = max(output_size, files_size([year_output_filename(year)]))
+                analysed.append((year, claim))
+            elif name == 'upload':
+                if queue is not None:
+                    queue.complete(claim)
+                analysed_years.append(year)
+
+        if interrupted.is_set():
+            for proc, year, claim in running.values():
+                proc.terminate()
+                proc.join()
+            release_years(queue, [(year, claim) for proc, year, claim in running.values()] +
+                          list(downloaded) + list(analysed))
+            break
+
+        if 'download' not in running and years_left:
+            idle = not downloaded and 'analyse' not in running
+            if idle or (len(downloaded) < MAX_PREFETCH_YEARS and
+                        disk_used() + data_size + output_size <= disk_budget):
+                # Only take the next year (e.g. claim it from the queue) when it can be started.
+                next_year = next(years, None)
+                if next_year is None:
+                    years_left = False
+                else:
+                    year, claim = next_year
+                    running['download'] = (start_child_process(download_stage, year), year, claim)
+
+        if 'upload' not in running and analysed:
+            year, claim = analysed.popleft()
+            running['upload'] = (start_child_process(upload_stage, year), year, claim)
+
+        if 'analyse' not in running and downloaded and not analysed:
+            year, claim = downloaded.popleft()
+            running['analyse'] = (start_child_process(analyse_stage, year), year, claim)
+
+        sleep(1)
+
+    return analysed_years, failed_years
+
+
+def main():
+    if EVENTS_URI:
+        start_heartbeat(EVENTS_URI, HOST)
+
+    if SPOT_INTERRUPTION_URL:
+        interrupted = start_interruption_watcher(SPOT_INTERRUPTION_URL)
+    else:
+        interrupted = threading.Event()
+
+    if QUEUE_URI:
+        if os.path.exists(DRAIN_FILENAME):
+            # Left from an earlier run.
+            os.remove(DRAIN_FILENAME)
+        queue = open_queue(QUEUE_URI)
+        years = queued_years(queue)
+    else:
+        queue = None
+        years = static_years(YEARS)
+
+    if PIPELINE:
+        analysed_years, failed_years = run_pipelined(years, queue, interrupted=interrupted)
+    elif MAX_CONCURRENT_YEARS != 1:
+        analysed_years, failed_years = run_concurrent(years, queue,
+                                                      MAX_CONCURRENT_YEARS or mp.cpu_count(),
+                                                      interrupted=interrupted)
+    else:
+        analysed_years, failed_years = run_serial(years, queue, interrupted=interrupted)
+
+    if interrupted.is_set():
+        # Instead of the usual finished message, so that the master replaces this worker.
+        log.warn('{0}: {1}, analysed years {2}'.format(
+            INTERRUPTED_MESSAGE, interrupted.notice,
+            ', '.join(str(y) for y in analysed_years)))
+        return
 
-    log.info('analysed years {0}-{1}'.format(YEARS[0], YEARS[-1]))
+    log.info('analysed years {0}'.format(', '.join(str(y) for y in analysed_years)))
+    if failed_years:
+        log.error('failed years {0}'.format(', '.join(str(y) for y in failed_years)))
+        # So that supervisor (and so the master) sees that the worker did not succeed.
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -1,2 +1,20 @@
 """Template that will get rendered to EC2 instance"""
 YEARS = %(years)s
+# If set, years are pulled from this work queue instead of being taken from YEARS.
+QUEUE_URI = %(queue_uri)r
+# Overlap download/analysis/upload of different years.
+PIPELINE = %(pipeline)r
+# Max C20 data (GB) to hold on disk when downloading ahead in PIPELINE mode.
+DISK_BUDGET_GB = %(disk_budget_gb)r
+# Compress output straight into S3 rather than via an archive on disk.
+STREAM_UPLOAD = %(stream_upload)r
+# If set, status and heartbeat events are pushed to this queue (see heartbeat).
+EVENTS_URI = %(events_uri)r
+# Name the master knows this worker by.
+HOST = %(host)r
+# Stage checkpoints are kept per run, so a restarted worker resumes, but a new run starts afresh.
+RUN_ID = %(run_id)r
+# If set, this is a spot instance: this URL is checked for notice of interruption (see spot).
+SPOT_INTERRUPTION_URL = %(spot_interruption_url)r
+# Max number of years run at once, memory and disk permitting (0: one per CPU).
+MAX_CONCURRENT_YEARS = %(max_concurrent_years)r
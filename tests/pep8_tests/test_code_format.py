@@ -37,3 +37,5 @@ class TestCodeFormat:
         self._test_conformance_in_files(filenames)
         filenames = glob('aws_interaction/*.py')
         self._test_conformance_in_files(filenames)
+        filenames = glob('unit_tests/*.py')
+        self._test_conformance_in_files(filenames)
@@ -0,0 +1,44 @@
+import sys
+sys.path.insert(0, '..')
+
+from autoscaling import AutoscalingController, mean_year_hours, DEFAULT_YEAR_HOURS
+
+
+class TestAutoscaling:
+    def test_1_target_time(self):
+        """Check that enough instances are asked for to finish in time, up to the spend limit"""
+        controller = AutoscalingController(target_hours=10, year_hours=2., start_time=0)
+        # 5 years per instance in 10h.
+        assert controller.desired_instances(20, now=0) == 4
+        assert controller.desired_instances(21, now=0) == 5
+        # Half the time left.
+        assert controller.desired_instances(20, now=5 * 3600) == 8
+        # Never more instances than years.
+        assert controller.desired_instances(3, now=9.9 * 3600) == 3
+
+        controller = AutoscalingController(target_hours=10, max_hourly_spend=0.25,
+                                           instance_hourly_cost=0.06, year_hours=2.,
+                                           start_time=0)
+        assert controller.desired_instances(100, now=0) == 4
+
+    def test_2_measured_throughput(self):
+        """Check that the fleet only shrinks once throughput has been measured"""
+        controller = AutoscalingController(target_hours=10, year_hours=2., start_time=0)
+        controller.update(20, 0, now=0)
+        assert controller.plan(20, 4, now=0) == 0
+        assert controller.plan(20, 2, now=0) == 2
+
+        # Less than 10h left now: still predicted, so grows.
+        controller.update(20, 4, now=600)
+        assert controller.plan(20, 4, now=600) == 1
+
+        # 4 instances finish 8 years in 1h: twice as fast as predicted.
+        controller.update(12, 4, now=600 + 3600)
+        assert controller.years_per_instance_hour() == 2.
+        assert controller.plan(12, 4, now=600 + 3600) == -3
+
+    def test_3_mean_year_hours(self):
+        """Check that years with no history take the median runtime"""
+        assert mean_year_hours([2000], {}) == DEFAULT_YEAR_HOURS
+        runtimes = {2000: 3600., 2001: 7200., 2002: 3 * 3600.}
+        assert mean_year_hours([2000, 2005], runtimes) == 1.5
@@ -0,0 +1,200 @@
+import sys
+import os
+import json
+import shutil
+import tempfile
+import threading
+sys.path.insert(0, '..')
+
+import boto
+from moto import mock_s3_deprecated
+
+import aws_helpers
+
+# moto mocks S3 by patching sockets, which is not thread-safe: requests sent from several threads
+# at once can get their bodies mixed up. So every S3 transfer in these tests uses one thread.
+
+
+class TestConnectionCache:
+    def setup(self):
+        self._get_credentials = aws_helpers._get_credentials
+        aws_helpers._get_credentials = lambda: ('user', 'key_id', 'secret')
+
+    def teardown(self):
+        aws_helpers._get_credentials = self._get_credentials
+
+    def test_1_connection_per_thread(self):
+        """Check that connections are cached, but not shared between threads"""
+        conns = []
+        thread = threading.Thread(target=lambda: conns.append(aws_helpers.create_s3_connection()))
+        thread.start()
+        thread.join()
+        conn = aws_helpers.create_s3_connection()
+        assert aws_helpers.create_s3_connection() is conn
+        assert conns[0] is not conn
+
+
+class TestUploadLargeFile:
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.mock = mock_s3_deprecated()
+        self.mock.start()
+        self._get_credentials = aws_helpers._get_credentials
+        aws_helpers._get_credentials = lambda: ('user', 'key_id', 'secret')
+        self.bucket = boto.connect_s3('key_id', 'secret').create_bucket('stormtracks_data')
+
+    def teardown(self):
+        aws_helpers._get_credentials = self._get_credentials
+        self.mock.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def write_file(self, size, char):
+        filename = os.path.join(self.tmpdir, 'year.tgz')
+        with open(filename, 'wb') as fp:
+            fp.write(char * size)
+        return filename
+
+    def test_1_resume_with_stale_parts(self):
+        """Check that parts of a resumed upload beyond the end of the file are left out"""
+        part_size = aws_helpers.MIN_PART_SIZE
+        # Three parts were uploaded from an earlier, larger version of the file.
+        filename = self.write_file(3 * part_size, 'a')
+        mp = self.bucket.initiate_multipart_upload('year.tgz')
+        with open(filename, 'rb') as fp:
+            for part_num in range(1, 4):
+                mp.upload_part_from_file(fp, part_num, size=part_size)
+
+        filename = self.write_file(part_size + 10, 'b')
+        aws_helpers.upload_large_file(filename, part_size=part_size, num_threads=1, verify=True)
+
+        assert self.bucket.get_key('year.tgz').get_contents_as_string() == 'b' * (part_size + 10)
+        assert self.bucket.get_all_multipart_uploads() == []
+
+
+class TestDownloadKeys:
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.mock = mock_s3_deprecated()
+        self.mock.start()
+        self._get_credentials = aws_helpers._get_credentials
+        aws_helpers._get_credentials = lambda: ('user', 'key_id', 'secret')
+        self.bucket = boto.connect_s3('key_id', 'secret').create_bucket('stormtracks_data')
+
+    def teardown(self):
+        aws_helpers._get_credentials = self._get_credentials
+        self.mock.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_1_download_ranges(self):
+        """Check that keys are downloaded in ranges and put together"""
+        contents = {'2005/a.nc': ''.join(chr(i % 256) for i in range(1000)), '2005/b.nc': ''}
+        for key_name, content in contents.items():
+            self.bucket.new_key(key_name).set_contents_from_string(content)
+
+        keys = list(self.bucket.list())
+        failed_keys = aws_helpers.download_keys(self.bucket, keys, self.tmpdir, num_threads=1,
+                                                range_size=300)
+        assert failed_keys == []
+        for key_name, content in contents.items():
+            with open(os.path.join(self.tmpdir, key_name), 'rb') as fp:
+                assert fp.read() == content
+
+
+class TestMultipartUploadWriter:
+    def setup(self):
+        self.mock = mock_s3_deprecated()
+        self.mock.start()
+        self._get_credentials = aws_helpers._get_credentials
+        aws_helpers._get_credentials = lambda: ('user', 'key_id', 'secret')
+        self._send_part = aws_helpers._send_part
+        self.bucket = boto.connect_s3('key_id', 'secret').create_bucket('stormtracks_data')
+
+    def teardown(self):
+        aws_helpers._send_part = self._send_part
+        aws_helpers._get_credentials = self._get_credentials
+        self.mock.stop()
+
+    def test_1_stream_parts(self):
+        """Check that data written in several parts is put together into one object"""
+        part_size = aws_helpers.MIN_PART_SIZE
+        writer = aws_helpers.MultipartUploadWriter('year.tgz.bz2', part_size=part_size,
+                                                   num_threads=1)
+        # Two full halves make the first part, the rest is the second.
+        chunks = ['a' * (part_size / 2), 'b' * (part_size / 2), 'c' * 10]
+        for chunk in chunks:
+            writer.write(chunk)
+        writer.close(verify=True)
+
+        key = self.bucket.get_key('year.tgz.bz2')
+        assert key.get_contents_as_string() == ''.join(chunks)
+        assert key.etag.strip('"') == writer.etag
+        assert writer.etag.endswith('-2')
+
+    def test_2_cancel(self):
+        """Check that a cancelled upload leaves neither an object nor an unfinished upload"""
+        writer = aws_helpers.MultipartUploadWriter('year.tgz.bz2', num_threads=1)
+        writer.write('a' * 10)
+        writer.cancel()
+        assert self.bucket.get_key('year.tgz.bz2') is None
+        assert self.bucket.get_all_multipart_uploads() == []
+
+    def test_3_close_error(self):
+        """Check that the upload is cancelled if a part cannot be sent when closing"""
+        def fail(*args):
+            raise IOError('connection reset')
+        aws_helpers._send_part = fail
+        writer = aws_helpers.MultipartUploadWriter('year.tgz.bz2', num_threads=1)
+        writer.write('a' * 10)
+        try:
+            writer.close()
+            assert False, 'Should have raised IOError'
+        except IOError:
+            pass
+        assert self.bucket.get_key('year.tgz.bz2') is None
+        assert self.bucket.get_all_multipart_uploads() == []
+
+
+class TestSyncBucket:
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.mock = mock_s3_deprecated()
+        self.mock.start()
+        self._get_credentials = aws_helpers._get_credentials
+        aws_helpers._get_credentials = lambda: ('user', 'key_id', 'secret')
+        self._download_keys = aws_helpers.download_keys
+        self.downloaded = []
+
+        def download_keys(bucket, keys, directory, num_threads):
+            self.downloaded.extend(key.key for key in keys)
+            return self._download_keys(bucket, keys, directory, num_threads=1)
+        aws_helpers.download_keys = download_keys
+        self.bucket = boto.connect_s3('key_id', 'secret').create_bucket('stormtracks_data')
+
+    def teardown(self):
+        aws_helpers.download_keys = self._download_keys
+        aws_helpers._get_credentials = self._get_credentials
+        self.mock.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def read(self, key_name):
+        with open(os.path.join(self.tmpdir, key_name), 'rb') as fp:
+            return fp.read()
+
+    def test_1_sync(self):
+        """Check that only new or changed objects are downloaded, and deleted ones pruned"""
+        for key_name in ['2004.bz2', '2005.bz2', '2006.bz2']:
+            self.bucket.new_key(key_name).set_contents_from_string(key_name + ' v1')
+        assert aws_helpers.sync_bucket(directory=self.tmpdir) == []
+        assert sorted(self.downloaded) == ['2004.bz2', '2005.bz2', '2006.bz2']
+
+        self.downloaded = []
+        self.bucket.new_key('2005.bz2').set_contents_from_string('2005.bz2 v2')
+        self.bucket.delete_key('2006.bz2')
+        assert aws_helpers.sync_bucket(directory=self.tmpdir, prune=True) == []
+        assert self.downloaded == ['2005.bz2']
+        assert self.read('2004.bz2') == '2004.bz2 v1'
+        assert self.read('2005.bz2') == '2005.bz2 v2'
+        assert not os.path.exists(os.path.join(self.tmpdir, '2006.bz2'))
+
+        with open(os.path.join(self.tmpdir, aws_helpers.MANIFEST_FILENAME), 'r') as f:
+            assert sorted(json.load(f)) == ['2004.bz2', '2005.bz2']
@@ -0,0 +1,56 @@
+import sys
+import Queue
+sys.path.insert(0, '..')
+
+import fanout
+
+
+class TestFanOut:
+    def setup(self):
+        self._transfer = fanout._transfer
+        self._connect = fanout._connect
+        self.sources = {}
+
+        def fake_transfer(results, source, host, local_path, remote_path, sha1, mode, bucket):
+            if source == 'bad_relay' or host == 'bad_host':
+                results.put((source, host, 'Failed'))
+            else:
+                self.sources[host] = source
+                results.put((source, host, None))
+        fanout._transfer = fake_transfer
+
+    def teardown(self):
+        fanout._transfer = self._transfer
+        fanout._connect = self._connect
+
+    def test_1_token_bucket(self):
+        """Check that consuming more than the bucket's capacity is rate limited"""
+        clock = [0.]
+
+        def sleep(seconds):
+            clock[0] += seconds
+
+        # Powers of 2, so that the fake clock's arithmetic is exact.
+        bucket = fanout.TokenBucket(2 ** 20, clock=lambda: clock[0], sleep=sleep)
+        for i in range(24):
+            bucket.consume(2 ** 16)
+        assert clock[0] == 0.5
+
+    def test_2_relay(self):
+        """Check that hosts relay the file on and that failing hosts are retried then reported"""
+        hosts = ['host{0}'.format(i) for i in range(6)] + ['bad_host']
+        failed = fanout.fan_out(__file__, hosts, 'fanout_tests.py', num_threads=1,
+                                retries=2, relay=True)
+        assert failed.keys() == ['bad_host']
+        assert self.sources['host0'] is None
+        assert any(source is not None for source in self.sources.values())
+
+    def test_3_transfer_error(self):
+        """Check that unexpected errors are reported as failed transfers"""
+        def bad_connect(host):
+            raise EOFError()
+        fanout._connect = bad_connect
+        results = Queue.Queue()
+        self._transfer(results, None, 'host0', __file__, 'fanout_tests.py', 'sha1', None, None)
+        source, host, error = results.get_nowait()
+        assert host == 'host0' and error == 'EOFError()'
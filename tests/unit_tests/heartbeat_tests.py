@@ -0,0 +1,86 @@
+import sys
+import os
+import shutil
+import logging
+import tempfile
+sys.path.insert(0, '..')
+
+import heartbeat
+
+
+class TestHeartbeat:
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.uri = 'sqlite://{0}'.format(os.path.join(self.tmpdir, 'events.db'))
+        self.collector = heartbeat.HeartbeatCollector(self.uri)
+        self.threads = []
+
+    def teardown(self):
+        # Otherwise they would carry on writing to the deleted queue.
+        for thread in self.threads:
+            thread.stopped.set()
+            thread.join()
+        shutil.rmtree(self.tmpdir)
+
+    def handler_log(self, name):
+        handler = heartbeat.HeartbeatHandler(self.uri, 'host1')
+        log = logging.getLogger(name)
+        log.setLevel(logging.INFO)
+        log.handlers = [handler]
+        return log, handler
+
+    def test_1_status_events(self):
+        """Check that logged status lines reach the collector and mark completion"""
+        log, handler = self.handler_log('heartbeat_test')
+        log.info('finished year 2005')
+        log.info('analysed years 2005')
+        # Sends what is buffered.
+        handler.close()
+
+        events = self.collector.poll(wait_time=0)
+        assert [e['message'] for e in events] == ['finished year 2005', 'analysed years 2005']
+        assert self.collector.finished_hosts() == set(['host1'])
+        assert self.collector.poll(wait_time=0) == []
+
+    def test_2_stale_hosts(self):
+        """Check that hosts that have not sent events count as stale"""
+        self.collector.watch(['host1', 'host2'])
+        self.threads.append(heartbeat.start_heartbeat(self.uri, 'host1', interval=60))
+        self.collector.poll(wait_time=5)
+        assert self.collector.stale_hosts(timeout=-1) == set(['host1', 'host2'])
+        self.collector.hosts['host2']['last_seen'] -= 10
+        assert self.collector.stale_hosts(timeout=5) == set(['host2'])
+
+    def test_3_interrupted_hosts(self):
+        """Check that an interrupted worker counts as finished and interrupted"""
+        log, handler = self.handler_log('heartbeat_test_interrupted')
+        log.info('released year 2005')
+        log.info('interrupted: terminate, analysed years 2004')
+        handler.close()
+
+        self.collector.poll(wait_time=0)
+        assert self.collector.finished_hosts() == set(['host1'])
+        assert self.collector.interrupted_hosts() == set(['host1'])
+
+    def test_4_claims(self):
+        """Check that claims are tracked until their year is finished or released"""
+        log, handler = self.handler_log('heartbeat_test_claims')
+        log.info('claimed year 2005', extra={'claim': {'unit': 2005, 'handle': 1}})
+        log.info('claimed year 2006', extra={'claim': {'unit': 2006, 'handle': 2}})
+        log.info('finished year 2005')
+        handler.close()
+
+        self.collector.poll(wait_time=0)
+        assert self.collector.claims('host1') == [2]
+        assert self.collector.claims('host2') == []
+
+    def test_5_batched_status_events(self):
+        """Check that logging does not wait for the queue, and status lines are sent in batches"""
+        log, handler = self.handler_log('heartbeat_test_batched')
+        log.info('claimed year 2005')
+        assert self.collector.poll(wait_time=0) == []
+        log.info('finished year 2005')
+
+        events = self.collector.poll(wait_time=5)
+        assert [e['message'] for e in events] == ['claimed year 2005', 'finished year 2005']
+        handler.close()
@@ -0,0 +1,46 @@
+import sys
+import logging
+sys.path.insert(0, '..')
+
+import fabfile
+import orchestrator
+
+
+class TestFleetOrchestrator:
+    def setup(self):
+        self._host_log = orchestrator.host_log
+        self._beep = fabfile.beep
+        # Neither writing host logs nor beeping is wanted in tests.
+        orchestrator.host_log = lambda host: logging.getLogger('orchestrator_test')
+        fabfile.beep = lambda: None
+
+        self.fleet = orchestrator.FleetOrchestrator(None, {'host1': None}, {'host1': [2005]}, {})
+        self.fleet.states['host1'] = orchestrator.RUNNING
+        self.submitted = []
+        self.fleet._submit = lambda task, host, **kwargs: self.submitted.append(
+            (task.__name__, host))
+
+    def teardown(self):
+        orchestrator.host_log = self._host_log
+        fabfile.beep = self._beep
+
+    def test_1_worker_finished(self):
+        """Check that a worker whose last line is the finished message is finished"""
+        self.fleet._check_worker_done('host1', None, ('2015-06-01 12:00:00 analysed years 2005',
+                                                      'EXITED'))
+        assert self.fleet.states['host1'] == orchestrator.RETRIEVING_LOGS
+        assert self.submitted == [('retrieve_logs', 'host1')]
+
+    def test_2_worker_failed_years(self):
+        """Check that a worker that exited after some years failed is finished"""
+        self.fleet._check_worker_done('host1', None, ('2015-06-01 12:00:00 failed years 2005',
+                                                      'EXITED'))
+        assert self.fleet.states['host1'] == orchestrator.RETRIEVING_LOGS
+        assert self.submitted == [('retrieve_logs', 'host1')]
+
+    def test_3_worker_starting(self):
+        """Check that a worker that supervisor is still starting is left running"""
+        self.fleet._check_worker_done('host1', None, ('2015-06-01 12:00:00 claimed year 2005',
+                                                      'STARTING'))
+        assert self.fleet.states['host1'] == orchestrator.RUNNING
+        assert self.submitted == []
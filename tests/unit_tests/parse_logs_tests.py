@@ -0,0 +1,72 @@
+import sys
+import os
+import json
+import shutil
+import tempfile
+sys.path.insert(0, '..')
+sys.path.insert(0, '../st_worker_files')
+
+import parse_logs
+from log_vital_stats import RingLog
+
+
+def stage_line(year, stage='analyse', status='ok'):
+    return json.dumps({'stage': stage, 'year': year, 'pid': 1, 'status': status,
+                       'start': 0., 'end': 10., 'duration': 10., 'cpu': 9.,
+                       'rchar': 1, 'wchar': 2, 'read_bytes': 3, 'write_bytes': 4,
+                       'peak_rss_mb': 100.}) + '\n'
+
+
+class TestParseLogs:
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_1_read_stages_log(self):
+        """Check that each stage line becomes a row, with whether the stage succeeded"""
+        filename = os.path.join(self.tmpdir, 'st_worker_stages.jsonl')
+        with open(filename, 'w') as f:
+            f.write(stage_line(2004, stage='download'))
+            f.write(stage_line(2004))
+            f.write(stage_line(2005, status='error'))
+        stages = parse_logs.read_stages_log(filename)
+        assert list(stages['stage']) == ['download', 'analyse', 'analyse']
+        assert list(stages['year']) == [2004., 2004., 2005.]
+        assert list(stages['ok']) == [True, True, False]
+        assert list(stages['duration']) == [10., 10., 10.]
+
+    def test_2_read_vital_stats_log_truncated(self):
+        """Check that a last line that has not been written in full is skipped"""
+        filename = os.path.join(self.tmpdir, 'vital_stats.log')
+        with open(filename, 'w') as f:
+            f.write('date,st_worker_mem_usage(%),used(Mb),free(Mb),df(%),'
+                    'rss(Mb),cpu(s),read(Mb),write(Mb),num_procs\n')
+            f.write('2015-06-01 12:00:00.000000,1.50,100,200,10.0,50.0,1.00,2.0,3.0,4\n')
+            f.write('2015-06-01 12:00:10.000000,1.60,110,190,10.0,55.0,2.00,2.0,3.0,4\n')
+            f.write('2015-06-01 12:0')
+        stats = parse_logs.read_vital_stats_log(filename)
+        assert len(stats['date']) == 2
+        assert list(stats['used']) == [100., 110.]
+        assert list(stats['num_procs']) == [4., 4.]
+
+    def test_3_read_vital_stats_ring(self):
+        """Check that a ring log that has wrapped round reads back in time order in each tier"""
+        filename = os.path.join(self.tmpdir, 'vital_stats.bin')
+        ring = RingLog(filename, fields=['rss', 'cpu'], tiers=[(1, 5), (3, 2)])
+        for t in range(13):
+            ring.append(float(t), (float(t), 2. * t))
+        ring.f.close()
+
+        samples = parse_logs.read_vital_stats_ring(filename, tier=0)
+        assert list(samples.time) == [8., 9., 10., 11., 12.]
+        assert list(samples.cpu) == [16., 18., 20., 22., 24.]
+
+        # Windows of 3 samples, the last (12) is not complete.
+        windows = parse_logs.read_vital_stats_ring(filename, tier=1)
+        assert list(windows.time) == [6., 9.]
+        assert list(windows.rss_min) == [6., 9.]
+        assert list(windows.rss_mean) == [7., 10.]
+        assert list(windows.rss_max) == [8., 11.]
+        assert list(windows.cpu_mean) == [14., 20.]
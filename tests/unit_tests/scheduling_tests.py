@@ -0,0 +1,50 @@
+import sys
+import os
+import shutil
+import tempfile
+sys.path.insert(0, '..')
+
+import scheduling
+
+STATUS_LOG = """Starting child process
+2015-06-01 10:00:00 downloading year data 2004
+2015-06-01 10:30:00 cross ensemble analysing year 2004
+2015-06-01 12:00:00 finished year 2004
+2015-06-01 12:00:01 Starting child process
+2015-06-01 12:00:02 downloading year data 2005
+2015-06-01 12:10:00 deleting year data 2005
+"""
+
+
+class TestScheduling:
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_1_lpt_partition(self):
+        """Check that long years are spread out and bins are balanced"""
+        runtimes = {2000: 10., 2001: 9., 2002: 5., 2003: 4., 2004: 1.}
+        year_lists, bin_runtimes = scheduling.lpt_partition(2, sorted(runtimes), runtimes)
+        assert sorted(bin_runtimes) == [14., 15.]
+        assert [2000] in [[y for y in ys if y in (2000, 2001)] for ys in year_lists]
+
+    def test_2_lpt_partition_no_history(self):
+        """Check that years are split evenly if there is no runtime history"""
+        year_lists, bin_runtimes = scheduling.lpt_partition(3, range(2000, 2010), {})
+        assert sorted(len(ys) for ys in year_lists) == [3, 3, 4]
+        assert sorted(sum(year_lists, [])) == range(2000, 2010)
+
+    def test_3_update_runtime_history(self):
+        """Check that only fully analysed years are read from status logs"""
+        logs_dir = os.path.join(self.tmpdir, 'remote', '1.2.3.4', 'logs')
+        os.makedirs(logs_dir)
+        with open(os.path.join(logs_dir, 'st_worker_status.log'), 'w') as f:
+            f.write(STATUS_LOG)
+
+        history_file = os.path.join(self.tmpdir, 'year_runtimes.json')
+        runtimes = scheduling.update_runtime_history(os.path.join(self.tmpdir, 'remote'),
+                                                     history_file)
+        assert runtimes == {2004: 7200.}
+        assert scheduling.load_runtime_history(history_file) == {2004: {'1.2.3.4': 7200.}}
@@ -0,0 +1,51 @@
+import sys
+import json
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+sys.path.insert(0, '..')
+
+import spot
+
+
+class InstanceActionHandler(BaseHTTPRequestHandler):
+    """Stands in for the instance metadata endpoint: 404 until a notice is set on the server."""
+    def do_GET(self):
+        if self.server.notice is None:
+            self.send_response(404)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(json.dumps(self.server.notice))
+
+    def log_message(self, *args):
+        pass
+
+
+class TestSpot:
+    def setup(self):
+        self.server = HTTPServer(('127.0.0.1', 0), InstanceActionHandler)
+        self.server.notice = None
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:{0}/latest/meta-data/spot/instance-action'.format(
+            self.server.server_address[1])
+
+    def teardown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_1_interruption_notice(self):
+        """Check that a notice is only returned once the endpoint stops returning 404"""
+        assert spot.interruption_notice(self.url) is None
+        self.server.notice = {'action': 'terminate', 'time': '2016-01-01T00:02:00Z'}
+        assert spot.interruption_notice(self.url) == self.server.notice
+
+    def test_2_interruption_watcher(self):
+        """Check that the watcher sets its event once notice is given"""
+        interrupted = spot.start_interruption_watcher(self.url, interval=0.1)
+        assert not interrupted.wait(0.5)
+        self.server.notice = {'action': 'stop', 'time': '2016-01-01T00:02:00Z'}
+        assert interrupted.wait(5)
+        assert interrupted.notice['action'] == 'stop'
@@ -0,0 +1,79 @@
+import sys
+import os
+import shutil
+import tempfile
+sys.path.insert(0, '..')
+
+import work_queue
+
+
+class TestSqliteWorkQueue:
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.uri = 'sqlite://{0}'.format(os.path.join(self.tmpdir, 'queue.db'))
+        self.queue = work_queue.open_queue(self.uri)
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_1_claim_in_order(self):
+        """Check that units are claimed in the order they were put"""
+        self.queue.put_units([2005, 2006, 2007])
+        years = []
+        claim = self.queue.claim()
+        while claim is not None:
+            years.append(claim.unit)
+            self.queue.complete(claim)
+            claim = self.queue.claim()
+        assert years == [2005, 2006, 2007]
+        assert self.queue.remaining() == 0
+
+    def test_2_claims_not_shared(self):
+        """Check that two queue instances never claim the same unit"""
+        other_queue = work_queue.open_queue(self.uri)
+        self.queue.put_units([2005, 2006])
+        claim1 = self.queue.claim()
+        claim2 = other_queue.claim()
+        assert claim1.unit != claim2.unit
+        assert self.queue.claim() is None
+        assert self.queue.remaining() == 2
+
+    def test_3_release(self):
+        """Check that a released unit can be claimed again"""
+        self.queue.put_units([2005])
+        claim = self.queue.claim()
+        self.queue.release(claim)
+        assert self.queue.claim().unit == 2005
+
+    def test_4_visibility_timeout(self):
+        """Check that an expired claim is handed out again"""
+        queue = work_queue.open_queue(self.uri, visibility_timeout=-1)
+        queue.put_units([{'year': 2005}])
+        assert queue.claim().unit == {'year': 2005}
+        assert queue.claim().unit == {'year': 2005}
+
+    def test_5_bad_uri(self):
+        """Check that an unknown URI scheme raises an error"""
+        try:
+            work_queue.open_queue('ftp://queue')
+            assert False, 'Should have raised WorkQueueError'
+        except work_queue.WorkQueueError:
+            pass
+
+    def test_6_claim_batch(self):
+        """Check that a batch claim takes several units and waits when there are none"""
+        self.queue.put_units([2005, 2006, 2007])
+        claims = self.queue.claim_batch(2, wait_time=0)
+        assert [claim.unit for claim in claims] == [2005, 2006]
+        self.queue.complete_batch(claims)
+        assert self.queue.remaining() == 1
+        assert [c.unit for c in self.queue.claim_batch(10, wait_time=0)] == [2007]
+        assert self.queue.claim_batch(10, wait_time=0.1) == []
+
+    def test_7_release_handle(self):
+        """Check that a claim can be released by another queue instance using its handle"""
+        other_queue = work_queue.open_queue(self.uri)
+        self.queue.put_units([2005])
+        handle = self.queue.handle(self.queue.claim())
+        other_queue.release_handle(handle)
+        assert other_queue.claim().unit == 2005
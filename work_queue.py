@@ -0,0 +1,233 @@
+"""
+Work queues used to hand out units of work (e.g. years) to st_workers.
+
+Rather than splitting the years between instances when they are launched, the master puts every
+unit into a queue and each st_worker pulls the next unit as soon as it is free. A claimed unit
+becomes visible to other workers again if it has not been completed within the visibility
+timeout, so a unit held by a worker that dies is not lost.
+
+Queues are identified by a URI, which allows the same string to be rendered into the
+st_worker's settings file:
+
+* ``sqs://<region>/<queue_name>`` - AWS SQS queue, used for real runs.
+* ``sqlite:///<path>`` - SQLite backed queue, useful for testing and running locally.
+
+Units must be JSON serializable.
+"""
+from __future__ import print_function
+
+import json
+import sqlite3
+import logging
+from time import time, sleep
+
+from boto.sqs.message import RawMessage
+
+import aws_helpers
+
+log = logging.getLogger('st_master.work_queue')
+
+# SQS's maximum, analysing a year can take several hours.
+DEFAULT_VISIBILITY_TIMEOUT = 12 * 60 * 60
+
+
+class WorkQueueError(Exception):
+    pass
+
+
+class Claim(object):
+    """
+    A unit of work that has been claimed from a queue.
+    Should be passed back to the queue's complete or release.
+    """
+    def __init__(self, unit, receipt):
+        self.unit = unit
+        self.receipt = receipt
+
+
+class SqsWorkQueue(object):
+    """
+    Work queue backed by AWS SQS. Creates the queue if it does not exist.
+    """
+    def __init__(self, region, name, visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT):
+        self.uri = 'sqs://{0}/{1}'.format(region, name)
+        self.visibility_timeout = visibility_timeout
+        self.conn = aws_helpers.create_sqs_connection(region)
+        self.queue = self.conn.get_queue(name)
+        if self.queue is None:
+            log.info('Creating SQS queue {0}'.format(name))
+            self.queue = self.conn.create_queue(name, visibility_timeout)
+        self.queue.set_message_class(RawMessage)
+
+    def put_units(self, units):
+        units = list(units)
+        # SQS allows at most 10 messages per batch.
+        for i in range(0, len(units), 10):
+            batch = [(str(i + j), json.dumps(unit), 0)
+                     for j, unit in enumerate(units[i:i + 10])]
+            self.queue.write_batch(batch)
+
+    def claim(self):
+        """
+        Returns the next Claim, or None if the queue is empty.
+        """
+        # Long poll: stops SQS from wrongly reporting that the queue is empty.
+        message = self.queue.read(visibility_timeout=self.visibility_timeout,
+                                  wait_time_seconds=20)
+        if message is None:
+            return None
+        return Claim(json.loads(message.get_body()), message)
+
+    def claim_batch(self, max_units=10, wait_time=20):
+        """
+        Returns a list of up to max_units (at most 10) Claims, waiting up to wait_time (s) for
+        at least one unit to arrive.
+        """
+        messages = self.queue.get_messages(num_messages=min(max_units, 10),
+                                           visibility_timeout=self.visibility_timeout,
+                                           wait_time_seconds=wait_time)
+        return [Claim(json.loads(message.get_body()), message) for message in messages]
+
+    def complete(self, claim):
+        self.queue.delete_message(claim.receipt)
+
+    def complete_batch(self, claims):
+        for i in range(0, len(claims), 10):
+            self.queue.delete_message_batch([claim.receipt for claim in claims[i:i + 10]])
+
+    def release(self, claim):
+        """
+        Makes a claimed unit immediately available to other workers.
+        """
+        claim.receipt.change_visibility(0)
+
+    def handle(self, claim):
+        """
+        JSON serializable handle to claim, which can be released from another process.
+        """
+        return claim.receipt.receipt_handle
+
+    def release_handle(self, handle):
+        self.conn.change_message_visibility(self.queue, handle, 0)
+
+    def remaining(self):
+        """
+        Approximate number of units not yet completed (including claimed units).
+        """
+        attrs = self.queue.get_attributes()
+        return (int(attrs['ApproximateNumberOfMessages']) +
+                int(attrs['ApproximateNumberOfMessagesNotVisible']))
+
+    def delete(self):
+        self.conn.delete_queue(self.queue)
+
+
+class SqliteWorkQueue(object):
+    """
+    Work queue backed by an SQLite database, safe to share between processes on one machine.
+    """
+    def __init__(self, path, visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT):
+        self.uri = 'sqlite://{0}'.format(path)
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        # Transactions are handled explicitly so that claims can take a write lock.
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS units ('
+                          'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                          'unit TEXT NOT NULL, '
+                          'claimed_at REAL, '
+                          'done INTEGER NOT NULL DEFAULT 0)')
+
+    def put_units(self, units):
+        self.conn.execute('BEGIN IMMEDIATE')
+        self.conn.executemany('INSERT INTO units (unit) VALUES (?)',
+                              [(json.dumps(unit), ) for unit in units])
+        self.conn.execute('COMMIT')
+
+    def claim(self):
+        """
+        Returns the next Claim, or None if the queue is empty.
+        """
+        now = time()
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.conn.execute('SELECT id, unit FROM units '
+                                    'WHERE done = 0 AND (claimed_at IS NULL OR claimed_at < ?) '
+                                    'ORDER BY id LIMIT 1',
+                                    (now - self.visibility_timeout, )).fetchone()
+            if row is not None:
+                self.conn.execute('UPDATE units SET claimed_at = ? WHERE id = ?', (now, row[0]))
+        finally:
+            self.conn.execute('COMMIT')
+
+        if row is None:
+            return None
+        return Claim(json.loads(row[1]), row[0])
+
+    def claim_batch(self, max_units=10, wait_time=20):
+        """
+        Returns a list of up to max_units Claims, waiting up to wait_time (s) for at least one
+        unit to arrive.
+        """
+        end_time = time() + wait_time
+        while True:
+            now = time()
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self.conn.execute('SELECT id, unit FROM units '
+                                         'WHERE done = 0 AND '
+                                         '(claimed_at IS NULL OR claimed_at < ?) '
+                                         'ORDER BY id LIMIT ?',
+                                         (now - self.visibility_timeout, max_units)).fetchall()
+                self.conn.executemany('UPDATE units SET claimed_at = ? WHERE id = ?',
+                                      [(now, row[0]) for row in rows])
+            finally:
+                self.conn.execute('COMMIT')
+
+            if rows or now >= end_time:
+                return [Claim(json.loads(row[1]), row[0]) for row in rows]
+            sleep(min(1, end_time - now))
+
+    def complete(self, claim):
+        self.conn.execute('UPDATE units SET done = 1 WHERE id = ?', (claim.receipt, ))
+
+    def complete_batch(self, claims):
+        self.conn.executemany('UPDATE units SET done = 1 WHERE id = ?',
+                              [(claim.receipt, ) for claim in claims])
+
+    def release(self, claim):
+        """
+        Makes a claimed unit immediately available to other workers.
+        """
+        self.release_handle(claim.receipt)
+
+    def handle(self, claim):
+        """
+        JSON serializable handle to claim, which can be released from another process.
+        """
+        return claim.receipt
+
+    def release_handle(self, handle):
+        self.conn.execute('UPDATE units SET claimed_at = NULL WHERE id = ?', (handle, ))
+
+    def remaining(self):
+        """
+        Number of units not yet completed (including claimed units).
+        """
+        return self.conn.execute('SELECT COUNT(*) FROM units WHERE done = 0').fetchone()[0]
+
+    def delete(self):
+        self.conn.execute('DROP TABLE units')
+
+
+def open_queue(uri, visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT):
+    """
+    Opens the work queue given by uri, e.g. sqs://eu-central-1/st_years or sqlite:///tmp/q.db
+    """
+    if uri.startswith('sqs://'):
+        region, name = uri[len('sqs://'):].split('/', 1)
+        return SqsWorkQueue(region, name, visibility_timeout)
+    elif uri.startswith('sqlite://'):
+        return SqliteWorkQueue(uri[len('sqlite://'):], visibility_timeout)
+    else:
+        raise WorkQueueError('Unrecognized work queue URI: {0}'.format(uri))